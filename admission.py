@@ -0,0 +1,189 @@
+"""Admission control: refuse low-priority work while the database is slow.
+
+When Postgres slows down, every request blocks waiting for a pooled
+connection and they pile up until the proxy times them out, the
+timeline and posting along with everything else. Instead, each request is
+given a priority from its endpoint:
+
+- 'critical' requests are always admitted (the timeline, posting, logging
+  in, static files);
+- 'normal' requests are refused once the worker is badly overloaded;
+- 'low' requests (long lists that can wait) are refused first.
+
+A request is refused, with `503 Service Unavailable` and Retry-After,
+when the requests already in flight in this worker, or the recent time
+spent waiting for a pool connection, pass its priority's limit in
+ADMISSION_LIMITS. The check runs before anything else in the request, so
+a refused request never touches the database.
+
+Pool wait is a moving average of how long `pool.connect()` takes. It
+decays with time too, so once requests stop waiting (or stop coming,
+because they're being refused) it falls back and traffic is let in again.
+
+Priorities default to DEFAULT_PRIORITIES and can be changed per endpoint
+with the ROUTE_PRIORITIES config setting. Refusals are counted in the
+`warbler_requests_shed_total` metric.
+"""
+
+import threading
+import time
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+import metrics
+
+
+PRIORITIES = ('critical', 'normal', 'low')
+
+DEFAULT_PRIORITY = 'normal'
+
+DEFAULT_PRIORITIES = {
+    # the timeline and posting
+    'homepage': 'critical',
+    'messages_add': 'critical',
+    'messages_stream': 'critical',
+    'like_message': 'critical',
+    'login': 'critical',
+    'logout': 'critical',
+    'signup': 'critical',
+    # no database
+    'static': 'critical',
+    'assets.asset': 'critical',
+    'metrics.show': 'critical',
+    # long lists
+    'list_users': 'low',
+    'liked_warbles': 'low',
+    'show_following': 'low',
+    'users_followers': 'low',
+    'users_likes': 'low',
+    'trending_show': 'low',
+}
+
+# priority -> (most requests already in flight, longest average pool wait
+# in seconds) before a request of that priority is refused
+DEFAULT_LIMITS = {
+    'normal': (100, 1.0),
+    'low': (25, 0.1),
+}
+
+# weight of each new pool wait in the moving average
+WAIT_SMOOTHING = 0.2
+# with no new samples, the average halves this often
+WAIT_HALF_LIFE = 2.0
+
+RETRY_AFTER = 5
+
+
+class Overloaded(ServiceUnavailable):
+    """503 with a Retry-After header."""
+
+    description = "The server is busy. Please try again in a few seconds."
+
+    def get_headers(self, *args, **kwargs):
+        headers = super().get_headers(*args, **kwargs)
+        headers.append(('Retry-After', str(RETRY_AFTER)))
+        return headers
+
+
+class AdmissionController:
+    """Counts requests in flight and pool wait, and decides who gets in."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self._wait = 0.0
+        self._wait_at = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds, now=None):
+        """Fold a pool checkout that took `seconds` into the average."""
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            average = self.pool_wait(now)
+            self._wait = average + WAIT_SMOOTHING * (seconds - average)
+            self._wait_at = now
+
+    def pool_wait(self, now=None):
+        """Recent average pool wait in seconds, decayed since the last sample."""
+
+        now = time.monotonic() if now is None else now
+        return self._wait * 0.5 ** ((now - self._wait_at) / WAIT_HALF_LIFE)
+
+    def admit(self, priority, limits, now=None):
+        """Count a request of `priority` in, or return False to refuse it."""
+
+        limit = limits.get(priority)
+        with self._lock:
+            if limit is not None:
+                max_in_flight, max_wait = limit
+                if self.in_flight >= max_in_flight or self.pool_wait(now) >= max_wait:
+                    return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+controller = AdmissionController()
+
+shed = metrics.counter('warbler_requests_shed_total',
+                       "Requests refused by admission control.",
+                       labels=('priority', 'endpoint'))
+metrics.gauge('warbler_requests_in_flight',
+              "Requests being served by this worker.",
+              lambda: controller.in_flight)
+metrics.gauge('warbler_pool_wait_seconds',
+              "Recent average wait for a database connection.",
+              lambda: round(controller.pool_wait(), 6))
+
+
+def priority_for(endpoint):
+    priorities = current_app.config.get('ROUTE_PRIORITIES', {})
+    if endpoint in priorities:
+        return priorities[endpoint]
+    return DEFAULT_PRIORITIES.get(endpoint, DEFAULT_PRIORITY)
+
+
+def _admit():
+    priority = priority_for(request.endpoint)
+    limits = current_app.config.get('ADMISSION_LIMITS', DEFAULT_LIMITS)
+
+    if not controller.admit(priority, limits):
+        shed.inc(priority, request.endpoint or '')
+        raise Overloaded()
+    g.admitted = True
+
+
+def _release(exc=None):
+    if g.pop('admitted', False):
+        controller.release()
+
+
+def watch_pool(engine):
+    """Time every connection checkout from `engine`'s pool."""
+
+    pool = engine.pool
+    if getattr(pool, '_admission_watched', False):
+        return
+
+    connect = pool.connect
+
+    def timed_connect(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return connect(*args, **kwargs)
+        finally:
+            controller.record_wait(time.monotonic() - start)
+
+    pool.connect = timed_connect
+    pool._admission_watched = True
+
+
+def init_app(app):
+    """Check admission before every other request hook of `app`."""
+
+    app.before_request_funcs.setdefault(None, []).insert(0, _admit)
+    app.teardown_request(_release)
@@ -0,0 +1,421 @@
+"""JSON API (/api/v1) for the data behind the HTML pages.
+
+Handlers are short and never block on anything but the database; with
+gevent workers (gunicorn.conf.py) and psycopg2 patched to cooperate, a
+waiting query yields to other requests, so one worker serves many slow
+clients at once.
+
+Responses are JSON (encoded with orjson when it's installed) or
+MessagePack when the client sends `Accept: application/msgpack`. Every
+list endpoint takes `fields=a,b,c` to return only those fields.
+"""
+
+import json
+from functools import wraps
+
+from flask import Blueprint, Response, g, request
+
+from cache import records, record_key
+import cards
+from models import User, Follows, Message, ArchivedMessage
+import entities
+import sharding
+import trending
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MSGPACK_TYPES = ['application/msgpack', 'application/x-msgpack']
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+# most ids a batch lookup takes in one request
+MAX_BATCH = 300
+
+
+##############################################################################
+# Encoding
+
+
+def _encode_default(obj):
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError(f"Can't encode {type(obj).__name__}")
+
+
+def render(data, status=200):
+    """Encode `data` as MessagePack or JSON, whichever the client prefers."""
+
+    offered = ['application/json'] + (MSGPACK_TYPES if msgpack else [])
+    best = request.accept_mimetypes.best_match(offered, default='application/json')
+
+    if best in MSGPACK_TYPES:
+        body = msgpack.packb(data, default=_encode_default)
+        return Response(body, status=status, mimetype=best)
+
+    if orjson:
+        body = orjson.dumps(data, default=_encode_default,
+                            option=orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(data, default=_encode_default)
+    return Response(body, status=status, mimetype='application/json')
+
+
+def error(message, status):
+    return render({'error': message}, status)
+
+
+def requested_fields():
+    fields = request.args.get('fields')
+    return set(fields.split(',')) if fields else None
+
+
+def select_fields(item, fields):
+    if fields is None:
+        return item
+    return {key: value for key, value in item.items() if key in fields}
+
+
+def page_args():
+    limit = max(1, min(request.args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT))
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    return limit, offset
+
+
+##############################################################################
+# Serializers
+
+
+def user_json(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'image_url': user.image_url,
+        'header_image_url': user.header_image_url,
+        'bio': user.bio,
+        'location': user.location,
+    }
+
+
+def message_json(msg):
+    return {
+        'id': msg.id,
+        'user_id': msg.user_id,
+        'text': msg.text,
+        'timestamp': msg.timestamp,
+    }
+
+
+def timeline_json(messages, fields=None):
+    """Compact JSON for a list of messages: authors are listed once."""
+
+    users = {}
+    for msg in messages:
+        if msg.user_id not in users:
+            users[msg.user_id] = {'username': msg.user.username,
+                                  'image_url': msg.user.image_url}
+
+    return {
+        'messages': [select_fields(message_json(msg), fields) for msg in messages],
+        'users': users,
+    }
+
+
+def users_json(users, fields=None):
+    return {'users': [select_fields(user_json(user), fields) for user in users]}
+
+
+##############################################################################
+# Batch lookups through the record cache
+
+
+def _load_users(ids):
+    return {user.id: user_json(user)
+            for user in User.query.filter(User.id.in_(ids))}
+
+
+def _load_messages(ids):
+    shards = sharding.current()
+    if shards:
+        return {msg.id: message_json(msg) for msg in shards.find_many(ids)}
+
+    found = {msg.id: message_json(msg)
+             for msg in Message.query.filter(Message.id.in_(ids))}
+
+    archived = [msg_id for msg_id in ids if msg_id not in found]
+    if archived:
+        found.update((msg.id, message_json(msg)) for msg in
+                     ArchivedMessage.query.filter(ArchivedMessage.id.in_(archived)))
+    return found
+
+
+LOADERS = {
+    'user': _load_users,
+    'message': _load_messages,
+}
+
+
+def record_tags(kind, item):
+    """Tags besides its own key for a cached record: a message's author."""
+
+    if kind == 'message':
+        return [record_key('user', item['user_id'])]
+    return []
+
+
+def lookup(kind, ids):
+    """Serialized records for `ids`, in the same order; missing ids are skipped.
+
+    Cached records are served from memory; the rest are fetched with one
+    IN query and cached. Requests missing on the same records at once
+    share that query.
+    """
+
+    keys = {record_key(kind, record_id): record_id for record_id in ids}
+
+    def load(misses):
+        loaded = LOADERS[kind]([keys[key] for key in misses])
+        return {record_key(kind, record_id): item for record_id, item in loaded.items()}
+
+    found = records.get_many_or_load(list(keys), load,
+                                     tags=lambda key, item: record_tags(kind, item))
+    found = {keys[key]: item for key, item in found.items()}
+    return [found[record_id] for record_id in ids if record_id in found]
+
+
+def requested_ids():
+    """Parse `ids=1,2,3` into a de-duplicated list, keeping the order.
+
+    Raises ValueError for non-numeric ids or too many of them.
+    """
+
+    ids = []
+    seen = set()
+    for part in request.args.get('ids', '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if not part.isdigit():
+            raise ValueError("Invalid ids.")
+        record_id = int(part)
+        if record_id not in seen:
+            seen.add(record_id)
+            ids.append(record_id)
+
+    if len(ids) > MAX_BATCH:
+        raise ValueError(f"At most {MAX_BATCH} ids per request.")
+    return ids
+
+
+def batch(kind, key):
+    try:
+        ids = requested_ids()
+    except ValueError as e:
+        return error(str(e), 400)
+
+    fields = requested_fields()
+    items = [select_fields(item, fields) for item in lookup(kind, ids)]
+    return render({key: items})
+
+
+##############################################################################
+# Endpoints
+
+
+def api_auth(f):
+    """Like app.check_auth, but answer with a JSON 401."""
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not g.user:
+            return error("Access unauthorized.", 401)
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+@api.route('/timeline')
+@api_auth
+def timeline():
+    """Messages from followed users; takes `before`, `since` and `limit`."""
+
+    user_ids = list(g.viewer.following)
+    user_ids.append(g.user.id)
+
+    limit, _ = page_args()
+    since = request.args.get('since', type=int)
+    shards = sharding.current()
+    timeline = shards.timeline if shards else cards.timeline
+    messages = timeline(user_ids=user_ids,
+                        before=request.args.get('before', type=int),
+                        since=since,
+                        limit=limit)
+
+    if since is not None and not messages:
+        return Response(status=204)
+
+    return render(timeline_json(messages, requested_fields()))
+
+
+@api.route('/users')
+@api_auth
+def list_users():
+    """Users, optionally matching a `q` search on username.
+
+    With `ids=1,2,3`, look those users up instead (in that order).
+    """
+
+    if 'ids' in request.args:
+        return batch('user', 'users')
+
+    limit, offset = page_args()
+    search = request.args.get('q')
+
+    query = User.query
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
+    users = query.order_by(User.id).offset(offset).limit(limit).all()
+
+    return render(users_json(users, requested_fields()))
+
+
+@api.route('/users/<int:user_id>')
+@api_auth
+def users_show(user_id):
+    """A user's profile and their latest messages (paged with `before`)."""
+
+    users = lookup('user', [user_id])
+    if not users:
+        return error("Not found.", 404)
+
+    limit, _ = page_args()
+    shards = sharding.current()
+    timeline = shards.timeline if shards else cards.timeline
+    messages = timeline(user_ids=[user_id],
+                        before=request.args.get('before', type=int),
+                        limit=limit)
+    fields = requested_fields()
+
+    return render({
+        'user': select_fields(users[0], fields),
+        'messages': [select_fields(message_json(msg), fields) for msg in messages],
+    })
+
+
+@api.route('/users/<int:user_id>/following')
+@api_auth
+def show_following(user_id):
+    limit, offset = page_args()
+    users = (User.query
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user_id)
+             .order_by(User.id)
+             .offset(offset)
+             .limit(limit)
+             .all())
+
+    return render(users_json(users, requested_fields()))
+
+
+@api.route('/users/<int:user_id>/followers')
+@api_auth
+def users_followers(user_id):
+    limit, offset = page_args()
+    users = (User.query
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id)
+             .order_by(User.id)
+             .offset(offset)
+             .limit(limit)
+             .all())
+
+    return render(users_json(users, requested_fields()))
+
+
+@api.route('/users/<int:user_id>/liked_warbles')
+@api_auth
+def liked_warbles(user_id):
+    """Messages a user liked, newest first; paged with `before`."""
+
+    limit, _ = page_args()
+    shards = sharding.current()
+    liked = shards.liked_messages if shards else cards.liked
+    messages = liked(user_id, before=request.args.get('before', type=int), limit=limit)
+    return render(timeline_json(messages, requested_fields()))
+
+
+@api.route('/tags/<tag>')
+@api_auth
+def tags_show(tag):
+    """Messages with a hashtag, newest first; paged with `before`."""
+
+    limit, _ = page_args()
+    messages = entities.tagged(tag, before=request.args.get('before', type=int),
+                               limit=limit)
+    return render(timeline_json(messages, requested_fields()))
+
+
+@api.route('/mentions')
+@api_auth
+def mentions():
+    """Messages mentioning the current user, newest first."""
+
+    limit, _ = page_args()
+    messages = entities.mentioning(g.user.id,
+                                   before=request.args.get('before', type=int),
+                                   limit=limit)
+    return render(timeline_json(messages, requested_fields()))
+
+
+@api.route('/trending')
+@api_auth
+def trending_list():
+    """Trending messages and users in a `window` ('hour' or 'day')."""
+
+    window = request.args.get('window', 'hour')
+    if window not in trending.WINDOWS:
+        return error("Unknown window.", 400)
+
+    limit = max(1, min(request.args.get('limit', 20, type=int), trending.TOP_CAPACITY))
+    fields = requested_fields()
+
+    data = {}
+    for kind, record_kind in (('messages', 'message'), ('users', 'user')):
+        scores = dict(trending.top(kind, window, limit))
+        data[kind] = [dict(select_fields(item, fields), score=scores[item['id']])
+                      for item in lookup(record_kind, list(scores))]
+    return render(data)
+
+
+@api.route('/messages')
+@api_auth
+def messages_batch():
+    """Look up the messages in `ids=1,2,3` (in that order)."""
+
+    return batch('message', 'messages')
+
+
+@api.route('/messages/<int:message_id>')
+@api_auth
+def messages_show(message_id):
+    messages = lookup('message', [message_id])
+    authors = messages and lookup('user', [messages[0]['user_id']])
+    if not authors:
+        return error("Not found.", 404)
+
+    # a copy: the record is shared through the cache, the rest is this viewer's
+    data = dict(select_fields(messages[0], requested_fields()))
+    data['liked'] = g.viewer.has_liked(message_id)
+    data['user'] = authors[0]
+    return render(data)
@@ -1,11 +1,46 @@
+import json
 import os
+import time
+from datetime import datetime, timedelta
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, Response, render_template, request, flash, redirect,
+                   session, g, jsonify, stream_with_context, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from forms import UserAddForm, LoginForm, MessageForm, ProfileEditForm, ChangePasswordForm
-from models import db, connect_db, User, Follows, Message, Likes
+from models import (db, connect_db, User, Follows, Message, Likes, ArchivedMessage,
+                    ArchivedLike, Suggestion, StaleSuggestions, MessageTag, Mention,
+                    Notification)
+import admission
+import api
+import archive
+import assets
+import availability
+import cards
+from cards import user_cards
+from compression import CompressionMiddleware
+import entities
+import images
+import metrics
+from broker import create_broker, user_topic
+import cache
+from cache import records, record_key
+import migrations
+import notifications
+import ratelimit
+from ratelimit import rate_limit
+import recommendations
+import sharding
+import snowflake
+from streaming import stream_template
+import trending
+import viewer_state
+import warmup
+from export import EXPORT_FORMATS, export_filename, export_stream
 CURR_USER_KEY = "curr_user"
+VIEWER_VERSION_KEY = "viewer_version"
+VIEWER_CHANGED_KEY = "viewer_changed_at"
 
 app = Flask(__name__)
 
@@ -18,13 +53,65 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['EMAIL_DELIVERABILITY_POLICY'] = (
+    os.environ.get('EMAIL_DELIVERABILITY_POLICY', 'warn'))
+# 'memory://' only reaches streams served by the same worker; use the
+# database URL to fan events out to every worker through LISTEN/NOTIFY
+app.config['BROKER_URL'] = os.environ.get('BROKER_URL', 'memory://')
+# where trending counts are checkpointed for restarts (unset: not at all)
+app.config['TRENDING_CHECKPOINT'] = os.environ.get('TRENDING_CHECKPOINT')
+# 'memory://' limits each worker separately; 'sqlite:///path' shares the
+# buckets between workers on a host (see ratelimit.py)
+app.config['RATELIMIT_URL'] = os.environ.get('RATELIMIT_URL', 'memory://')
+# per-endpoint overrides of the limits set on routes, e.g.
+# {'login': {'ip': '5/minute'}}; None turns an endpoint's limits off
+app.config['RATE_LIMITS'] = {}
+# per-endpoint overrides of admission.DEFAULT_PRIORITIES
+# ('critical', 'normal' or 'low')
+app.config['ROUTE_PRIORITIES'] = {}
+# priority -> (most requests in flight, longest average pool wait in
+# seconds) before requests of that priority are refused with a 503
+app.config['ADMISSION_LIMITS'] = dict(admission.DEFAULT_LIMITS)
+# 'name=url,name=url' to keep messages and likes on shards by user id
+# (see sharding.py); unset keeps them in the main database
+app.config['SHARDS'] = sharding.parse_shard_urls(os.environ.get('SHARD_URLS'))
+# 'memory://' caches records in each worker only; 'sqlite:///path' (best on
+# a RAM disk, like /dev/shm) adds a second tier shared by every worker on
+# the host (see cache.py)
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL', 'memory://')
+# cache warm-up on worker start (see warmup.py): a file of the hottest
+# user ids, from `flask hot-list`, and how long and how much memory to
+# spend warming them
+app.config['WARMUP_HOT_LIST'] = os.environ.get('WARMUP_HOT_LIST')
+app.config['WARMUP_TIME_BUDGET'] = float(
+    os.environ.get('WARMUP_TIME_BUDGET', warmup.WARM_TIME_BUDGET))
+app.config['WARMUP_MEMORY_BUDGET'] = int(
+    os.environ.get('WARMUP_MEMORY_BUDGET', warmup.WARM_MEMORY_BUDGET))
 toolbar = DebugToolbarExtension(app)
+app.wsgi_app = CompressionMiddleware(app.wsgi_app)
 
 connect_db(app)
-
-# Initialize app context for database connection and create tables
+broker = create_broker(app.config['BROKER_URL'])
+app.register_blueprint(api.api)
+app.register_blueprint(assets.assets)
+app.register_blueprint(metrics.metrics)
+admission.init_app(app)
+app.add_template_global(assets.asset_url)
+app.add_template_filter(entities.linkify)
+images.init_app(app)
+trending.configure(app.config['TRENDING_CHECKPOINT'])
+ratelimit.configure(app.config['RATELIMIT_URL'])
+cache.configure(app.config['CACHE_URL'])
+
+# Initialize app context for database connection and bring the schema
+# up to date (a no-op once every migration has been applied)
 with app.app_context():
-    db.create_all()
+    migrations.upgrade(db.engine)
+    admission.watch_pool(db.engine)
+    sharding.init_app(app, db.engine)
+    # where processes lease their message id workers (see snowflake.py)
+    snowflake.configure(sharding.IdAllocator(db.engine, 'snowflake_workers',
+                                             block_size=1, start=0).next_id)
 
 def check_auth(f):
     def wrapper(*args, **kwargs):
@@ -49,6 +136,20 @@ def add_user_to_g():
     else:
         g.user = None
 
+    # ids of who they follow and what they've liked, for the templates
+    g.viewer = None
+    if g.user:
+        g.viewer = viewer_state.for_user(g.user.id, session.get(VIEWER_VERSION_KEY, 0),
+                                         session.get(VIEWER_CHANGED_KEY))
+
+
+def bump_viewer_version():
+    """Note that the current user followed/liked something; return the new version."""
+
+    session[VIEWER_VERSION_KEY] = session.get(VIEWER_VERSION_KEY, 0) + 1
+    session[VIEWER_CHANGED_KEY] = time.time()
+    return session[VIEWER_VERSION_KEY]
+
 
 def do_login(user):
     """Log in user."""
@@ -64,6 +165,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@rate_limit(ip='5/minute')
 def signup():
     """Handle user signup.
 
@@ -79,6 +181,12 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # check before User.signup, so we don't spend a bcrypt hash on a
+        # name we'll have to turn down anyway
+        if availability.is_taken(form.username.data, form.email.data):
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -87,6 +195,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            images.derive_later(user.image_url)
 
         except IntegrityError as e:
             flash("Username already taken", 'danger')
@@ -100,7 +209,25 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
+@app.route('/signup/available')
+def signup_available():
+    """Tell the signup form whether a username and/or email are free.
+
+    Takes `username` and/or `email` params in the querystring; returns JSON
+    like {"username": true, "email": false}.
+    """
+
+    result = {}
+    if 'username' in request.args:
+        result['username'] = not availability.username_taken(request.args['username'])
+    if 'email' in request.args:
+        result['email'] = not availability.email_taken(request.args['email'])
+
+    return jsonify(result)
+
+
 @app.route('/login', methods=["GET", "POST"])
+@rate_limit(ip='10/minute')
 def login():
     """Handle user login."""
 
@@ -144,6 +271,10 @@ def list_users():
         # Handle user creation logic here
         form = UserAddForm()  # Ensure form defined for adding users
         if form.validate_on_submit():
+            if availability.is_taken(form.username.data, form.email.data):
+                flash("Username already taken", "danger")
+                return render_template('users/index.html', form=form)
+
             try:
                 user = User.signup(
                     username=form.username.data,
@@ -161,12 +292,17 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.query.order_by(User.id)
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    suggestions = []
+    if g.user and not search:
+        suggestions = Suggestion.for_user(g.user.id, exclude=g.viewer.following)
 
-    return render_template('users/index.html', users=users)
+    # can be every user there is, so send the page as it renders
+    return stream_template('users/index.html', users=user_cards(users),
+                           suggestions=suggestions)
 
 
 @app.route('/users/<int:user_id>')
@@ -178,12 +314,10 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    shards = sharding.current()
+    timeline = shards.timeline if shards else cards.timeline
+    messages = timeline(user_ids=[user_id],
+                        before=request.args.get('before', type=int))
     return render_template('users/show.html', user=user, messages=messages)
 
 
@@ -194,10 +328,41 @@ def liked_warbles(user_id):
     """Show liked warbles for a specific user."""
     user = User.query.get_or_404(user_id)
 
-    # fetch liked messages
-    liked_warbles = Message.query.join(Likes).filter(Likes.user_id == user_id).all()
+    shards = sharding.current()
+    if shards:
+        return render_template('users/liked_warbles.html', user=user,
+                               liked_warbles=shards.liked_messages(user_id))
+
+    return render_template('users/liked_warbles.html', user=user,
+                           liked_warbles=Message.liked_by(user_id))
 
-    return render_template('users/liked_warbles.html', user=user, liked_warbles=liked_warbles)
+
+@app.route('/users/<int:user_id>/export')
+@check_auth
+def export_user(user_id):
+    """Download all of this user's messages, likes and follows.
+
+    Takes `format` (ndjson or csv) and `gzip` params in the querystring.
+    The export is streamed, so it starts right away even for big accounts.
+    """
+
+    if g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        flash("Unknown export format.", "danger")
+        return redirect(f"/users/{user_id}")
+
+    gzip = request.args.get('gzip') in ('1', 'true')
+    filename = export_filename(g.user, fmt, gzip)
+
+    return Response(
+        stream_with_context(export_stream(user_id, fmt, gzip)),
+        mimetype='application/gzip' if gzip else EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
 
 
 @app.route('/users/<int:user_id>/following')
@@ -210,7 +375,12 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = (User.query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id)
+                 .order_by(User.id))
+    return stream_template('users/following.html', user=user,
+                           following=user_cards(following))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -223,7 +393,12 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = (User.query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .order_by(User.id))
+    return stream_template('users/followers.html', user=user,
+                           followers=user_cards(followers))
 
 
 
@@ -246,8 +421,13 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    if not g.viewer.is_following(followed_user.id):
+        db.session.add(Follows(user_being_followed_id=followed_user.id,
+                               user_following_id=g.user.id))
+        StaleSuggestions.mark(g.user.id)
+        db.session.commit()
+        viewer_state.follow(g.user.id, followed_user.id, bump_viewer_version())
+        notifications.notify(followed_user.id, 'follow', g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -261,13 +441,39 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.query.filter_by(user_being_followed_id=follow_id,
+                            user_following_id=g.user.id).delete()
+    StaleSuggestions.mark(g.user.id)
     db.session.commit()
+    viewer_state.unfollow(g.user.id, follow_id, bump_viewer_version())
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.route('/notifications')
+@check_auth
+def notifications_show():
+    """Show the current user's latest notifications and mark them read."""
+
+    latest = (Notification.query
+                          .filter_by(user_id=g.user.id)
+                          .options(db.joinedload(Notification.actor))
+                          .order_by(Notification.updated_at.desc())
+                          .limit(50)
+                          .all())
+    unread = {n.id for n in latest if not n.is_read}
+    shards = sharding.current()
+    find_many = shards.find_many if shards else Message.find_many
+    messages = {msg.id: msg for msg in
+                find_many([n.message_id for n in latest if n.message_id])}
+
+    if g.user.unread_notifications or unread:
+        notifications.mark_read(g.user.id)
+
+    return render_template('users/notifications.html', notifications=latest,
+                           unread=unread, messages=messages)
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
 @check_auth
 def edit_profile():
@@ -288,6 +494,10 @@ def edit_profile():
                 user.location = form.location.data
 
                 db.session.commit()
+                # their record, and every cached entry tagged with it
+                records.invalidate(record_key('user', user.id))
+                images.derive_later(user.image_url, refresh=True)
+                images.derive_later(user.header_image_url, refresh=True)
 
             except IntegrityError:
                 flash("Username already taken", 'danger')
@@ -303,6 +513,7 @@ def edit_profile():
         return render_template('users/edit.html', form=form)
 
 @app.route('/users/profile/password', methods=["GET", "POST"])
+@rate_limit(ip='10/minute', user='5/minute')
 @check_auth
 def change_password():
     """Change password for current user."""
@@ -354,8 +565,32 @@ def delete_user():
             flash("User not found.", "danger")
             return redirect("/")
 
+        # Delete hashtags and mentions in their messages, hot or archived
+        for model in (Message, ArchivedMessage):
+            own = db.session.query(model.id).filter(model.user_id == user_to_delete.id)
+            MessageTag.query.filter(MessageTag.message_id.in_(own)).delete(synchronize_session=False)
+            Mention.query.filter(Mention.message_id.in_(own)).delete(synchronize_session=False)
+
+        # Delete likes of their archived messages (likes_archive has no
+        # foreign key to cascade from)
+        own_archived = (db.session.query(ArchivedMessage.id)
+                                  .filter(ArchivedMessage.user_id == user_to_delete.id))
+        ArchivedLike.query.filter(ArchivedLike.message_id.in_(own_archived)).delete(synchronize_session=False)
+
+        # Delete their messages and likes on the shards, with those messages'
+        # likes, hashtags and mentions
+        shards = sharding.current()
+        if shards:
+            sharded = shards.delete_user(user_to_delete.id)
+            for i in range(0, len(sharded), sharding.DELETE_BATCH_SIZE):
+                batch = sharded[i:i + sharding.DELETE_BATCH_SIZE]
+                MessageTag.query.filter(MessageTag.message_id.in_(batch)).delete(synchronize_session=False)
+                Mention.query.filter(Mention.message_id.in_(batch)).delete(synchronize_session=False)
+
         # Delete messages associated with the user
         Message.query.filter_by(user_id=user_to_delete.id).delete(synchronize_session='fetch')
+        ArchivedMessage.query.filter_by(user_id=user_to_delete.id).delete(synchronize_session=False)
+        ArchivedLike.query.filter_by(user_id=user_to_delete.id).delete(synchronize_session=False)
 
         # Delete related follows entries
         Follows.query.filter(
@@ -366,6 +601,8 @@ def delete_user():
         # Delete the user
         db.session.delete(user_to_delete)
         db.session.commit()
+        viewer_state.forget(user_to_delete.id)
+        records.invalidate(record_key('user', user_to_delete.id))
         flash("User deleted successfully.", "success")
     except Exception as e:
         db.session.rollback()  # Rollback in case of error
@@ -375,10 +612,15 @@ def delete_user():
     return redirect("/signup")
 
 @app.route('/users/add_like/<int:message_id>', methods=["POST"])
+@rate_limit(ip='120/minute', user='60/minute')
 @check_auth
 def like_message(message_id):
     """Like a message."""
 
+    shards = sharding.current()
+    if shards:
+        return like_sharded_message(shards, message_id)
+
     # Fetch the message or return a 404 if not found
     message = Message.query.get_or_404(message_id)
 
@@ -403,6 +645,36 @@ def like_message(message_id):
     # Commit the session
     db.session.commit()
 
+    if existing_like:
+        viewer_state.unlike(g.user.id, message_id, bump_viewer_version())
+    else:
+        viewer_state.like(g.user.id, message_id, bump_viewer_version())
+        trending.record_like(message_id, message.user_id)
+        notifications.notify(message.user_id, 'like', g.user.id, message_id)
+
+    return redirect(f"/messages/{message_id}")
+
+
+def like_sharded_message(shards, message_id):
+    """like_message, for messages and likes kept on shards."""
+
+    message = shards.find(message_id)
+    if message is None:
+        abort(404)
+
+    if message.user_id == g.user.id:
+        flash("You cannot like your own warble!", "error")
+        return redirect(f"/messages/{message_id}")
+
+    if shards.toggle_like(g.user.id, message):
+        flash("Warble liked!", "success")
+        viewer_state.like(g.user.id, message_id, bump_viewer_version())
+        trending.record_like(message_id, message.user_id)
+        notifications.notify(message.user_id, 'like', g.user.id, message_id)
+    else:
+        flash("Warble unliked!", "info")
+        viewer_state.unlike(g.user.id, message_id, bump_viewer_version())
+
     return redirect(f"/messages/{message_id}")
 
 
@@ -410,6 +682,7 @@ def like_message(message_id):
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@rate_limit(ip='60/minute', user='30/minute')
 def messages_add():
     """Add a message:
 
@@ -423,10 +696,28 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
+        shards = sharding.current()
+        if shards:
+            msg_id = shards.add_message(g.user.id, form.text.data)
+            _, mentions = entities.index_sharded(msg_id, form.text.data)
+            db.session.commit()
+
+            broker.publish(user_topic(g.user.id), {'id': msg_id, 'user_id': g.user.id})
+            trending.record_message(g.user.id)
+            for mention in mentions:
+                notifications.notify(mention.user_id, 'mention', g.user.id, msg_id)
+            return redirect(f"/users/{g.user.id}")
+
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        entities.index_message(msg)
         db.session.commit()
 
+        broker.publish(user_topic(g.user.id), {'id': msg.id, 'user_id': g.user.id})
+        trending.record_message(g.user.id)
+        for mention in msg.mentions:
+            notifications.notify(mention.user_id, 'mention', g.user.id, msg.id)
+
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
@@ -437,15 +728,59 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    shards = sharding.current()
+    if shards:
+        msg = shards.find(message_id)
+        if msg is None:
+            abort(404)
+        return render_template('messages/show.html', message=msg,
+                               user_liked=g.viewer.has_liked(message_id))
+
+    msg = Message.find(message_id)
+    if msg is None:
+        abort(404)
     # Check if the user has liked the message
     user_liked = False
     if g.user:
-        user_liked = any(like.user_id == g.user.id for like in msg.likes)
+        user_liked = g.viewer.has_liked(msg.id)
 
     return render_template('messages/show.html', message=msg, user_liked=user_liked)
 
 
+# seconds between keepalive comments on an idle stream
+STREAM_KEEPALIVE = 15
+
+
+@app.route('/messages/stream')
+@check_auth
+def messages_stream():
+    """Stream ids of new messages from followed users, as server-sent events.
+
+    The response is long-lived; serve it from an async (gevent) worker.
+    """
+
+    topics = [user_topic(user_id) for user_id in g.viewer.following]
+    topics.append(user_topic(g.user.id))
+    sub = broker.subscribe(topics)
+
+    def events():
+        yield "retry: 5000\n\n"
+        while True:
+            event = sub.get(timeout=STREAM_KEEPALIVE)
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+
+            topic, payload = event
+            yield f"id: {payload['id']}\nevent: message\ndata: {json.dumps(payload)}\n\n"
+
+    resp = Response(events(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+    # runs when the client goes away, even if the stream never started
+    resp.call_on_close(sub.close)
+    return resp
+
+
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
@@ -454,13 +789,70 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    shards = sharding.current()
+    if shards:
+        if shards.delete_message(message_id, g.user.id):
+            MessageTag.query.filter_by(message_id=message_id).delete()
+            Mention.query.filter_by(message_id=message_id).delete()
+            db.session.commit()
+            records.delete(record_key('message', message_id))
+        return redirect(f"/users/{g.user.id}")
+
     msg = Message.query.get(message_id)
     db.session.delete(msg)
     db.session.commit()
+    records.delete(record_key('message', message_id))
 
     return redirect(f"/users/{g.user.id}")
 
 
+@app.route('/tags/<tag>')
+@check_auth
+def tags_show(tag):
+    """Show messages with a hashtag, newest first."""
+
+    messages = entities.tagged(tag, before=request.args.get('before', type=int))
+    return render_template('messages/feed.html', title=f"#{tag.lower()}",
+                           messages=messages, page_size=entities.FEED_PAGE_SIZE)
+
+
+@app.route('/mentions')
+@check_auth
+def mentions_show():
+    """Show messages mentioning the current user, newest first."""
+
+    messages = entities.mentioning(g.user.id,
+                                   before=request.args.get('before', type=int))
+    return render_template('messages/feed.html', title="Mentions",
+                           messages=messages, page_size=entities.FEED_PAGE_SIZE)
+
+
+@app.route('/trending')
+@check_auth
+def trending_show():
+    """Show the most-liked messages and most active users right now."""
+
+    window = request.args.get('window', 'hour')
+    if window not in trending.WINDOWS:
+        window = 'hour'
+
+    top_messages = [msg_id for msg_id, _ in trending.top('messages', window)]
+    top_users = [user_id for user_id, _ in trending.top('users', window)]
+
+    # ids come back best first; deleted ones are skipped
+    shards = sharding.current()
+    if shards:
+        messages = shards.find_many(top_messages)
+    else:
+        found = {msg.id: msg for msg in Message.query.filter(Message.id.in_(top_messages))}
+        messages = [found[msg_id] for msg_id in top_messages if msg_id in found]
+    found = {user.id: user for user in User.query.filter(User.id.in_(top_users))}
+    users = [found[user_id] for user_id in top_users if user_id in found]
+
+    return render_template('trending.html', window=window,
+                           windows=trending.WINDOWS, messages=messages, users=users)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -471,24 +863,44 @@ def homepage():
 
     - anon users: no messages
     - logged in: 100 most recent messages of followed_users
+
+    Polling clients can pass `since` (the newest message id they have) to
+    get only newer messages, and ask for JSON with `format=json` or an
+    Accept header. If there's nothing new, the response is an empty 204.
     """
 
+    wants_json = (request.args.get('format') == 'json' or
+                  request.accept_mimetypes.best_match(
+                      ['text/html', 'application/json']) == 'application/json')
+
     if g.user:
-        messages = (Message
-                    .query
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        user_ids = list(g.viewer.following)
+        user_ids.append(g.user.id)
+
+        since = request.args.get('since', type=int)
+        shards = sharding.current()
+        timeline = shards.timeline if shards else cards.timeline
+        messages = timeline(user_ids=user_ids,
+                            before=request.args.get('before', type=int),
+                            since=since)
+
+        if since is not None and not messages:
+            return '', 204
 
-        followings = [following.id for following in g.user.following]
-        followings.append(g.user.id)
-        likes = [like.id for like in g.user.likes]
+        if wants_json:
+            return api.render(api.timeline_json(messages))
 
-        return render_template('home.html', messages=messages, followings=followings, likes=likes)
+        suggestions = Suggestion.for_user(g.user.id, exclude=g.viewer.following)
+        return render_template('home.html', messages=messages,
+                               suggestions=suggestions)
+
+    elif wants_json:
+        return api.error("Access unauthorized.", 401)
 
     else:
         return render_template('home-anon.html')
 
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -498,7 +910,13 @@ def homepage():
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Fingerprinted assets keep their own far-future caching headers.
+    """
+
+    if request.endpoint == 'assets.asset':
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
@@ -511,3 +929,127 @@ def page_not_found(e):
     """NOT FOUND page 404 ERROR"""
 
     return render_template('users/404.html'), 404
+
+
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('db-upgrade')
+@click.option('--target', type=int, default=None,
+              help="Stop after this migration version.")
+def db_upgrade(target):
+    """Apply pending schema migrations."""
+
+    applied = migrations.upgrade(db.engine, target=target)
+    for mig in applied:
+        click.echo(f"applied {mig.version}: {mig.description}")
+    if not applied:
+        click.echo("schema is up to date")
+
+
+@app.cli.command('db-verify-indexes')
+@click.option('--min-rows', type=int, default=10_000,
+              help="Ignore sequential scans on tables smaller than this.")
+def db_verify_indexes(min_rows):
+    """Fail if a hot route query sequentially scans a large table."""
+
+    problems = migrations.verify_indexes(db.engine, min_rows=min_rows)
+    for route, table, rows in problems:
+        click.echo(f"{route}: sequential scan on {table} (~{rows} rows)", err=True)
+    if problems:
+        raise SystemExit(1)
+    click.echo("all hot queries use indexes")
+
+
+@app.cli.command('export-user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(sorted(EXPORT_FORMATS)),
+              default='ndjson')
+@click.option('--gzip', is_flag=True, help="Compress the output.")
+@click.option('--output', '-o', type=click.File('wb'), default='-')
+def export_user_command(user_id, fmt, gzip, output):
+    """Stream a user's data to a file (stdout by default)."""
+
+    if not User.query.get(user_id):
+        raise click.BadParameter(f"no user with id {user_id}")
+
+    for chunk in export_stream(user_id, fmt, gzip):
+        output.write(chunk)
+
+
+@app.cli.command('archive-messages')
+@click.option('--older-than-days', type=int, default=archive.HOT_WINDOW_DAYS)
+@click.option('--batch-size', type=int, default=archive.ARCHIVE_BATCH_SIZE)
+def archive_messages_command(older_than_days, batch_size):
+    """Move old messages and their likes to the archive tables."""
+
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    count = archive.archive_messages(cutoff, batch_size=batch_size)
+    click.echo(f"archived {count} messages older than {cutoff:%Y-%m-%d}")
+
+
+@app.cli.command('recommend-users')
+@click.option('--all', 'everyone', is_flag=True,
+              help="Recompute every user, not just those whose follows changed.")
+def recommend_users_command(everyone):
+    """Recompute "who to follow" suggestions."""
+
+    if everyone:
+        count = recommendations.refresh(engine=db.engine)
+    else:
+        count = recommendations.refresh_stale(db.engine)
+    click.echo(f"refreshed suggestions for {count} users")
+
+
+@app.cli.command('backfill-entities')
+@click.option('--batch-size', type=int, default=entities.BACKFILL_BATCH_SIZE)
+def backfill_entities_command(batch_size):
+    """Index hashtags and mentions in existing messages."""
+
+    count = entities.backfill(batch_size=batch_size)
+    click.echo(f"indexed {count} messages")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Write fingerprinted, precompressed copies of static files."""
+
+    manifest = assets.build()
+    click.echo(f"built {len(manifest)} assets into {assets.DIST_DIR}")
+
+
+@app.cli.command('rebalance-shards')
+@click.option('--batch-size', type=int, default=sharding.REBALANCE_BATCH_SIZE)
+def rebalance_shards_command(batch_size):
+    """Move messages and likes to the shards SHARD_URLS now puts them on."""
+
+    shards = sharding.current()
+    if not shards:
+        raise click.ClickException("SHARD_URLS isn't set; nothing to rebalance.")
+
+    for name, moved in shards.rebalance(batch_size=batch_size).items():
+        click.echo(f"moved {moved} rows off shard {name}")
+
+
+@app.cli.command('move-to-shards')
+@click.option('--batch-size', type=int, default=sharding.REBALANCE_BATCH_SIZE)
+def move_to_shards_command(batch_size):
+    """Move the main database's messages and likes to the shards that own them."""
+
+    shards = sharding.current()
+    if not shards:
+        raise click.ClickException("SHARD_URLS isn't set; nowhere to move them.")
+
+    copied = shards.move_from_main(batch_size=batch_size)
+    click.echo(f"moved {copied['messages']} messages and {copied['likes']} likes to the shards")
+
+
+@app.cli.command('hot-list')
+@click.argument('access_log', type=click.File())
+@click.option('--limit', type=int, default=warmup.HOT_LIST_SIZE)
+def hot_list_command(access_log, limit):
+    """Print the ids of the users an access log asks for most, for WARMUP_HOT_LIST."""
+
+    for user_id in warmup.hot_list(access_log, limit):
+        click.echo(user_id)
@@ -0,0 +1,107 @@
+"""Move old messages from the hot `messages` table to the cold archive.
+
+Timelines mostly read the last few weeks of messages, so keeping only
+those in `messages` keeps its indexes small. Older messages (and their
+likes) are moved, in batches, to `messages_archive` / `likes_archive`;
+`Message.timeline` reads from the archive only when a page runs past the
+hot rows.
+
+On Postgres `messages_archive` is range-partitioned by month, and this
+job creates each month's partition the first time it's needed.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from models import db, Message, Likes, ArchivedMessage, ArchivedLike
+
+
+HOT_WINDOW_DAYS = 30
+
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def _month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def _next_month(dt):
+    return datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+
+
+def is_partitioned(conn):
+    """Is messages_archive a partitioned table? (Postgres only.)"""
+
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    relkind = conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE relname = 'messages_archive'")).scalar()
+    return relkind == 'p'
+
+
+def ensure_partition(conn, month):
+    """Create the messages_archive partition holding `month`."""
+
+    start = _month_start(month)
+    end = _next_month(start)
+
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS messages_archive_{start:%Y_%m} "
+        f"PARTITION OF messages_archive "
+        f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"))
+
+
+def archive_messages(cutoff=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move messages older than `cutoff` into the archive.
+
+    `cutoff` defaults to HOT_WINDOW_DAYS ago. Each batch is moved in its
+    own transaction, so the job can be stopped and rerun safely.
+    Returns the number of messages archived.
+    """
+
+    if cutoff is None:
+        cutoff = datetime.utcnow() - timedelta(days=HOT_WINDOW_DAYS)
+
+    partitioned = is_partitioned(db.session.connection())
+    archived = 0
+
+    while True:
+        batch = (db.session
+                 .query(Message.id, Message.timestamp)
+                 .filter(Message.timestamp < cutoff)
+                 .order_by(Message.timestamp)
+                 .limit(batch_size)
+                 .all())
+        if not batch:
+            break
+
+        ids = [msg_id for msg_id, _ in batch]
+
+        if partitioned:
+            months = {_month_start(timestamp) for _, timestamp in batch}
+            for month in sorted(months):
+                ensure_partition(db.session.connection(), month)
+
+        moved_messages = db.session.query(
+            Message.id, Message.text, Message.timestamp, Message.user_id
+        ).filter(Message.id.in_(ids))
+        db.session.execute(
+            ArchivedMessage.__table__.insert().from_select(
+                ['id', 'text', 'timestamp', 'user_id'], moved_messages))
+
+        moved_likes = db.session.query(
+            Likes.id, Likes.user_id, Likes.message_id
+        ).filter(Likes.message_id.in_(ids))
+        db.session.execute(
+            ArchivedLike.__table__.insert().from_select(
+                ['id', 'user_id', 'message_id'], moved_likes))
+
+        Likes.query.filter(Likes.message_id.in_(ids)).delete(synchronize_session=False)
+        Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        archived += len(ids)
+
+    return archived
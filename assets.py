@@ -0,0 +1,202 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ (except generated
+directories) to static/dist/ with a content hash in its name, say
+stylesheets/style.3f2a1b9c0d12.css, plus .gz and .br copies of text
+files, and records the mapping in static/dist/manifest.json.
+
+Templates link to assets with `asset_url('stylesheets/style.css')`, which
+takes the same filename as `url_for('static', filename=...)` and returns
+the fingerprinted /assets/ URL when the manifest has one (the plain
+/static/ URL otherwise, so nothing breaks before a build).
+
+Stylesheets are built after everything else, with their `url(...)`
+references to other static files rewritten to the fingerprinted URLs, so
+their images are cached for good too.
+
+/assets/ responses never change, so they're cached for a year as
+`immutable`, and are served precompressed when the client accepts it.
+
+Brotli is optional; without it only .gz copies are written.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+from flask import Blueprint, abort, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = 'manifest.json'
+
+# generated at runtime or by the build; not fingerprinted
+SKIP_DIRS = {'dist', 'derived'}
+
+# worth compressing; images are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html', '.map'}
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# Content-Encoding -> suffix of the precompressed copy, best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+ASSETS_URL = '/assets/'
+STATIC_URL = '/static/'
+
+# url(...) in a stylesheet, quoted or not
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+assets = Blueprint('assets', __name__)
+
+_manifest = None
+
+
+##############################################################################
+# Building
+
+
+def fingerprint(path, data):
+    """`path` with a hash of `data` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def rewrite_css_urls(css, filename, manifest):
+    """`css` (from static file `filename`) linking to the built files in `manifest`.
+
+    References to files that weren't built, or to other sites, are kept.
+    """
+
+    def replace(match):
+        url = match.group(2).strip()
+        path = url.split('?')[0].split('#')[0]
+        if path.startswith(STATIC_URL):
+            target = path[len(STATIC_URL):]
+        elif path.startswith('/') or ':' in path:
+            return match.group(0)
+        else:
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(filename), path))
+
+        hashed = manifest.get(target)
+        if hashed is None:
+            return match.group(0)
+        return f'url("{ASSETS_URL}{hashed}")'
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+def _build_file(filename, data, dist_dir):
+    hashed = fingerprint(filename, data)
+    target = os.path.join(dist_dir, hashed)
+    _write(target, data)
+
+    if os.path.splitext(filename)[1].lower() in COMPRESSIBLE:
+        # mtime=0 so a rebuild writes identical bytes
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data):
+            _write(target + '.gz', compressed)
+        if brotli:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                _write(target + '.br', compressed)
+    return hashed
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    """Write fingerprinted and precompressed copies; return the manifest."""
+
+    manifest = {}
+    stylesheets = {}
+
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir:
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            filename = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            # after the files they link to have their names
+            if name.lower().endswith('.css'):
+                stylesheets[filename] = data
+                continue
+            manifest[filename] = _build_file(filename, data, dist_dir)
+
+    for filename, data in stylesheets.items():
+        css = rewrite_css_urls(data.decode(), filename, manifest)
+        manifest[filename] = _build_file(filename, css.encode(), dist_dir)
+
+    _write(os.path.join(dist_dir, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+##############################################################################
+# Linking and serving
+
+
+def load_manifest(dist_dir=DIST_DIR):
+    """(Re)read the manifest; an empty one if there hasn't been a build."""
+
+    global _manifest
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as f:
+            _manifest = json.load(f)
+    except OSError:
+        _manifest = {}
+    return _manifest
+
+
+def asset_url(filename):
+    """URL of static file `filename`, fingerprinted when it's been built."""
+
+    if _manifest is None:
+        load_manifest()
+
+    hashed = _manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('assets.asset', filename=hashed)
+
+
+@assets.route('/assets/<path:filename>')
+def asset(filename):
+    """Serve a fingerprinted file, precompressed if the client accepts it."""
+
+    if (filename.endswith(('.gz', '.br')) or filename == MANIFEST or
+            '..' in filename.split('/')):
+        abort(404)
+
+    for encoding, suffix in ENCODINGS:
+        if (encoding in request.accept_encodings and
+                os.path.isfile(os.path.join(DIST_DIR, filename + suffix))):
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            resp = send_from_directory(DIST_DIR, filename + suffix, mimetype=mimetype)
+            resp.headers['Content-Encoding'] = encoding
+            break
+    else:
+        resp = send_from_directory(DIST_DIR, filename)
+
+    resp.vary.add('Accept-Encoding')
+    resp.headers['Cache-Control'] = f"public, max-age={ONE_YEAR}, immutable"
+    return resp
@@ -0,0 +1,174 @@
+"""Fast username/email availability checks.
+
+Signing up hashes the password with bcrypt, which is slow on purpose, so
+we want to turn away taken usernames and emails *before* hashing. A
+counting Bloom filter over every existing username and email answers
+"definitely free" from memory; only a "maybe taken" answer costs an
+(indexed) database lookup.
+
+Each worker builds its own filter the first time it's needed and keeps it
+current through SQLAlchemy events on `User`. A name taken through another worker may be
+missing here; that only means we fall back to the old path (hash, then
+IntegrityError on commit), never that we turn away a free name.
+"""
+
+import hashlib
+import math
+
+from sqlalchemy import event, inspect
+
+from models import db, User
+
+
+class CountingBloomFilter:
+    """Bloom filter with small counters instead of bits, so it supports remove.
+
+    Counters saturate at 255; a saturated counter is never decremented, which
+    can only cause false positives, never false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.size = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.counters = bytearray(self.size)
+        self.count = 0
+
+    def _indexes(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for i in self._indexes(item):
+            if self.counters[i] < 255:
+                self.counters[i] += 1
+        self.count += 1
+
+    def remove(self, item):
+        if item not in self:
+            return
+        for i in self._indexes(item):
+            if 0 < self.counters[i] < 255:
+                self.counters[i] -= 1
+        self.count -= 1
+
+    def __contains__(self, item):
+        return all(self.counters[i] for i in self._indexes(item))
+
+
+def _username_key(username):
+    return f"u:{username}"
+
+
+def _email_key(email):
+    return f"e:{email}"
+
+
+# start with room to grow; the filter is rebuilt with more room once it
+# holds more items than it was sized for
+MIN_CAPACITY = 10_000
+
+_filter = None
+_needs_reload = False
+
+
+def load():
+    """(Re)build the filter from every username and email in the database."""
+
+    global _filter, _needs_reload
+
+    total = db.session.query(User.id).count()
+    new_filter = CountingBloomFilter(max(total * 4, MIN_CAPACITY))
+
+    rows = db.session.query(User.username, User.email).yield_per(5000)
+    for username, email in rows:
+        new_filter.add(_username_key(username))
+        new_filter.add(_email_key(email))
+
+    _filter = new_filter
+    _needs_reload = False
+    return _filter
+
+
+def _remember(username=None, email=None):
+    global _needs_reload
+
+    if _filter is None:
+        return
+    if username:
+        _filter.add(_username_key(username))
+    if email:
+        _filter.add(_email_key(email))
+
+    # called mid-flush, so don't query here; reload on the next check
+    if _filter.count > _filter.capacity:
+        _needs_reload = True
+
+
+def _forget(username=None, email=None):
+    if _filter is None:
+        return
+    if username:
+        _filter.remove(_username_key(username))
+    if email:
+        _filter.remove(_email_key(email))
+
+
+def might_exist(username=None, email=None):
+    """False if neither `username` nor `email` can belong to a user yet."""
+
+    if _filter is None or _needs_reload:
+        load()
+
+    return ((username is not None and _username_key(username) in _filter) or
+            (email is not None and _email_key(email) in _filter))
+
+
+def username_taken(username):
+    if not might_exist(username=username):
+        return False
+    return db.session.query(User.id).filter_by(username=username).first() is not None
+
+
+def email_taken(email):
+    if not might_exist(email=email):
+        return False
+    return db.session.query(User.id).filter_by(email=email).first() is not None
+
+
+def is_taken(username, email):
+    """Is `username` or `email` already used by someone?
+
+    Cheap enough to call before hashing a password.
+    """
+
+    return username_taken(username) or email_taken(email)
+
+
+##############################################################################
+# Keep the filter in step with the users table
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, user):
+    _remember(user.username, user.email)
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, user):
+    state = inspect(user)
+
+    for attr in ('username', 'email'):
+        history = state.attrs[attr].history
+        for old in history.deleted:
+            _forget(**{attr: old})
+        for new in history.added:
+            _remember(**{attr: new})
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    _forget(user.username, user.email)
@@ -0,0 +1,121 @@
+"""Benchmark model objects against card rows for list pages.
+
+Run from the project root:
+
+    python benchmarks/cards.py [--cards N] [--repeat R]
+
+Fills an in-memory SQLite database with N users, each with one message,
+then loads N users, and loads and renders N user cards (users/index.html)
+and N message cards (home.html), both ways: from `User`/`Message` objects, and from
+cards.py's column-selected named tuples. Reports the best time of R runs
+and the peak traced Python memory of one run.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from flask import g, render_template  # noqa: E402
+
+from app import app  # noqa: E402
+import cards  # noqa: E402
+from models import db, User, Message  # noqa: E402
+from viewer_state import IntSet, ViewerState  # noqa: E402
+
+
+def fill(count):
+    db.drop_all()
+    db.create_all()
+    db.session.bulk_insert_mappings(User, [
+        {'id': n, 'username': f"user{n}", 'email': f"user{n}@example.com",
+         'password': '$2b$12$' + 'x' * 53, 'bio': f"Bio of user {n}. " * 5,
+         'location': "Somewhere"}
+        for n in range(1, count + 1)])
+    db.session.bulk_insert_mappings(Message, [
+        {'text': f"Warble number {n}", 'user_id': n} for n in range(1, count + 1)])
+    db.session.commit()
+
+
+def load_user_models(count):
+    return User.query.order_by(User.id).limit(count).all()
+
+
+def load_user_rows(count):
+    return list(cards.user_cards(User.query.order_by(User.id).limit(count)))
+
+
+def user_models(count):
+    users = User.query.order_by(User.id).limit(count)
+    return render_template('users/index.html', users=users, suggestions=[])
+
+
+def user_rows(count):
+    users = cards.user_cards(User.query.order_by(User.id).limit(count))
+    return render_template('users/index.html', users=users, suggestions=[])
+
+
+def message_models(count):
+    messages = Message.timeline(limit=count)
+    return render_template('home.html', messages=messages, suggestions=[])
+
+
+def message_rows(count):
+    messages = cards.timeline(limit=count)
+    return render_template('home.html', messages=messages, suggestions=[])
+
+
+def run(render, count):
+    with app.test_request_context('/'):
+        g.user = User.query.get(1)
+        # home.html only shows messages from followed users
+        g.viewer = ViewerState(g.user.id, 0, IntSet(range(1, count + 1)), IntSet())
+        render(count)
+        db.session.remove()
+
+
+def measure(render, count, repeat):
+    """(best seconds, peak bytes)."""
+
+    best = min(timed(render, count) for _ in range(repeat))
+
+    tracemalloc.start()
+    run(render, count)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def timed(render, count):
+    start = time.perf_counter()
+    run(render, count)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cards', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        fill(args.cards)
+
+    print(f"{args.cards} cards, best of {args.repeat}")
+    for name, render in [('load users: User objects', load_user_models),
+                         ('load users: UserCard rows', load_user_rows),
+                         ('user cards: User objects', user_models),
+                         ('user cards: UserCard rows', user_rows),
+                         ('timeline: Message objects', message_models),
+                         ('timeline: MessageCard rows', message_rows)]:
+        best, peak = measure(render, args.cards, args.repeat)
+        print(f"{name:28} {best * 1000:8.1f}ms  peak {peak / 1024:8.0f}KiB")
+
+
+if __name__ == '__main__':
+    main()
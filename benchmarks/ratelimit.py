@@ -0,0 +1,42 @@
+"""Benchmark the cost of a rate limit check on each backend.
+
+Run from the project root:
+
+    python benchmarks/ratelimit.py [--checks N]
+
+Times `take()` over a spread of keys, as a limited route does once per
+bucket (per IP, per user) on each request.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import MemoryBackend, SQLiteBackend, parse_limit  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checks', type=int, default=100_000)
+    parser.add_argument('--keys', type=int, default=10_000)
+    args = parser.parse_args()
+
+    limit = parse_limit('60/minute')
+    keys = [f"login:ip:10.0.{n // 256}.{n % 256}" for n in range(args.keys)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, backend in [('memory', MemoryBackend()),
+                              ('sqlite', SQLiteBackend(os.path.join(tmp, 'buckets.sqlite')))]:
+            start = time.perf_counter()
+            for i in range(args.checks):
+                backend.take(keys[i % len(keys)], limit, time.time())
+            elapsed = time.perf_counter() - start
+            print(f"{name:8} {elapsed / args.checks * 1e6:7.1f}us per check")
+
+
+if __name__ == '__main__':
+    main()
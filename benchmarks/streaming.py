@@ -0,0 +1,86 @@
+"""Benchmark streamed against buffered rendering of the users page.
+
+Run from the project root (importing the app needs its database):
+
+    python benchmarks/streaming.py [--users N]
+
+Renders users/index.html for N made-up users with `render_template` and
+with `stream_template`, plain and through the gzip middleware, and
+reports time to the first chunk, total time and peak memory (traced
+Python allocations while rendering; the rows are generated on the fly, as
+a streamed query yields them).
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import g, render_template  # noqa: E402
+
+from app import app  # noqa: E402
+from compression import CompressionMiddleware  # noqa: E402
+from streaming import stream_template  # noqa: E402
+
+
+def fake_users(count):
+    for n in range(count):
+        yield SimpleNamespace(id=n, username=f"user{n}", image_url='',
+                              header_image_url='', bio=f"Bio of user {n}. " * 5)
+
+
+def buffered(count):
+    yield render_template('users/index.html', users=fake_users(count), suggestions=[])
+
+
+def streamed(count):
+    return stream_template('users/index.html', users=fake_users(count),
+                           suggestions=[]).response
+
+
+def compressed(count):
+    resp = stream_template('users/index.html', users=fake_users(count), suggestions=[])
+    environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+    return CompressionMiddleware(resp)(environ, lambda status, headers, exc_info=None: None)
+
+
+def measure(body):
+    """(seconds to first chunk, total seconds, bytes sent, peak bytes)."""
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    first = None
+    sent = 0
+    for chunk in body:
+        if first is None:
+            first = time.perf_counter() - start
+        sent += len(chunk)
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return first, total, sent, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f"users/index.html with {args.users} users")
+    for name, render in [('render_template', buffered),
+                         ('stream_template', streamed),
+                         ('stream_template + gzip', compressed)]:
+        with app.test_request_context('/users'):
+            g.user = None
+            first, total, sent, peak = measure(render(args.users))
+        print(f"{name:24} first byte {first * 1000:8.1f}ms  "
+              f"total {total * 1000:8.1f}ms  "
+              f"sent {sent / 1024:8.0f}KiB  peak {peak / 1024:8.0f}KiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""Microbenchmarks for the model and template code we tune most.
+
+Run from the project root:
+
+    python benchmarks/suite.py [-k NAME] [--samples N] [--history FILE]
+
+Each benchmark builds its own fixture in an in-memory SQLite database,
+then times one operation: a sample repeats it enough times to take at
+least MIN_SAMPLE_TIME, and the per-call times of N samples are kept.
+
+Results are appended to a JSON-lines history file (one run per line, with
+the commit it ran on). Each benchmark is compared with its samples from
+the previous run, and a slowdown is flagged when it's both significant
+(one-sided Mann-Whitney U test, p < --alpha) and big enough to matter
+(median more than --threshold slower). Any flagged slowdown makes the
+exit status 1, so this can gate a change in CI.
+
+Timings only compare between runs on the same machine, so the history
+file is not checked in.
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+from functools import partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from flask import g, render_template  # noqa: E402
+
+from app import app  # noqa: E402
+import cards  # noqa: E402
+from models import (db, User, Follows, Message, Likes, ArchivedMessage,  # noqa: E402
+                    ArchivedLike, liked_query)
+from seed import seed  # noqa: E402
+import viewer_state  # noqa: E402
+
+
+DEFAULT_HISTORY = os.path.join(ROOT, 'benchmarks', 'history.jsonl')
+
+DEFAULT_SAMPLES = 15
+
+# repeat a call until a sample takes at least this long
+MIN_SAMPLE_TIME = 0.05
+
+Benchmark = namedtuple('Benchmark', 'name setup samples')
+
+BENCHMARKS = []
+
+
+def benchmark(name, samples=DEFAULT_SAMPLES):
+    """Register `setup`, which builds a fixture and returns the call to time."""
+
+    def decorator(setup):
+        BENCHMARKS.append(Benchmark(name, setup, samples))
+        return setup
+    return decorator
+
+
+##############################################################################
+# Fixtures
+
+
+def reset_db():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def add_users(count):
+    """Users 1..`count`, with a made-up (not checkable) password hash."""
+
+    db.session.execute(User.__table__.insert(), [
+        {'id': n, 'username': f"user{n}", 'email': f"user{n}@example.com",
+         'password': '$2b$12$' + 'x' * 53, 'image_url': '/static/images/default-pic.png',
+         'bio': f"Bio of user {n}."}
+        for n in range(1, count + 1)])
+
+
+def add_follows(pairs):
+    db.session.execute(Follows.__table__.insert(), [
+        {'user_following_id': follower, 'user_being_followed_id': followed}
+        for follower, followed in pairs])
+
+
+##############################################################################
+# Benchmarks
+
+
+def follows_setup(size, method):
+    """User 1 follows, and is followed by, `size` users; check the last one."""
+
+    reset_db()
+    add_users(size + 1)
+    others = range(2, size + 2)
+    add_follows([(1, other) for other in others] + [(other, 1) for other in others])
+    db.session.commit()
+
+    user = User.query.get(1)
+    other = User.query.get(size + 1)
+    relationship = 'following' if method == 'is_following' else 'followers'
+
+    def call():
+        # each request loads its user afresh
+        db.session.expire(user, [relationship])
+        getattr(user, method)(other)
+    return call
+
+
+for size, samples in ((10, DEFAULT_SAMPLES), (1_000, DEFAULT_SAMPLES), (100_000, 5)):
+    for method in ('is_following', 'is_followed_by'):
+        benchmark(f'User.{method}[{size}]', samples)(partial(follows_setup, size, method))
+
+
+@benchmark('User.authenticate', samples=5)
+def authenticate_setup():
+    reset_db()
+    User.signup("someone", "someone@example.com", "password", None)
+    db.session.commit()
+
+    return partial(User.authenticate, "someone", "password")
+
+
+@benchmark('render home.html[100 messages]')
+def home_setup():
+    reset_db()
+    add_users(20)
+    add_follows([(1, other) for other in range(2, 21)])
+    db.session.bulk_insert_mappings(Message, [
+        {'text': f"Warble number {n}, with a few more words in it.", 'user_id': n % 20 + 1}
+        for n in range(100)])
+    db.session.commit()
+
+    g.user = User.query.get(1)
+    g.viewer = viewer_state.load(1)
+    user_ids = list(g.viewer.following) + [1]
+
+    def call():
+        messages = cards.timeline(user_ids=user_ids)
+        render_template('home.html', messages=messages, suggestions=[])
+    return call
+
+
+@benchmark('liked_warbles queries')
+def liked_warbles_setup():
+    """Build, and compile to SQL, the two queries behind liked_warbles."""
+
+    dialect = db.engine.dialect
+
+    def call():
+        for model, like_model in ((Message, Likes), (ArchivedMessage, ArchivedLike)):
+            str(liked_query(model, like_model, 1).statement.compile(dialect=dialect))
+    return call
+
+
+@benchmark('seed.py', samples=5)
+def seed_setup():
+    return partial(seed, os.path.join(ROOT, 'generator'))
+
+
+##############################################################################
+# Timing and history
+
+
+def measure(call, samples):
+    """Per-call seconds for each of `samples` samples."""
+
+    number = 1
+    while True:
+        elapsed = timed(call, number)
+        if elapsed >= MIN_SAMPLE_TIME:
+            break
+        number *= 2
+
+    return [timed(call, number) / number for _ in range(samples)]
+
+
+def timed(call, number):
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def slower_p(before, after):
+    """One-sided Mann-Whitney U p-value for `after` being slower than `before`."""
+
+    n1, n2 = len(before), len(after)
+    n = n1 + n2
+    values = sorted([(value, False) for value in before] +
+                    [(value, True) for value in after])
+
+    # ranks, ties sharing their average rank
+    after_ranks = 0.0
+    ties = 0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2 + 1
+        after_ranks += rank * sum(1 for k in range(i, j + 1) if values[k][1])
+        ties += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+
+    u = after_ranks - n2 * (n2 + 1) / 2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    # normal approximation, with continuity correction
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 1 - statistics.NormalDist().cdf(z)
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_samples(history, name):
+    for run in reversed(history):
+        if name in run['results']:
+            return run['results'][name]
+    return None
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:7.2f}{unit}"
+    return f"{seconds / 1e-9:7.2f}ns"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', dest='pattern', help="only benchmarks matching this regex")
+    parser.add_argument('--samples', type=int, help="samples per benchmark")
+    parser.add_argument('--history', default=DEFAULT_HISTORY)
+    parser.add_argument('--no-record', action='store_true',
+                        help="don't add this run to the history")
+    parser.add_argument('--alpha', type=float, default=0.01)
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help="smallest slowdown to flag, as a fraction")
+    args = parser.parse_args()
+
+    history = load_history(args.history)
+    results = {}
+    regressions = []
+
+    for bench in BENCHMARKS:
+        if args.pattern and not re.search(args.pattern, bench.name):
+            continue
+
+        with app.test_request_context('/'):
+            call = bench.setup()
+            samples = measure(call, args.samples or bench.samples)
+            db.session.remove()
+        results[bench.name] = samples
+
+        median = statistics.median(samples)
+        line = f"{bench.name:32} {format_time(median)}  ±{format_time(statistics.pstdev(samples))}"
+
+        before = previous_samples(history, bench.name)
+        if before:
+            change = median / statistics.median(before) - 1
+            p = slower_p(before, samples)
+            line += f"  {change:+7.1%}  p={p:.3f}"
+            if p < args.alpha and change > args.threshold:
+                line += "  SLOWER"
+                regressions.append(bench.name)
+        print(line, flush=True)
+
+    if not args.no_record and results:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps({
+                'when': datetime.utcnow().isoformat(timespec='seconds'),
+                'commit': commit(),
+                'python': platform.python_version(),
+                'results': results,
+            }) + '\n')
+
+    if regressions:
+        print(f"\n{len(regressions)} significantly slower: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
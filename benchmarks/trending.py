@@ -0,0 +1,47 @@
+"""Benchmark the trending aggregator's event rate.
+
+Run from the project root:
+
+    python benchmarks/trending.py [--events N]
+
+Feeds N likes with a skewed (Zipf-like) spread over message ids, as real
+likes are, then checks the top messages came out right.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trending  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=500_000)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    weights = [1 / rank for rank in range(1, args.messages + 1)]
+    message_ids = rand.choices(range(args.messages), weights=weights, k=args.events)
+
+    trending.reset()
+    now = time.time()
+
+    start = time.perf_counter()
+    for i, message_id in enumerate(message_ids):
+        trending.record_like(message_id, message_id % 1000, now=now + i / 1000)
+    elapsed = time.perf_counter() - start
+
+    top = [message_id for message_id, _ in trending.top('messages', 'day', 10, now=now)]
+    print(f"{args.events} events in {elapsed:.2f}s "
+          f"({args.events / elapsed:,.0f} events/s)")
+    print(f"top 10 messages: {top} (expected mostly 0-9)")
+
+
+if __name__ == '__main__':
+    main()
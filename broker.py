@@ -0,0 +1,179 @@
+"""Publish/subscribe for live updates (new messages, for now).
+
+`InProcessBroker` delivers events to subscribers in the same process,
+which is all a single worker needs. `PostgresBroker` sends events through
+Postgres LISTEN/NOTIFY so subscribers on every worker (and node) get
+them; each worker runs one listener thread and fans events out locally.
+
+If the listener's connection drops, it logs the error and reconnects
+(with backoff) and LISTENs again. Events published while it was away are
+lost; clients catch up with ?since= when they reconnect.
+
+Subscribers are plain queues, so an idle connection costs a queue and a
+few set entries. Serve the stream from an async (gevent) worker so idle
+connections don't tie up a thread each; see gunicorn.conf.py.
+"""
+
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+
+
+# seconds to wait before reconnecting a dropped listener, doubling on each
+# failure in a row
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+    """A subscriber's queue of (topic, payload) events."""
+
+    def __init__(self, broker, topics, maxsize=100):
+        self.broker = broker
+        self.topics = set(topics)
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def get(self, timeout=None):
+        """Next event, or None if nothing arrives within `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InProcessBroker:
+    """Deliver events to subscribers in this process."""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        sub = Subscription(self, topics)
+        with self._lock:
+            for topic in sub.topics:
+                self._subscribers[topic].add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._subscribers.get(topic)
+                if subs:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subscribers[topic]
+
+    def deliver(self, topic, payload):
+        """Hand an event to local subscribers of `topic`."""
+
+        with self._lock:
+            subs = list(self._subscribers.get(topic, ()))
+
+        for sub in subs:
+            try:
+                sub.queue.put_nowait((topic, payload))
+            except queue.Full:
+                # a subscriber that isn't reading; it can catch up with ?since=
+                pass
+
+    def publish(self, topic, payload):
+        self.deliver(topic, payload)
+
+
+class PostgresBroker(InProcessBroker):
+    """Deliver events to subscribers on every worker via LISTEN/NOTIFY."""
+
+    CHANNEL = 'warbler_events'
+
+    def __init__(self, dsn):
+        super().__init__()
+        self.dsn = dsn
+        self._listener = None
+        self._publish_conn = None
+        self._publish_lock = threading.Lock()
+
+    def subscribe(self, topics):
+        # start listening lazily, so workers that never stream don't hold
+        # an extra connection
+        if self._listener is None:
+            self._start_listener()
+        return super().subscribe(topics)
+
+    def publish(self, topic, payload):
+        message = json.dumps({'topic': topic, 'payload': payload})
+
+        with self._publish_lock:
+            if self._publish_conn is None or self._publish_conn.closed:
+                self._publish_conn = psycopg2.connect(self.dsn)
+                self._publish_conn.autocommit = True
+            with self._publish_conn.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", (self.CHANNEL, message))
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self._listen, name='broker-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        delay = RECONNECT_DELAY
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.CHANNEL}")
+                delay = RECONNECT_DELAY
+                self._receive(conn)
+            except Exception:
+                logger.exception("broker listener failed; reconnecting in %ss", delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _receive(self, conn):
+        while True:
+            if select.select([conn], [], [], 60) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                event = json.loads(notify.payload)
+                self.deliver(event['topic'], event['payload'])
+
+
+def create_broker(url):
+    """Build a broker from a BROKER_URL like 'memory://' or 'postgresql://...'."""
+
+    if not url or url.startswith('memory:'):
+        return InProcessBroker()
+    if url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBroker(url)
+    raise ValueError(f"Unsupported BROKER_URL: {url}")
+
+
+def user_topic(user_id):
+    return f"user:{user_id}"
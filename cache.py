@@ -0,0 +1,594 @@
+"""In-process caches, and a two-tier cache shared between workers.
+
+`TTLCache` is a per-process LRU. `TieredCache` puts one in front of a
+store every worker on the host can read (`SQLiteStore`, a SQLite file;
+keep it on a RAM disk like /dev/shm), so a record one worker loaded is a
+hit for the others:
+
+    records.get_or_load('user:42', load_user, tags=['user:42'])
+    records.invalidate('user:42')   # after a profile edit
+
+An entry is tagged with its own key and any `tags` given, and
+`invalidate(tag)` drops every entry with that tag from the shared store
+and this worker's LRU. Other workers' LRUs catch up within
+SYNC_INTERVAL seconds, when they next read the store's log of
+invalidations.
+
+Hits (per tier), misses, evictions and invalidations are counted per
+namespace, the part of the key before the first ':', in /metrics.
+"""
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after `ttl` seconds.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # called with the key of each entry dropped to make room
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._loads = SingleFlight()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                if self.on_evict is not None:
+                    self.on_evict(evicted)
+
+    def get_or_load(self, key, load, ttl=None):
+        """The cached value for `key`, or else `load()`'s, cached.
+
+        Callers that miss on the same key at once share a single `load()`.
+        """
+
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        def load_once():
+            # a load that just finished may have filled it
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                value = load()
+                self.set(key, value, ttl)
+            return value
+
+        return self._loads.do(key, load_once)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Call:
+    def __init__(self):
+        # looked up now, not at import: gevent may have patched it since
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers that arrive while
+    it's running wait and get its result (or its exception) instead of
+    running it again. Works with threads and, monkey-patched, greenlets.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+    def do_many(self, keys, fn):
+        """Like do(), for a batch: `fn(keys)` returns {key: value}.
+
+        `fn` is called once, with just the keys no other caller is already
+        running; the rest are waited for. Keys missing from `fn`'s result
+        are missing from the one returned.
+        """
+
+        waiting = {}
+        leading = {}
+        with self._lock:
+            for key in keys:
+                call = self._calls.get(key)
+                if call is None:
+                    leading[key] = self._calls[key] = _Call()
+                else:
+                    waiting[key] = call
+
+        found = {}
+        if leading:
+            try:
+                found = fn(list(leading))
+            except BaseException as e:
+                for call in leading.values():
+                    call.error = e
+                raise
+            finally:
+                with self._lock:
+                    for key, call in leading.items():
+                        del self._calls[key]
+                        call.value = found.get(key, _MISSING)
+                        call.done.set()
+
+        for key, call in waiting.items():
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if call.value is not _MISSING:
+                found[key] = call.value
+        return found
+
+
+##############################################################################
+# Two tiers
+
+
+# the shared store sweeps out expired entries every this many writes
+SWEEP_EVERY = 10_000
+
+# invalidations older than this are dropped from the store's log; a worker
+# that hasn't read the log for longer clears its whole LRU
+INVALIDATION_LOG_SECONDS = 60 * 60
+
+# how often each worker reads the invalidation log
+SYNC_INTERVAL = 1.0
+
+SQLITE_TIMEOUT = 1.0
+
+logger = logging.getLogger(__name__)
+
+hits = metrics.counter('warbler_cache_hits_total',
+                       "Cache lookups answered, by the tier that had them.",
+                       labels=('cache', 'namespace', 'tier'))
+misses = metrics.counter('warbler_cache_misses_total',
+                         "Cache lookups that missed every tier.",
+                         labels=('cache', 'namespace'))
+evictions = metrics.counter('warbler_cache_evictions_total',
+                            "Entries dropped from a worker's LRU to make room.",
+                            labels=('cache', 'namespace'))
+invalidations = metrics.counter('warbler_cache_invalidations_total',
+                                "Tags invalidated.",
+                                labels=('cache', 'namespace'))
+
+
+def namespace(key):
+    return key.split(':', 1)[0]
+
+
+class SQLiteStore:
+    """Entries in a SQLite file, shared by every process that opens it.
+
+    Values are pickled. Like the rate limiter's buckets, the file is only
+    a cache, so it skips fsync.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "key TEXT PRIMARY KEY, "
+                         "value BLOB NOT NULL, "
+                         "expires REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS tags ("
+                         "tag TEXT NOT NULL, "
+                         "key TEXT NOT NULL, "
+                         "PRIMARY KEY (tag, key)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_tags_key ON tags (key)")
+            conn.execute("CREATE TABLE IF NOT EXISTS invalidations ("
+                         "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "tag TEXT NOT NULL, "
+                         "at REAL NOT NULL)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _write(self, statements):
+        """Run `statements(conn)` in one write transaction."""
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(conn)
+
+                self._writes += 1
+                if self._writes % SWEEP_EVERY == 0:
+                    now = time.time()
+                    conn.execute("DELETE FROM entries WHERE expires < ?", (now,))
+                    conn.execute("DELETE FROM tags WHERE key NOT IN (SELECT key FROM entries)")
+                    conn.execute("DELETE FROM invalidations WHERE at < ?",
+                                 (now - INVALIDATION_LOG_SECONDS,))
+
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def get(self, key, now):
+        """(value, expires, tags) for `key`, or None."""
+
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, expires FROM entries WHERE key = ?",
+                               (key,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            tags = tuple(tag for tag, in conn.execute(
+                "SELECT tag FROM tags WHERE key = ?", (key,)))
+        return pickle.loads(row[0]), row[1], tags
+
+    def set(self, key, value, expires, tags):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        def statements(conn):
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                         (key, data, expires))
+            conn.execute("DELETE FROM tags WHERE key = ?", (key,))
+            conn.executemany("INSERT INTO tags VALUES (?, ?)",
+                             [(tag, key) for tag in tags])
+
+        self._write(statements)
+
+    def delete(self, key):
+        def statements(conn):
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            conn.execute("DELETE FROM tags WHERE key = ?", (key,))
+
+        self._write(statements)
+
+    def invalidate(self, tags):
+        """Drop every entry with any of `tags`, and log the invalidation."""
+
+        def statements(conn):
+            marks = ','.join('?' * len(tags))
+            keys = [(key,) for key, in conn.execute(
+                f"SELECT DISTINCT key FROM tags WHERE tag IN ({marks})", tags)]
+            conn.executemany("DELETE FROM entries WHERE key = ?", keys)
+            conn.executemany("DELETE FROM tags WHERE key = ?", keys)
+            now = time.time()
+            conn.executemany("INSERT INTO invalidations (tag, at) VALUES (?, ?)",
+                             [(tag, now) for tag in tags])
+
+        self._write(statements)
+
+    def invalidations_since(self, seq):
+        """[(seq, tag)] logged after `seq`, and the oldest seq still logged."""
+
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute("SELECT seq, tag FROM invalidations WHERE seq > ? "
+                                "ORDER BY seq", (seq,)).fetchall()
+            oldest = conn.execute("SELECT MIN(seq) FROM invalidations").fetchone()[0]
+        return rows, oldest
+
+    def last_invalidation(self):
+        with self._lock:
+            seq = self._connect().execute(
+                "SELECT MAX(seq) FROM invalidations").fetchone()[0]
+        return seq or 0
+
+    def clear(self):
+        def statements(conn):
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM tags")
+
+        self._write(statements)
+
+
+def create_store(url):
+    """A shared store from a CACHE_URL like 'sqlite:///path', or None for 'memory://'."""
+
+    if not url or url.startswith('memory:'):
+        return None
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported CACHE_URL: {url}")
+
+
+class TieredCache:
+    """A TTLCache in front of an optional shared store, with tags (see module docs).
+
+    If the store fails, it's skipped: lookups miss and writes only reach
+    this worker's LRU.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=300, store=None):
+        self.name = name
+        self.ttl = ttl
+        self.store = store
+        self.local = TTLCache(maxsize, ttl, on_evict=self._evicted)
+        # this worker's tag -> keys and key -> tags, for the local tier
+        self._keys = {}
+        self._tags = {}
+        self._lock = threading.Lock()
+        self._loads = SingleFlight()
+        self._seen = None
+        self._synced_at = 0.0
+
+    def _evicted(self, key):
+        evictions.inc(self.name, namespace(key))
+        self._untag(key)
+
+    def _untag(self, key):
+        with self._lock:
+            for tag in self._tags.pop(key, ()):
+                keys = self._keys.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._keys[tag]
+
+    def _tag(self, key, tags):
+        with self._lock:
+            self._tags[key] = tags
+            for tag in tags:
+                self._keys.setdefault(tag, set()).add(key)
+
+    def _drop_local(self, tags):
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._keys.get(tag, ()))
+        for key in keys:
+            self.local.delete(key)
+            self._untag(key)
+
+    def _clear_local(self):
+        self.local.clear()
+        with self._lock:
+            self._keys.clear()
+            self._tags.clear()
+
+    def _sync(self):
+        """Apply other workers' invalidations to the local tier."""
+
+        now = time.monotonic()
+        if self.store is None or now < self._synced_at + SYNC_INTERVAL:
+            return
+        self._synced_at = now
+
+        try:
+            if self._seen is None:
+                self._seen = self.store.last_invalidation()
+                return
+            rows, oldest = self.store.invalidations_since(self._seen)
+        except sqlite3.Error as e:
+            logger.warning("cache store failed: %s", e)
+            return
+
+        if oldest is not None and oldest > self._seen + 1:
+            # missed some that were already dropped from the log
+            self._clear_local()
+        elif rows:
+            self._drop_local([tag for _, tag in rows])
+        if rows:
+            self._seen = rows[-1][0]
+
+    def get(self, key, default=None):
+        self._sync()
+
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            hits.inc(self.name, namespace(key), 'local')
+            return value
+        self._untag(key)
+
+        if self.store is not None:
+            try:
+                found = self.store.get(key, time.time())
+            except sqlite3.Error as e:
+                logger.warning("cache store failed: %s", e)
+                found = None
+            if found is not None:
+                value, expires, tags = found
+                hits.inc(self.name, namespace(key), 'shared')
+                self._set_local(key, value, expires - time.time(), tags)
+                return value
+
+        misses.inc(self.name, namespace(key))
+        return default
+
+    def _set_local(self, key, value, ttl, tags):
+        self.local.set(key, value, ttl)
+        self._untag(key)
+        self._tag(key, tags)
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = self.ttl if ttl is None else ttl
+        tags = (key,) + tuple(tag for tag in tags if tag != key)
+
+        self._set_local(key, value, ttl, tags)
+        if self.store is not None:
+            try:
+                self.store.set(key, value, time.time() + ttl, tags)
+            except sqlite3.Error as e:
+                logger.warning("cache store failed: %s", e)
+
+    def get_or_load(self, key, load, ttl=None, tags=()):
+        """The cached value for `key`, or else `load()`'s, cached with `tags`.
+
+        Callers in this worker that miss on the same key at once share a
+        single `load()`.
+        """
+
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        def load_once():
+            value = self.local.get(key, _MISSING)
+            if value is _MISSING:
+                value = load()
+                self.set(key, value, ttl, tags)
+            return value
+
+        return self._loads.do(key, load_once)
+
+    def get_many_or_load(self, keys, load, ttl=None, tags=None):
+        """{key: value} for `keys`, loading the misses with one `load(misses)`.
+
+        `load` returns {key: value} for the keys it found; `tags(key,
+        value)`, if given, tags each loaded entry. As with get_or_load,
+        callers in this worker missing on the same keys at once share the
+        loads.
+        """
+
+        found = {}
+        misses = []
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                misses.append(key)
+            else:
+                found[key] = value
+        if not misses:
+            return found
+
+        def load_once(keys):
+            # a load that just finished may have filled some
+            values = {}
+            for key in keys:
+                value = self.local.get(key, _MISSING)
+                if value is not _MISSING:
+                    values[key] = value
+            rest = [key for key in keys if key not in values]
+            loaded = load(rest) if rest else {}
+            for key, value in loaded.items():
+                self.set(key, value, ttl, tags(key, value) if tags else ())
+            values.update(loaded)
+            return values
+
+        found.update(self._loads.do_many(misses, load_once))
+        return found
+
+    def delete(self, key):
+        self.invalidate(key)
+
+    def invalidate(self, *tags):
+        """Drop every entry tagged with any of `tags`, in both tiers."""
+
+        for tag in tags:
+            invalidations.inc(self.name, namespace(tag))
+        self._drop_local(tags)
+        if self.store is not None:
+            try:
+                self.store.invalidate(list(tags))
+            except sqlite3.Error as e:
+                logger.warning("cache store failed: %s", e)
+
+    def clear(self):
+        self._clear_local()
+        if self.store is not None:
+            try:
+                self.store.clear()
+            except sqlite3.Error as e:
+                logger.warning("cache store failed: %s", e)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self.local)
+
+
+# Serialized users and messages by "<kind>:<id>", shared by the API's
+# lookups and invalidated by the routes that change those rows. Message
+# records are also tagged with their author's key.
+RECORD_TTL = 60
+
+records = TieredCache('records', maxsize=100_000, ttl=RECORD_TTL)
+
+
+def record_key(kind, record_id):
+    return f"{kind}:{record_id}"
+
+
+def configure(url):
+    """Back `records` with the shared store at CACHE_URL `url`."""
+
+    records.store = create_store(url)
+    records._seen = None
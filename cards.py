@@ -0,0 +1,72 @@
+"""Read-only rows for the user and message cards on list pages.
+
+A card shows a handful of columns: a username, two images and a bio, or
+a message's text and its author's name and picture. Loading whole `User`
+and `Message` objects for that drags in password hashes, emails and the
+rest, and each object is tracked by the session (identity map, change
+history) until the request ends.
+
+These load just the card's columns and return named tuples, which the
+templates use the same way (`user.username`, `msg.user.image_url`).
+They're detached from the session, so they're read-only: views that
+change a user or message still load the model.
+"""
+
+from collections import namedtuple
+
+from models import db, User, Message
+from streaming import STREAM_BATCH_SIZE, stream_query
+
+
+UserCard = namedtuple('UserCard', 'id username image_url header_image_url bio')
+
+# the author shown next to a message
+Author = namedtuple('Author', 'id username image_url')
+
+MessageCard = namedtuple('MessageCard', 'id text timestamp user_id user')
+
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+AUTHOR_COLUMNS = (User.id, User.username, User.image_url)
+
+MESSAGE_CARD_COLUMNS = ('id', 'text', 'timestamp', 'user_id')
+
+
+def user_cards(query, batch_size=STREAM_BATCH_SIZE):
+    """UserCards for the users `query` selects, streamed `batch_size` at a time."""
+
+    rows = stream_query(query.with_entities(*USER_CARD_COLUMNS), batch_size)
+    return map(UserCard._make, rows)
+
+
+def authors(user_ids):
+    """{id: Author} for `user_ids`."""
+
+    if not user_ids:
+        return {}
+    rows = db.session.query(*AUTHOR_COLUMNS).filter(User.id.in_(user_ids))
+    return {row.id: Author._make(row) for row in rows}
+
+
+def with_authors(rows):
+    """MessageCards for message `rows`, with their authors loaded."""
+
+    users = authors({row.user_id for row in rows})
+    return [MessageCard(row.id, row.text, row.timestamp, row.user_id,
+                        users.get(row.user_id))
+            for row in rows]
+
+
+def timeline(user_ids=None, before=None, since=None, limit=100):
+    """Message.timeline, as MessageCards."""
+
+    return with_authors(Message.timeline(user_ids, before, since, limit,
+                                         columns=MESSAGE_CARD_COLUMNS))
+
+
+def liked(user_id, before=None, limit=100):
+    """Message.liked_by, as MessageCards."""
+
+    return with_authors(Message.liked_by(user_id, before, limit,
+                                         columns=MESSAGE_CARD_COLUMNS))
@@ -0,0 +1,182 @@
+"""WSGI middleware that gzip- or brotli-compresses responses on the fly.
+
+Works chunk by chunk, so streamed pages (see streaming.py) stay streamed:
+each chunk is compressed and flushed as it comes out of the app, rather
+than the whole body being collected first.
+
+The encoding is negotiated from Accept-Encoding, preferring brotli. Left
+alone are responses that:
+
+- are already encoded (fingerprinted assets are served precompressed),
+- aren't text-like (images, gzip exports), or are server-sent events,
+- have a Content-Length below MIN_SIZE, or no body at all.
+
+Brotli is optional; without it only gzip is offered.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+MIN_SIZE = 500
+
+GZIP_LEVEL = 6
+# a low quality keeps brotli about as cheap as gzip at level 6, and still smaller
+BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'image/svg+xml',
+}
+
+NEVER_COMPRESS_TYPES = {'text/event-stream'}
+
+
+def parse_accept_encoding(header):
+    """{coding: q} from an Accept-Encoding header."""
+
+    codings = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def negotiate(header):
+    """'br', 'gzip' or None, for a request's Accept-Encoding header."""
+
+    codings = parse_accept_encoding(header or '')
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+
+    best = None
+    best_q = 0.0
+    for coding in offered:
+        q = codings.get(coding, codings.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compressible(headers):
+    """Is a response with these (lowercased name -> value) headers worth compressing?"""
+
+    if 'content-encoding' in headers:
+        return False
+
+    mimetype = headers.get('content-type', '').split(';')[0].strip().lower()
+    if mimetype in NEVER_COMPRESS_TYPES:
+        return False
+    if not (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES):
+        return False
+
+    length = headers.get('content-length')
+    return length is None or not length.isdigit() or int(length) >= MIN_SIZE
+
+
+class _GzipEncoder:
+    def __init__(self):
+        # wbits 31: gzip header and trailer
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliEncoder:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def chunk(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+ENCODERS = {'gzip': _GzipEncoder, 'br': _BrotliEncoder}
+
+
+class CompressionMiddleware:
+    """Compress `app`'s responses for clients that accept it."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        coding = None
+        if environ.get('REQUEST_METHOD') != 'HEAD':
+            coding = negotiate(environ.get('HTTP_ACCEPT_ENCODING'))
+        if coding is None:
+            return self.app(environ, start_response)
+
+        encoder = []
+
+        def _start_response(status, headers, exc_info=None):
+            names = {name.lower(): value for name, value in headers}
+            code = status.split(' ', 1)[0]
+            if code not in ('204', '304') and compressible(names):
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'content-length']
+                headers.append(('Content-Encoding', coding))
+                vary = names.get('vary')
+                if not vary:
+                    headers.append(('Vary', 'Accept-Encoding'))
+                elif 'accept-encoding' not in vary.lower():
+                    headers = [(name, f"{value}, Accept-Encoding"
+                                if name.lower() == 'vary' else value)
+                               for name, value in headers]
+                encoder[:] = [ENCODERS[coding]()]
+            else:
+                encoder[:] = []
+            return start_response(status, headers, exc_info)
+
+        return _CompressedBody(self.app(environ, _start_response), encoder)
+
+
+class _CompressedBody:
+    """A response body, compressed as it's iterated if `encoder` is set.
+
+    start_response may be called lazily, on the first iteration, so the
+    encoder is looked up as chunks come out rather than up front.
+    """
+
+    def __init__(self, body, encoder):
+        self.body = body
+        self.encoder = encoder
+
+    def __iter__(self):
+        for data in self.body:
+            if not self.encoder:
+                yield data
+            elif data:
+                compressed = self.encoder[0].chunk(data)
+                if compressed:
+                    yield compressed
+
+        if self.encoder:
+            yield self.encoder[0].finish()
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
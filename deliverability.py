@@ -0,0 +1,77 @@
+"""Email domain deliverability checks, off the request path.
+
+Forms only check email syntax inline. Whether the domain can actually
+receive mail (a DNS lookup that can be slow or hang) is checked in a
+background thread, and the answer is cached per domain for a while.
+
+What happens when a domain turns out to be undeliverable is decided by
+the EMAIL_DELIVERABILITY_POLICY config value:
+
+- 'ignore': don't look domains up at all
+- 'warn': look them up and log undeliverable ones (the default)
+- 'reject': like 'warn', and once a domain is known to be undeliverable,
+  forms reject addresses on it inline
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from email_validator import validate_email, EmailNotValidError, EmailUndeliverableError
+
+from cache import TTLCache
+
+
+POLICIES = ('ignore', 'warn', 'reject')
+
+DEFAULT_POLICY = 'warn'
+
+# how long to trust a lookup, in seconds
+DELIVERABILITY_TTL = 6 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+_results = TTLCache(maxsize=10_000, ttl=DELIVERABILITY_TTL)
+_pending = set()
+_pending_lock = Lock()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='email-deliverability')
+
+
+def is_undeliverable(domain):
+    """True only if a recent lookup found `domain` can't receive mail."""
+
+    return _results.get(domain.lower()) is False
+
+
+def _check(email, domain):
+    try:
+        validate_email(email, check_deliverability=True)
+        _results.set(domain, True)
+
+    except EmailUndeliverableError:
+        _results.set(domain, False)
+        logger.warning("email domain %s is not deliverable (%s)", domain, email)
+
+    except EmailNotValidError:
+        # lookup failed for some other reason (timeout, no resolver);
+        # don't cache that, we'll try again next time
+        pass
+
+    finally:
+        with _pending_lock:
+            _pending.discard(domain)
+
+
+def check_later(email, domain):
+    """Look up `domain` in the background unless we already know about it."""
+
+    domain = domain.lower()
+    if domain in _results:
+        return
+
+    with _pending_lock:
+        if domain in _pending:
+            return
+        _pending.add(domain)
+
+    _executor.submit(_check, email, domain)
@@ -0,0 +1,171 @@
+"""Hashtags and @mentions, indexed when a message is written.
+
+`index_message()` parses a message's text into `message_tags` and
+`mentions` rows, which are saved in the same transaction as the message.
+Tag pages and the mentions feed then page through those tables by
+message id, newest first, without ever scanning message text.
+
+Index rows have no foreign key to `messages`, so archived messages stay
+in the feeds; ids are resolved against the hot table, then the archive.
+With sharding on (sharding.py) the index rows still live in the main
+database, and ids are resolved against the shards instead.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+from models import db, User, Message, ArchivedMessage, MessageTag, Mention
+import sharding
+
+
+# '&' keeps '&#39;' and friends in escaped text from looking like tags
+TAG_RE = re.compile(r'(?<![\w#&])#(\w{1,50})')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w{1,50})')
+
+FEED_PAGE_SIZE = 100
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def parse_tags(text):
+    """Hashtags in `text`, lowercased, in order of first use."""
+
+    return list(dict.fromkeys(tag.lower() for tag in TAG_RE.findall(text)))
+
+
+def parse_mentions(text):
+    """Usernames @mentioned in `text`, in order of first use."""
+
+    return list(dict.fromkeys(MENTION_RE.findall(text)))
+
+
+def _user_ids(usernames):
+    """Map the usernames that exist to their user ids."""
+
+    if not usernames:
+        return {}
+    return dict(db.session
+                  .query(User.username, User.id)
+                  .filter(User.username.in_(usernames)))
+
+
+def index_message(msg):
+    """Fill in `msg`'s tags and mentions from its text.
+
+    The rows are saved when the message is, in the same transaction.
+    """
+
+    user_ids = _user_ids(parse_mentions(msg.text))
+
+    msg.tags = [MessageTag(tag=tag) for tag in parse_tags(msg.text)]
+    msg.mentions = [Mention(user_id=user_id)
+                    for user_id in dict.fromkeys(user_ids.values())]
+
+
+def index_sharded(message_id, text):
+    """index_message, for a message kept on a shard (see sharding.py).
+
+    Adds the rows to the session; returns them, tags then mentions.
+    """
+
+    user_ids = _user_ids(parse_mentions(text))
+
+    tags = [MessageTag(message_id=message_id, tag=tag) for tag in parse_tags(text)]
+    mentions = [Mention(message_id=message_id, user_id=user_id)
+                for user_id in dict.fromkeys(user_ids.values())]
+    db.session.add_all(tags + mentions)
+    return tags, mentions
+
+
+def linkify(text):
+    """Escape `text` for HTML, linking its hashtags and mentions."""
+
+    html = str(escape(text))
+    html = TAG_RE.sub(lambda m: f'<a href="/tags/{m[1].lower()}">#{m[1]}</a>', html)
+    html = MENTION_RE.sub(lambda m: f'<a href="/users?q={m[1]}">@{m[1]}</a>', html)
+    return Markup(html)
+
+
+##############################################################################
+# Feeds
+
+
+def _page(model, criterion, before, limit):
+    query = db.session.query(model.message_id).filter(criterion)
+    if before is not None:
+        query = query.filter(model.message_id < before)
+
+    ids = [msg_id for (msg_id,) in
+           query.order_by(model.message_id.desc()).limit(limit)]
+
+    shards = sharding.current()
+    if shards:
+        return shards.find_many(ids)
+    return Message.find_many(ids)
+
+
+def tagged(tag, before=None, limit=FEED_PAGE_SIZE):
+    """Newest messages tagged `tag`; `before` is the last id already shown."""
+
+    return _page(MessageTag, MessageTag.tag == tag.lower(), before, limit)
+
+
+def mentioning(user_id, before=None, limit=FEED_PAGE_SIZE):
+    """Newest messages mentioning `user_id`; `before` as for tagged()."""
+
+    return _page(Mention, Mention.user_id == user_id, before, limit)
+
+
+##############################################################################
+# Backfill
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Index every existing message, hot and archived.
+
+    Messages are read in id order, `batch_size` at a time, and each batch
+    is indexed in its own transaction, so memory stays flat and the job
+    can be stopped and rerun safely. Returns the number of messages read.
+    """
+
+    indexed = 0
+
+    for model in (Message, ArchivedMessage):
+        last_id = 0
+        while True:
+            batch = (db.session
+                     .query(model.id, model.text)
+                     .filter(model.id > last_id)
+                     .order_by(model.id)
+                     .limit(batch_size)
+                     .all())
+            if not batch:
+                break
+
+            ids = [msg_id for msg_id, _ in batch]
+            parsed = [(msg_id, parse_tags(text), parse_mentions(text))
+                      for msg_id, text in batch]
+            user_ids = _user_ids({name for _, _, names in parsed for name in names})
+
+            tag_rows = [{'tag': tag, 'message_id': msg_id}
+                        for msg_id, tags, _ in parsed for tag in tags]
+            mention_rows = [{'user_id': user_id, 'message_id': msg_id}
+                            for msg_id, _, names in parsed
+                            for user_id in dict.fromkeys(user_ids[name] for name in names
+                                                         if name in user_ids)]
+
+            MessageTag.query.filter(MessageTag.message_id.in_(ids)).delete(
+                synchronize_session=False)
+            Mention.query.filter(Mention.message_id.in_(ids)).delete(
+                synchronize_session=False)
+            if tag_rows:
+                db.session.execute(MessageTag.__table__.insert(), tag_rows)
+            if mention_rows:
+                db.session.execute(Mention.__table__.insert(), mention_rows)
+            db.session.commit()
+
+            indexed += len(batch)
+            last_id = ids[-1]
+
+    return indexed
@@ -0,0 +1,145 @@
+"""Streaming export of everything a user has in Warbler.
+
+Rows are read with server-side cursors (`yield_per` + `stream_results`),
+so memory use depends on the batch size, not on how many messages, likes
+or follows the account has.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from models import db, Follows, Message, Likes, ArchivedMessage, ArchivedLike
+import sharding
+
+
+EXPORT_BATCH_SIZE = 1000
+
+# flush encoded output in chunks of roughly this many bytes
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CSV_FIELDS = ['type', 'id', 'text', 'timestamp', 'user_id']
+
+
+def _stream(query):
+    return query.execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_records(user_id, shards=None):
+    """Yield one dict per exported row for user `user_id`.
+
+    Each record has a `type`: message, like, following or follower.
+    Archived messages and likes (see archive.py) come before the hot ones,
+    which are read from `shards` if sharding is on (see sharding.py).
+    """
+
+    for model in (ArchivedMessage,) if shards else (ArchivedMessage, Message):
+        messages = (db.session
+                    .query(model.id, model.text, model.timestamp)
+                    .filter(model.user_id == user_id)
+                    .order_by(model.id))
+        for msg_id, text, timestamp in _stream(messages):
+            yield {'type': 'message', 'id': msg_id, 'text': text,
+                   'timestamp': timestamp.isoformat()}
+    if shards:
+        for row in shards.user_rows(sharding.messages, user_id):
+            yield {'type': 'message', 'id': row.id, 'text': row.text,
+                   'timestamp': row.timestamp.isoformat()}
+
+    for model in (ArchivedLike,) if shards else (ArchivedLike, Likes):
+        likes = (db.session
+                 .query(model.message_id)
+                 .filter(model.user_id == user_id)
+                 .order_by(model.id))
+        for (message_id,) in _stream(likes):
+            yield {'type': 'like', 'id': message_id}
+    if shards:
+        for row in shards.user_rows(sharding.likes, user_id):
+            yield {'type': 'like', 'id': row.message_id}
+
+    following = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user_id)
+                 .order_by(Follows.user_being_followed_id))
+    for (other_id,) in _stream(following):
+        yield {'type': 'following', 'user_id': other_id}
+
+    followers = (db.session
+                 .query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .order_by(Follows.user_following_id))
+    for (other_id,) in _stream(followers):
+        yield {'type': 'follower', 'user_id': other_id}
+
+
+def _ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def _csv_lines(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # the header is flushed along with the first row; flush it here too
+    # in case there were no rows at all
+    yield buffer.getvalue()
+
+
+def _chunked(lines, size=EXPORT_CHUNK_SIZE):
+    """Join small strings into encoded chunks of about `size` bytes."""
+
+    parts = []
+    length = 0
+    for line in lines:
+        parts.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            length = 0
+
+    if parts:
+        yield ''.join(parts).encode('utf-8')
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip header and trailer
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def export_stream(user_id, fmt='ndjson', gzip=False):
+    """Return a generator of bytes holding the export for `user_id`."""
+
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    records = export_records(user_id, sharding.current())
+    lines = _ndjson_lines(records) if fmt == 'ndjson' else _csv_lines(records)
+    chunks = _chunked(lines)
+
+    return _gzipped(chunks) if gzip else chunks
+
+
+def export_filename(user, fmt, gzip=False):
+    name = f"warbler-{user.username}.{fmt}"
+    return name + '.gz' if gzip else name
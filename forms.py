@@ -1,11 +1,20 @@
+from flask import current_app
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import DataRequired, Length
+from wtforms.validators import DataRequired, Length, ValidationError
 from email_validator import validate_email, EmailNotValidError
 
+import deliverability
 
 
 class EmailValidator:
+    """Check an email address without waiting on DNS.
+
+    Only the syntax is checked inline; the domain's deliverability is looked
+    up in the background (see deliverability.py), as configured by the
+    EMAIL_DELIVERABILITY_POLICY setting.
+    """
+
     def __init__(self, message=None):
         if not message:
             message = "Invalid email address."
@@ -13,11 +22,23 @@ class EmailValidator:
 
     def __call__(self, form, field):
         try:
-            # Validate the email
-            validate_email(field.data)
+            # Validate the email's syntax only
+            valid = validate_email(field.data, check_deliverability=False)
         except EmailNotValidError as e:
             # Raise a validation error with the original error message
-            raise ValueError(f"{self.message}: {str(e)}") from e
+            raise ValidationError(f"{self.message}: {str(e)}") from e
+
+        policy = current_app.config.get('EMAIL_DELIVERABILITY_POLICY',
+                                        deliverability.DEFAULT_POLICY)
+        if policy == 'ignore':
+            return
+
+        if policy == 'reject' and deliverability.is_undeliverable(valid.domain):
+            raise ValidationError(
+                f"{self.message}: The domain {valid.domain} does not accept email.")
+
+        deliverability.check_later(field.data, valid.domain)
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
@@ -0,0 +1,70 @@
+"""Gunicorn settings for Warbler.
+
+Run with:
+
+    gunicorn app:app
+
+Workers are gevent-based, so long-lived connections (the /messages/stream
+server-sent events) are cheap greenlets rather than one thread each.
+"""
+
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+worker_class = 'gevent'
+
+# open connections per worker, idle event streams included
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 2000))
+
+# event streams send a keepalive every 15s; don't cut them off
+timeout = 60
+keepalive = 75
+
+# cache warm-up (see warmup.py): 'worker' warms each worker as it boots;
+# 'master' warms once before forking, and the workers start with a copy;
+# 'off' skips it
+WARMUP = os.environ.get('WARMUP', 'worker')
+
+# warming in the master needs the app loaded there
+preload_app = WARMUP == 'master'
+
+if preload_app:
+    # the workers patch themselves once forked, which is too late for
+    # whatever the app made while loading in the master: patch first
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def post_fork(server, worker):
+    # make psycopg2 yield to other greenlets while it waits on Postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def when_ready(server):
+    if WARMUP == 'master':
+        _warm(server.log, forking=True)
+
+
+def post_worker_init(worker):
+    # lease the worker's message id worker before it serves anything
+    import snowflake
+    snowflake.start()
+
+    if WARMUP == 'worker':
+        _warm(worker.log)
+
+
+def _warm(log, forking=False):
+    from app import app, db
+    import warmup
+
+    with app.app_context():
+        stats = warmup.warm_from_config(app.config)
+        if forking:
+            # the workers mustn't share the master's connections
+            db.engine.dispose()
+
+    log.info("warmed %d users (%d KiB) in %.1fs%s", stats.users, stats.bytes // 1024,
+             stats.seconds, f", stopped by {stats.stopped} budget" if stats.stopped else "")
@@ -0,0 +1,346 @@
+"""Resized, recompressed copies of avatars and header images.
+
+Pages used to embed `image_url` / `header_image_url` at full size. Now
+each source image is fetched once, in a background thread, and saved
+under static/derived/ as a small set of variants (see VARIANTS) at 1x and
+2x, in WebP and JPEG. Files are named after a hash of the source image's
+bytes, so the same picture pasted under different URLs is stored once,
+and a name never changes meaning (safe to cache forever).
+
+Templates use the `image_attrs` filter:
+
+    <img {{ user.image_url | image_attrs('thumb') }} class="timeline-image">
+
+which emits `src` and `srcset` for the derived files (WebP when the
+browser accepts it, so such pages are sent with `Vary: Accept`). Until
+they exist it emits the original URL and queues the image for processing.
+
+Pillow is optional; without it every image is served as-is.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import socket
+import ssl
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urljoin, urlparse
+
+from flask import g, request
+from markupsafe import Markup, escape
+
+from cache import TTLCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+
+
+Variant = namedtuple('Variant', 'width height')
+
+# sizes at 1x, in CSS pixels; images are cropped to fill them
+VARIANTS = {
+    'thumb': Variant(72, 72),       # .timeline-image, .card-image
+    'avatar': Variant(200, 200),    # #profile-avatar
+    'card': Variant(400, 200),      # .card-hero
+    'header': Variant(1200, 400),   # the profile banner
+}
+
+SCALES = (1, 2)
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# don't fetch or decode anything bigger than this
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_SOURCE_PIXELS = 40_000_000
+FETCH_TIMEOUT = 10
+MAX_REDIRECTS = 3
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# how long to wait before retrying an image that couldn't be derived
+RETRY_AFTER = 60 * 60
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DERIVED_DIR = os.path.join(STATIC_DIR, 'derived')
+DERIVED_URL = '/static/derived'
+
+logger = logging.getLogger(__name__)
+
+# source URL -> content hash of its image, once derived
+_digests = {}
+_failed = TTLCache(maxsize=10_000, ttl=RETRY_AFTER)
+_pending = set()
+_pending_lock = Lock()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-derivatives')
+
+if Image:
+    Image.MAX_IMAGE_PIXELS = MAX_SOURCE_PIXELS
+
+
+def _pointer_path(url):
+    # where a source URL's content hash is recorded, so every worker (and
+    # the next restart) can find the derived files
+    return os.path.join(DERIVED_DIR, hashlib.sha1(url.encode()).hexdigest() + '.src')
+
+
+def derived_name(digest, variant, scale, ext):
+    return f"{digest}-{variant}@{scale}x.{ext}"
+
+
+def digest_for(url):
+    """Content hash of `url`'s derived files, or None if there are none yet."""
+
+    digest = _digests.get(url)
+    if digest is None:
+        try:
+            with open(_pointer_path(url)) as f:
+                digest = _digests[url] = f.read().strip()
+        except OSError:
+            return None
+    return digest
+
+
+##############################################################################
+# Fetching and resizing
+
+
+def _public_address(host, port):
+    """The address to connect to for `host`, if it's public.
+
+    Raises ValueError unless `host` resolves only to public addresses. (No
+    fetching localhost, or anything on the private network.)
+    """
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        raise ValueError(f"can't resolve {host}") from None
+
+    addresses = [info[4][0] for info in infos]
+    if not addresses or not all(ipaddress.ip_address(a).is_global for a in addresses):
+        raise ValueError(f"not a public host: {host}")
+    return addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection to `address`, whatever `host` resolves to by now."""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """An HTTPS connection to `address`; the certificate is checked for `host`."""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout,
+                         context=ssl.create_default_context())
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def _get(url):
+    """GET `url` from the address its host was checked at; returns the connection."""
+
+    parts = urlparse(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"won't fetch {url}")
+
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    address = _public_address(parts.hostname, port)
+    connection_class = (_PinnedHTTPSConnection if parts.scheme == 'https'
+                        else _PinnedHTTPConnection)
+
+    conn = connection_class(parts.hostname, port, address, FETCH_TIMEOUT)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    conn.request('GET', path, headers={'User-Agent': 'warbler-images'})
+    return conn
+
+
+def fetch(url):
+    """The bytes of the image at `url`: a /static/ path or a public http(s) URL.
+
+    Redirects are followed by hand, up to MAX_REDIRECTS, so every hop's
+    host is checked (and pinned) like the first.
+    """
+
+    if url.startswith('/static/'):
+        path = os.path.normpath(os.path.join(STATIC_DIR, url[len('/static/'):]))
+        if not path.startswith(STATIC_DIR + os.sep):
+            raise ValueError(f"not a static file: {url}")
+        with open(path, 'rb') as f:
+            return f.read(MAX_SOURCE_BYTES + 1)
+
+    source = url
+    for _ in range(MAX_REDIRECTS + 1):
+        conn = _get(url)
+        try:
+            resp = conn.getresponse()
+            if resp.status in REDIRECT_STATUSES and resp.getheader('Location'):
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status != 200:
+                raise ValueError(f"HTTP {resp.status} from {url}")
+            data = resp.read(MAX_SOURCE_BYTES + 1)
+        finally:
+            conn.close()
+        break
+    else:
+        raise ValueError(f"too many redirects: {source}")
+
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ValueError(f"image too large: {source}")
+    return data
+
+
+def resize(image, width, height):
+    """`image` scaled and center-cropped to exactly `width` x `height`.
+
+    Never scales up: a small source gives a smaller result of the same shape.
+    """
+
+    scale = min(1, image.width / width, image.height / height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return ImageOps.fit(image, size, Image.LANCZOS)
+
+
+def derive(url):
+    """Write every variant of the image at `url`. Returns its content hash."""
+
+    data = fetch(url)
+    digest = hashlib.sha256(data).hexdigest()[:20]
+
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+
+    if not os.path.exists(os.path.join(DERIVED_DIR, derived_name(digest, 'header', 2, 'jpg'))):
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            # JPEG has no alpha; put transparent images on white
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+            image = background
+
+        # 'header' at 2x is written last and marks the set complete
+        for name, variant in sorted(VARIANTS.items(), key=lambda v: v[0] == 'header'):
+            for scale in SCALES:
+                resized = resize(image, variant.width * scale, variant.height * scale)
+                for ext, (fmt, options) in FORMATS.items():
+                    _save(resized, derived_name(digest, name, scale, ext), fmt, options)
+
+    _write_atomic(_pointer_path(url), digest.encode())
+    _digests[url] = digest
+    return digest
+
+
+def _save(image, name, fmt, options):
+    out = io.BytesIO()
+    image.save(out, fmt, **options)
+    _write_atomic(os.path.join(DERIVED_DIR, name), out.getvalue())
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def _derive(url):
+    try:
+        derive(url)
+    except Exception as e:
+        # a broken or unreachable image is served as-is
+        logger.info("couldn't derive images for %s: %s", url, e)
+        _failed.set(url, True)
+    finally:
+        with _pending_lock:
+            _pending.discard(url)
+
+
+def derive_later(url, refresh=False):
+    """Derive `url`'s variants in the background, unless that's done already."""
+
+    if not Image or not url:
+        return
+    if refresh:
+        _digests.pop(url, None)
+        _failed.delete(url)
+    elif url in _failed or digest_for(url):
+        return
+
+    with _pending_lock:
+        if url in _pending:
+            return
+        _pending.add(url)
+
+    _executor.submit(_derive, url)
+
+
+##############################################################################
+# Templates
+
+
+def image_attrs(url, variant):
+    """`src` and `srcset` attributes for `url` at the size of `variant`."""
+
+    if not url:
+        return Markup('src=""')
+
+    digest = digest_for(url) if Image else None
+    if digest is None:
+        derive_later(url)
+        return Markup('src="%s"') % url
+
+    # only browsers that name WebP outright get it; '*/*' doesn't count
+    accept = ''
+    if request:
+        accept = request.headers.get('Accept', '')
+        g.images_vary_on_accept = True
+    ext = 'webp' if 'image/webp' in accept else 'jpg'
+    urls = {scale: f"{DERIVED_URL}/{derived_name(digest, variant, scale, ext)}"
+            for scale in SCALES}
+    srcset = ', '.join(f"{urls[scale]} {scale}x" for scale in SCALES)
+
+    return Markup(f'src="{escape(urls[1])}" srcset="{escape(srcset)}"')
+
+
+def vary_on_accept(response):
+    """Tell caches when a page's images were picked by the Accept header.
+
+    A streamed page (streaming.py) renders after this runs, so whether it
+    has images isn't known yet: it always varies.
+    """
+
+    streamed_page = response.is_streamed and response.mimetype == 'text/html'
+    if g.get('images_vary_on_accept') or streamed_page:
+        response.vary.add('Accept')
+    return response
+
+
+def init_app(app):
+    """Add the `image_attrs` filter to `app`, and the Vary header it needs."""
+
+    app.add_template_filter(image_attrs)
+    app.after_request(vary_on_accept)
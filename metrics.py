@@ -0,0 +1,116 @@
+"""Counters and gauges, served at /metrics in Prometheus' text format.
+
+    shed = metrics.counter('warbler_requests_shed_total',
+                           "Requests refused by admission control.",
+                           labels=('priority',))
+    shed.inc('low')
+
+Gauges read their value from a function when /metrics is scraped, so
+nothing has to keep them up to date.
+
+Values are per process: each gunicorn worker counts its own requests, and
+a scrape of /metrics reaches whichever worker takes it. Scrape every
+worker (or sum over the `instance` label) for totals.
+"""
+
+import threading
+
+from flask import Blueprint, Response
+
+
+metrics = Blueprint('metrics', __name__)
+
+_registry = {}
+_lock = threading.Lock()
+
+
+class Counter:
+    """A count that only goes up, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge:
+    """A value that goes up and down, read from `read()` when scraped."""
+
+    kind = 'gauge'
+    labels = ()
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        return [((), self.read())]
+
+
+def _register(metric):
+    with _lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name, help, labels=()):
+    """The counter called `name`, created on first use."""
+
+    return _register(Counter(name, help, labels))
+
+
+def gauge(name, help, read):
+    """A gauge called `name` whose value is `read()`."""
+
+    return _register(Gauge(name, help, read))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def render():
+    """Every metric, in Prometheus' text exposition format."""
+
+    lines = []
+    with _lock:
+        registered = sorted(_registry.values(), key=lambda metric: metric.name)
+
+    for metric in registered:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for label_values, value in metric.samples():
+            labels = ','.join(f'{name}="{_escape(label)}"'
+                              for name, label in zip(metric.labels, label_values))
+            name = f"{metric.name}{{{labels}}}" if labels else metric.name
+            lines.append(f"{name} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+
+@metrics.route('/metrics')
+def show():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
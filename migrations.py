@@ -0,0 +1,462 @@
+"""Versioned schema migrations for Warbler.
+
+Each migration is a function registered with `@migration(version, ...)`.
+`upgrade()` applies every migration newer than the version recorded in the
+`schema_migrations` table, in order, and records each one as it finishes.
+
+Migrations that create indexes on Postgres use CREATE INDEX CONCURRENTLY so
+they don't lock the table against writes; those have to run outside of a
+transaction, so they are registered with `transactional=False`.
+"""
+
+import json
+from collections import namedtuple
+
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, Float, ForeignKey,
+                        Index, Integer, MetaData, SmallInteger, String, Table, Text,
+                        inspect, text)
+from sqlalchemy.schema import CreateTable
+
+import cards
+from models import db, Follows, Message, Likes, liked_query
+
+
+Migration = namedtuple('Migration', 'version description fn transactional')
+
+MIGRATIONS = []
+
+# arbitrary key for pg_advisory_lock, so workers booting together don't
+# race each other through the same migrations
+MIGRATION_LOCK_KEY = 727_001
+
+
+def migration(version, description, transactional=True):
+    """Register a migration function under `version`."""
+
+    def decorator(fn):
+        MIGRATIONS.append(Migration(version, description, fn, transactional))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return fn
+
+    return decorator
+
+
+def is_postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def create_index(conn, name, table, columns, concurrently=True):
+    """Create index `name` on `table` (`columns`) if it doesn't exist yet.
+
+    On Postgres the index is built CONCURRENTLY unless `concurrently` is
+    false, which is required inside a transaction or on a partitioned table.
+    """
+
+    concurrently = 'CONCURRENTLY ' if concurrently and is_postgres(conn) else ''
+
+    conn.execute(text(
+        f"CREATE INDEX {concurrently}IF NOT EXISTS {name} "
+        f"ON {table} ({', '.join(columns)})"))
+
+
+def add_column(conn, table, column, ddl):
+    """Add `column` to `table` unless the table already has it."""
+
+    existing = [col['name'] for col in inspect(conn).get_columns(table)]
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+##############################################################################
+# Tables, as the migration that created them left them
+#
+# Migrations never build DDL from models.py: the models describe the schema
+# as it is now, and a fresh database has to go through every step on the
+# way there (migration 8 widens these message ids, for one).
+
+schema = MetaData()
+
+# migration 1
+users = Table(
+    'users', schema,
+    Column('id', Integer, primary_key=True),
+    Column('email', Text, nullable=False, unique=True),
+    Column('username', Text, nullable=False, unique=True),
+    Column('image_url', Text),
+    Column('header_image_url', Text),
+    Column('bio', Text),
+    Column('location', Text),
+    Column('password', Text, nullable=False),
+)
+
+follows = Table(
+    'follows', schema,
+    Column('user_being_followed_id', Integer,
+           ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+    Column('user_following_id', Integer,
+           ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+)
+
+messages = Table(
+    'messages', schema,
+    Column('id', Integer, primary_key=True),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'),
+           nullable=False),
+)
+
+likes = Table(
+    'likes', schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade')),
+    Column('message_id', Integer, ForeignKey('messages.id', ondelete='cascade'),
+           unique=True),
+)
+
+# migration 3
+messages_archive = Table(
+    'messages_archive', schema,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'),
+           nullable=False),
+)
+
+likes_archive = Table(
+    'likes_archive', schema,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'),
+           nullable=False),
+    Column('message_id', Integer, nullable=False),
+)
+
+# migration 4
+suggestions = Table(
+    'suggestions', schema,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'),
+           primary_key=True),
+    Column('rank', SmallInteger, primary_key=True, autoincrement=False),
+    Column('suggested_user_id', Integer, ForeignKey('users.id', ondelete='cascade'),
+           nullable=False),
+    Column('score', Float, nullable=False),
+)
+
+suggestions_stale = Table(
+    'suggestions_stale', schema,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'),
+           primary_key=True),
+    Column('marked_at', DateTime, nullable=False),
+)
+
+# migration 5
+message_tags = Table(
+    'message_tags', schema,
+    Column('tag', Text, primary_key=True),
+    Column('message_id', Integer, primary_key=True, autoincrement=False),
+    Index('ix_message_tags_message_id', 'message_id'),
+)
+
+mentions = Table(
+    'mentions', schema,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'),
+           primary_key=True),
+    Column('message_id', Integer, primary_key=True, autoincrement=False),
+    Index('ix_mentions_message_id', 'message_id'),
+)
+
+# migration 6
+notifications = Table(
+    'notifications', schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'),
+           nullable=False),
+    Column('kind', Text, nullable=False),
+    Column('message_id', Integer),
+    Column('actor_id', Integer, ForeignKey('users.id', ondelete='set null')),
+    Column('count', Integer, nullable=False),
+    Column('is_read', Boolean, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+    Index('ix_notifications_user_id_updated_at', 'user_id', 'updated_at'),
+)
+
+# migration 7
+id_blocks = Table(
+    'id_blocks', schema,
+    Column('name', String(50), primary_key=True),
+    Column('next_id', BigInteger, nullable=False),
+)
+
+
+##############################################################################
+# Migrations
+
+
+@migration(1, "baseline tables")
+def create_baseline_tables(conn):
+    for table in (users, follows, messages, likes):
+        table.create(conn, checkfirst=True)
+
+
+@migration(2, "indexes for timeline, profile and likes queries",
+           transactional=False)
+def create_performance_indexes(conn):
+    create_index(conn, 'ix_follows_user_following_id', 'follows', ['user_following_id'])
+    create_index(conn, 'ix_likes_user_id_message_id', 'likes', ['user_id', 'message_id'])
+    create_index(conn, 'ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp'])
+    create_index(conn, 'ix_messages_timestamp', 'messages', ['timestamp'])
+
+
+@migration(3, "cold archive tables for old messages and their likes")
+def create_archive_tables(conn):
+    if is_postgres(conn) and not conn.dialect.has_table(conn, 'messages_archive'):
+        create = CreateTable(messages_archive).compile(dialect=conn.dialect)
+        conn.execute(text(f"{create} PARTITION BY RANGE (timestamp)"))
+    else:
+        messages_archive.create(conn, checkfirst=True)
+
+    likes_archive.create(conn, checkfirst=True)
+
+    create_index(conn, 'ix_messages_archive_user_id_timestamp', 'messages_archive',
+                 ['user_id', 'timestamp'], concurrently=False)
+    create_index(conn, 'ix_likes_archive_user_id', 'likes_archive', ['user_id'],
+                 concurrently=False)
+
+
+@migration(4, "follow suggestions")
+def create_suggestion_tables(conn):
+    for table in (suggestions, suggestions_stale):
+        table.create(conn, checkfirst=True)
+
+
+@migration(5, "hashtag and mention indexes")
+def create_entity_tables(conn):
+    # new, empty tables: their indexes are built along with them
+    for table in (message_tags, mentions):
+        table.create(conn, checkfirst=True)
+
+
+@migration(6, "notifications and users.unread_notifications")
+def create_notifications(conn):
+    add_column(conn, 'users', 'unread_notifications', "INTEGER NOT NULL DEFAULT 0")
+    notifications.create(conn, checkfirst=True)
+
+
+@migration(7, "global id blocks for sharded messages and likes")
+def create_id_blocks(conn):
+    id_blocks.create(conn, checkfirst=True)
+
+
+# columns holding message ids, which became 64-bit snowflakes
+MESSAGE_ID_COLUMNS = [
+    ('messages', 'id'),
+    ('messages_archive', 'id'),
+    ('likes', 'message_id'),
+    ('likes_archive', 'message_id'),
+    ('message_tags', 'message_id'),
+    ('mentions', 'message_id'),
+    ('notifications', 'message_id'),
+]
+
+
+@migration(8, "64-bit message ids")
+def widen_message_ids(conn):
+    # SQLite integers are 64-bit already
+    if is_postgres(conn):
+        for table, column in MESSAGE_ID_COLUMNS:
+            conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+        # the app makes message ids now (see snowflake.py)
+        conn.execute(text("ALTER TABLE messages ALTER COLUMN id DROP DEFAULT"))
+        conn.execute(text("DROP SEQUENCE IF EXISTS messages_id_seq"))
+
+
+@migration(9, "index messages by (user_id, id) instead of (user_id, timestamp)",
+           transactional=False)
+def index_messages_by_id(conn):
+    create_index(conn, 'ix_messages_user_id_id', 'messages', ['user_id', 'id'])
+    # messages_archive is partitioned, which rules out CONCURRENTLY
+    create_index(conn, 'ix_messages_archive_user_id_id', 'messages_archive',
+                 ['user_id', 'id'], concurrently=False)
+
+    concurrently = 'CONCURRENTLY ' if is_postgres(conn) else ''
+    conn.execute(text(f"DROP INDEX {concurrently}IF EXISTS ix_messages_user_id_timestamp"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_messages_archive_user_id_timestamp"))
+
+
+##############################################################################
+# Running migrations
+
+
+def ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        " version INTEGER PRIMARY KEY,"
+        " description TEXT NOT NULL,"
+        " applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"))
+
+
+def current_version(conn):
+    """Return the newest applied migration version (0 if none)."""
+
+    version = conn.execute(
+        text("SELECT MAX(version) FROM schema_migrations")).scalar()
+    return version or 0
+
+
+def upgrade(engine=None, target=None):
+    """Apply pending migrations up to `target` (default: all of them).
+
+    Returns the list of migrations that were applied.
+    """
+
+    engine = engine or db.engine
+    applied = []
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        ensure_version_table(conn)
+
+        if is_postgres(conn):
+            conn.execute(text("SELECT pg_advisory_lock(:key)"),
+                         {'key': MIGRATION_LOCK_KEY})
+        try:
+            version = current_version(conn)
+
+            for mig in MIGRATIONS:
+                if mig.version <= version:
+                    continue
+                if target is not None and mig.version > target:
+                    break
+
+                if mig.transactional:
+                    with engine.begin() as tx:
+                        mig.fn(tx)
+                else:
+                    mig.fn(conn)
+
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, description) "
+                         "VALUES (:version, :description)"),
+                    {'version': mig.version, 'description': mig.description})
+                applied.append(mig)
+
+        finally:
+            if is_postgres(conn):
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"),
+                             {'key': MIGRATION_LOCK_KEY})
+
+    return applied
+
+
+##############################################################################
+# Verifying that hot queries use indexes
+
+
+def hot_queries(user_id, following=()):
+    """Queries issued by the busiest routes, keyed by route name.
+
+    `following` is the ids of the users `user_id` follows. These mirror the
+    queries in app.py; keep them in step when a route's query changes.
+    """
+
+    card_columns = [getattr(Message, column) for column in cards.MESSAGE_CARD_COLUMNS]
+
+    return {
+        'homepage': [
+            db.session.query(*card_columns)
+                      .filter(Message.user_id.in_(list(following) + [user_id]))
+                      .order_by(Message.id.desc())
+                      .limit(100),
+            Follows.query.filter(Follows.user_following_id == user_id),
+            Likes.query.filter(Likes.user_id == user_id),
+        ],
+        'users_show': [
+            db.session.query(*card_columns)
+                      .filter(Message.user_id.in_([user_id]))
+                      .order_by(Message.id.desc())
+                      .limit(100),
+        ],
+        'liked_warbles': [
+            liked_query(Message, Likes, user_id, cards.MESSAGE_CARD_COLUMNS)
+                .order_by(Likes.message_id.desc())
+                .limit(100),
+        ],
+        'show_following': [
+            Follows.query.filter(Follows.user_following_id == user_id),
+        ],
+        'users_followers': [
+            Follows.query.filter(Follows.user_being_followed_id == user_id),
+        ],
+        'delete_user': [
+            Message.query.filter(Message.user_id == user_id),
+            Follows.query.filter((Follows.user_following_id == user_id) |
+                                 (Follows.user_being_followed_id == user_id)),
+        ],
+    }
+
+
+def _compile(query, conn):
+    return str(query.statement.compile(
+        dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def _table_rows(conn, table):
+    if is_postgres(conn):
+        return conn.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE relname = :t"),
+            {'t': table}).scalar() or 0
+    return conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+
+
+def _seq_scans(conn, sql):
+    """Return the tables `sql` reads with a sequential scan."""
+
+    if is_postgres(conn):
+        plan = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        scans = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                scans.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return scans
+
+    # SQLite reports "SCAN <table>" for full scans, "SEARCH" for index use
+    scans = []
+    for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql)):
+        detail = row[-1]
+        if detail.startswith('SCAN ') and 'INDEX' not in detail:
+            scans.append(detail.split()[1])
+    return scans
+
+
+def verify_indexes(engine=None, min_rows=10_000, user_id=None):
+    """EXPLAIN every hot query and report sequential scans on big tables.
+
+    Small tables are ignored: the planner rightly prefers a seq scan there.
+    Returns a list of (route, table, rows) problems; empty means all good.
+    """
+
+    engine = engine or db.engine
+    problems = []
+
+    with engine.connect() as conn:
+        if user_id is None:
+            user_id = conn.execute(text("SELECT MAX(id) FROM users")).scalar() or 1
+        following = [followed for followed, in conn.execute(
+            text("SELECT user_being_followed_id FROM follows "
+                 "WHERE user_following_id = :user_id"), {'user_id': user_id})]
+
+        for route, queries in hot_queries(user_id, following).items():
+            for query in queries:
+                for table in _seq_scans(conn, _compile(query, conn)):
+                    rows = _table_rows(conn, table)
+                    if rows >= min_rows:
+                        problems.append((route, table, rows))
+
+    return problems
@@ -5,6 +5,8 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+import snowflake
+
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -14,6 +16,11 @@ class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # the primary key covers lookups by followed user; this covers the
+        # reverse direction (who does this user follow?)
+        db.Index('ix_follows_user_following_id', 'user_following_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -32,6 +39,9 @@ class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes'
+    __table_args__ = (
+        db.Index('ix_likes_user_id_message_id', 'user_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -44,7 +54,7 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
         unique=True
     )
@@ -95,6 +105,14 @@ class User(db.Model):
         nullable=False,
     )
 
+    # kept up to date by notifications.py, so the header never counts rows
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -186,14 +204,32 @@ class User(db.Model):
         return False
 
 
+def _timestamp_from_id(context):
+    """Default for Message.timestamp: the time recorded in its id."""
+
+    message_id = context.get_current_parameters().get('id')
+    if message_id is not None and snowflake.is_snowflake(message_id):
+        return snowflake.timestamp_of(message_id)
+    return datetime.utcnow()
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # ids are time-ordered (see snowflake.py), so this covers a user's
+        # messages newest first
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        # for archive.py
+        db.Index('ix_messages_timestamp', 'timestamp'),
+    )
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -204,7 +240,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=_timestamp_from_id,
     )
 
     user_id = db.Column(
@@ -218,6 +254,407 @@ class Message(db.Model):
     # Relationship to the Likes model
     likes = db.relationship('Likes', backref='message', cascade='all, delete-orphan')
 
+    # hashtags and mentions, filled in by entities.index_message()
+    tags = db.relationship(
+        'MessageTag',
+        primaryjoin='Message.id == foreign(MessageTag.message_id)',
+        cascade='all, delete-orphan',
+    )
+
+    mentions = db.relationship(
+        'Mention',
+        primaryjoin='Message.id == foreign(Mention.message_id)',
+        cascade='all, delete-orphan',
+    )
+
+    @classmethod
+    def find(cls, message_id):
+        """Find a message by id, looking in the archive if it isn't hot."""
+
+        return (cls.query.get(message_id) or
+                ArchivedMessage.query.filter_by(id=message_id).first())
+
+    @classmethod
+    def liked_by(cls, user_id, before=None, limit=None, columns=None):
+        """Messages `user_id` has liked, including archived ones, newest first.
+
+        `before` is the id of the last message on the previous page. With
+        `columns`, return plain rows of just those columns (see cards.py).
+        """
+
+        messages = liked_page(cls, Likes, user_id, before, limit, columns)
+
+        if limit is None or len(messages) < limit:
+            cursor = messages[-1].id if messages else before
+            messages += liked_page(ArchivedMessage, ArchivedLike, user_id, cursor,
+                                    limit and limit - len(messages), columns)
+
+        return messages
+
+    @classmethod
+    def find_many(cls, message_ids):
+        """Messages with `message_ids`, hot or archived, in the same order.
+
+        Ids that don't exist (any more) are skipped.
+        """
+
+        found = {msg.id: msg for msg in cls.query.filter(cls.id.in_(message_ids))}
+
+        archived = [msg_id for msg_id in message_ids if msg_id not in found]
+        if archived:
+            found.update((msg.id, msg) for msg in
+                         ArchivedMessage.query.filter(ArchivedMessage.id.in_(archived)))
+
+        return [found[msg_id] for msg_id in message_ids if msg_id in found]
+
+    @classmethod
+    def timeline(cls, user_ids=None, before=None, since=None, limit=100,
+                 columns=None):
+        """Return up to `limit` messages, newest first.
+
+        If `user_ids` is given, only messages by those users are included.
+        `before` is the id of the last message on the previous page.
+
+        With `since` (the id of the newest message a client already has),
+        return only messages newer than it instead, oldest first, so a
+        client can keep polling from the last one it got.
+
+        Old messages are moved to `messages_archive` (see archive.py); the
+        archive is only queried once a page runs past the hot messages.
+
+        With `columns` (names like 'id', 'text'), return plain rows of just
+        those columns instead of model objects (see cards.py).
+        """
+
+        if since is not None:
+            return timeline_page(cls, user_ids, since, limit, newer=True,
+                                  columns=columns)
+
+        messages = timeline_page(cls, user_ids, before, limit, columns=columns)
+
+        if len(messages) < limit:
+            cursor = messages[-1].id if messages else before
+            messages += timeline_page(ArchivedMessage, user_ids, cursor,
+                                       limit - len(messages), columns=columns)
+
+        return messages
+
+
+class ArchivedMessage(db.Model):
+    """A message moved out of `messages` once it got old.
+
+    On Postgres this table is range-partitioned by month on `timestamp`
+    (see migrations.py), so the primary key has to include it.
+    """
+
+    __tablename__ = 'messages_archive'
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_id', 'user_id', 'id'),
+    )
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    user = db.relationship('User', viewonly=True)
+
+    likes = db.relationship(
+        'ArchivedLike',
+        primaryjoin='ArchivedMessage.id == foreign(ArchivedLike.message_id)',
+        viewonly=True,
+    )
+
+
+class ArchivedLike(db.Model):
+    """A like on a message that has been archived."""
+
+    __tablename__ = 'likes_archive'
+    __table_args__ = (
+        db.Index('ix_likes_archive_user_id', 'user_id'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message, lowercased and without the '#'.
+
+    There's no foreign key to `messages`, so rows stay put when a message
+    is archived; see entities.py.
+    """
+
+    __tablename__ = 'message_tags'
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+
+class Mention(db.Model):
+    """A user @mentioned in a message."""
+
+    __tablename__ = 'mentions'
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+
+class Notification(db.Model):
+    """Something that happened to a user, like "5 people liked your warble".
+
+    Events of the same `kind` about the same message are merged into one
+    unread notification, counting how many there were (see
+    notifications.py).
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_user_id_updated_at', 'user_id', 'updated_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'like', 'follow' or 'mention'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+    )
+
+    # whoever did it most recently
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    is_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+
+class Suggestion(db.Model):
+    """A user suggested for `user_id` to follow (see recommendations.py)."""
+
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.SmallInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    suggested_user = db.relationship('User', foreign_keys=[suggested_user_id])
+
+    @classmethod
+    def for_user(cls, user_id, limit=5, exclude=()):
+        """Up to `limit` suggested users for `user_id`, best first.
+
+        Users in `exclude` (say, ones followed since the job last ran) are
+        skipped.
+        """
+
+        # the job stores at most a few dozen rows per user
+        suggestions = (cls.query
+                          .filter_by(user_id=user_id)
+                          .options(db.joinedload(cls.suggested_user))
+                          .order_by(cls.rank)
+                          .all())
+
+        return [s.suggested_user for s in suggestions
+                if s.suggested_user_id not in exclude][:limit]
+
+
+class StaleSuggestions(db.Model):
+    """A user whose follows changed since their suggestions were computed."""
+
+    __tablename__ = 'suggestions_stale'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    marked_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def mark(cls, user_id):
+        db.session.merge(cls(user_id=user_id, marked_at=datetime.utcnow()))
+
+
+class IdBlock(db.Model):
+    """The next unallocated id in a global id sequence (see sharding.py)."""
+
+    __tablename__ = 'id_blocks'
+
+    name = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    next_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+def timeline_page(model, user_ids, cursor, limit, newer=False, columns=None):
+    """Newest-first page of `model` rows with ids below `cursor`.
+
+    With `newer`, an oldest-first page of rows with ids above `cursor`.
+    Ids are time-ordered, so this is also ordered by time. With `columns`,
+    rows of just those columns.
+    """
+
+    if columns is None:
+        query = model.query
+    else:
+        query = db.session.query(*[getattr(model, column) for column in columns])
+    if user_ids is not None:
+        query = query.filter(model.user_id.in_(user_ids))
+
+    if cursor is not None:
+        query = query.filter(model.id > cursor if newer else model.id < cursor)
+
+        if model is ArchivedMessage and snowflake.is_snowflake(cursor):
+            # lets Postgres skip the monthly partitions that can't match
+            bound = snowflake.timestamp_of(cursor)
+            query = query.filter(model.timestamp >= bound if newer
+                                 else model.timestamp <= bound)
+
+    if newer:
+        query = query.order_by(model.id)
+    else:
+        query = query.order_by(model.id.desc())
+
+    return query.limit(limit).all()
+
+
+def liked_query(model, like_model, user_id, columns=None):
+    """Query for the `model` rows that `user_id` liked, going by `like_model`."""
+
+    if columns is None:
+        query = model.query
+    else:
+        query = db.session.query(*[getattr(model, column) for column in columns])
+
+    return (query.join(like_model, like_model.message_id == model.id)
+                 .filter(like_model.user_id == user_id))
+
+
+def liked_page(model, like_model, user_id, cursor, limit, columns=None):
+    """Page of the `model` rows `user_id` liked, newest first, below `cursor`."""
+
+    query = liked_query(model, like_model, user_id, columns)
+    if cursor is not None:
+        query = query.filter(like_model.message_id < cursor)
+
+    return query.order_by(like_model.message_id.desc()).limit(limit).all()
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
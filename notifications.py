@@ -0,0 +1,192 @@
+"""Notifications for likes, follows and mentions, written in batches.
+
+Routes call `notify()`, which only appends to an in-memory queue, so a
+like or a follow costs no extra write in the request. A background thread
+flushes the queue every FLUSH_INTERVAL seconds (sooner once MAX_PENDING
+events are waiting):
+
+- events for the same recipient, kind and message are coalesced, so 12
+  likes on a warble become one "12 people liked your warble";
+- they're merged into that notification if it's still unread, or start
+  a new one;
+- the recipient's `users.unread_notifications` goes up by the number of
+  new notifications, so the header reads a column instead of counting.
+
+Each flush is one transaction with a handful of statements, however many
+events it holds. Events still queued when a worker is killed are lost;
+notifications are a convenience, not a record.
+"""
+
+import atexit
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, bindparam, or_, select
+
+from models import db, User, Notification
+
+
+FLUSH_INTERVAL = 1.0
+
+MAX_PENDING = 1000
+
+Event = namedtuple('Event', 'user_id kind message_id actor_id at')
+
+_pending = []
+_lock = threading.Lock()
+# one flush at a time, so two can't both start the same notification
+_flush_lock = threading.Lock()
+_wakeup = threading.Event()
+_flusher = None
+
+
+def notify(user_id, kind, actor_id, message_id=None):
+    """Queue a notification for `user_id` that `actor_id` did `kind`."""
+
+    if user_id == actor_id:
+        return
+
+    with _lock:
+        _pending.append(Event(user_id, kind, message_id, actor_id, datetime.utcnow()))
+        full = len(_pending) >= MAX_PENDING
+
+    _start_flusher()
+    if full:
+        _wakeup.set()
+
+
+def coalesce(events):
+    """Group events by (user_id, kind, message_id).
+
+    Returns {key: (set of actor_ids, latest actor_id, latest time)}, so
+    someone who likes, unlikes and likes again counts once.
+    """
+
+    groups = {}
+    for event in events:
+        key = (event.user_id, event.kind, event.message_id)
+        actors = groups[key][0] if key in groups else set()
+        actors.add(event.actor_id)
+        groups[key] = (actors, event.actor_id, event.at)
+    return groups
+
+
+def flush(engine=None):
+    """Write every queued event now. Returns how many were written."""
+
+    global _pending
+
+    with _flush_lock:
+        with _lock:
+            events, _pending = _pending, []
+        if not events:
+            return 0
+
+        engine = engine or db.engine
+        with engine.begin() as conn:
+            _write(conn, coalesce(events))
+        return len(events)
+
+
+def _write(conn, groups):
+    table = Notification.__table__
+    users = User.__table__
+
+    # recipients deleted since their events were queued
+    recipients = {user_id for user_id, _, _ in groups}
+    existing = {row[0] for row in conn.execute(
+        select([users.c.id]).where(users.c.id.in_(recipients)))}
+    groups = {key: value for key, value in groups.items() if key[0] in existing}
+    if not groups:
+        return
+
+    # unread notifications these events merge into
+    unread = {}
+    for row in conn.execute(table.select().where(and_(
+            table.c.user_id.in_(existing),
+            table.c.is_read.is_(False),
+            or_(*[and_(table.c.user_id == user_id,
+                       table.c.kind == kind,
+                       table.c.message_id == message_id)
+                  for user_id, kind, message_id in groups])))):
+        unread[row.user_id, row.kind, row.message_id] = (row.id, row.actor_id)
+
+    updates = []
+    inserts = []
+    for key, (actors, actor_id, at) in groups.items():
+        if key in unread:
+            notification_id, last_actor = unread[key]
+            # only the latest actor is stored, so that's the one repeat
+            # across flushes that can be left out
+            updates.append({'notification_id': notification_id,
+                            'added': len(actors - {last_actor}),
+                            'actor': actor_id, 'at': at})
+        else:
+            user_id, kind, message_id = key
+            inserts.append({'user_id': user_id, 'kind': kind,
+                            'message_id': message_id, 'actor_id': actor_id,
+                            'count': len(actors), 'is_read': False, 'updated_at': at})
+
+    if updates:
+        conn.execute(
+            table.update()
+                 .where(table.c.id == bindparam('notification_id'))
+                 .values(count=table.c.count + bindparam('added'),
+                         actor_id=bindparam('actor'),
+                         updated_at=bindparam('at')),
+            updates)
+
+    if inserts:
+        conn.execute(table.insert(), inserts)
+
+        new_counts = {}
+        for row in inserts:
+            new_counts[row['user_id']] = new_counts.get(row['user_id'], 0) + 1
+        conn.execute(
+            users.update()
+                 .where(users.c.id == bindparam('recipient'))
+                 .values(unread_notifications=(users.c.unread_notifications +
+                                               bindparam('added'))),
+            [{'recipient': user_id, 'added': added}
+             for user_id, added in new_counts.items()])
+
+
+def mark_read(user_id):
+    """Mark all of a user's notifications read and zero their counter."""
+
+    table = Notification.__table__
+    db.session.execute(table.update()
+                            .where(table.c.user_id == user_id)
+                            .where(table.c.is_read.is_(False))
+                            .values(is_read=True))
+    User.query.filter_by(id=user_id).update({'unread_notifications': 0},
+                                            synchronize_session='fetch')
+    db.session.commit()
+
+
+##############################################################################
+# Background flushing
+
+
+def _run():
+    while True:
+        _wakeup.wait(FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception:
+            # the batch is dropped; keep the thread alive for the next one
+            db.get_app().logger.exception("couldn't write notifications")
+
+
+def _start_flusher():
+    global _flusher
+
+    if _flusher is None:
+        with _lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_run, name='notifications',
+                                            daemon=True)
+                _flusher.start()
+                atexit.register(flush)
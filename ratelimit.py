@@ -0,0 +1,259 @@
+"""Token-bucket rate limits for expensive routes.
+
+Routes that hash passwords (login, signup, change_password) or write
+(messages_add, like_message) are wrapped in `@rate_limit`, which gives
+each client IP, and each logged-in user, a bucket of tokens:
+
+    @app.route('/login', methods=["GET", "POST"])
+    @rate_limit(ip='10/minute')
+    def login(): ...
+
+A bucket holds up to `count` tokens and refills at `count` per `period`,
+so a client can burst to the limit and then goes at the steady rate. A
+request that finds its bucket empty gets `429 Too Many Requests` with a
+Retry-After header, before the view runs. Only POSTs are counted by
+default; showing a form is cheap.
+
+Limits given in the code can be changed or turned off per endpoint with
+the RATE_LIMITS config setting:
+
+    app.config['RATE_LIMITS'] = {'login': {'ip': '5/minute'},
+                                 'like_message': None}
+
+Buckets live in a backend from RATELIMIT_URL: 'memory://' counts per
+process (so each gunicorn worker allows the full rate), while
+'sqlite:///path/to/file' shares them between every worker on the host.
+If the backend fails, requests are let through rather than refused.
+
+Behind a proxy, `request.remote_addr` is the proxy's address unless the
+app is wrapped in werkzeug's ProxyFix.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from functools import lru_cache, wraps
+
+from flask import current_app, g, request
+from werkzeug.exceptions import TooManyRequests
+
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+# the in-memory backend sweeps out full buckets once it holds this many
+# (or twice as many as were left after the last sweep)
+MAX_MEMORY_BUCKETS = 100_000
+
+# the SQLite backend sweeps out full buckets every this many requests
+SWEEP_EVERY = 10_000
+
+SQLITE_TIMEOUT = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class Limit(namedtuple('Limit', 'count period')):
+    """Up to `count` requests at once, refilled at `count` per `period` seconds."""
+
+    @property
+    def rate(self):
+        return self.count / self.period
+
+
+@lru_cache(maxsize=None)
+def parse_limit(spec):
+    """A Limit from a string like '10/minute' or '100/hour'."""
+
+    try:
+        count, period = spec.split('/')
+        return Limit(int(count), PERIODS[period.strip()])
+    except (ValueError, KeyError):
+        raise ValueError(f"Bad rate limit: {spec!r}") from None
+
+
+def refill(tokens, updated, now, limit):
+    """Tokens in a bucket that had `tokens` at time `updated`."""
+
+    return min(limit.count, tokens + (now - updated) * limit.rate)
+
+
+def _take(tokens, limit):
+    """(tokens left, seconds to wait) for taking a token from `tokens`."""
+
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / limit.rate
+
+
+##############################################################################
+# Backends
+
+
+class MemoryBackend:
+    """Buckets in this process."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._sweep_at = MAX_MEMORY_BUCKETS
+
+    def take(self, key, limit, now):
+        """Take a token from bucket `key`; return 0 or seconds to wait."""
+
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (limit.count, now, now))
+            tokens, wait = _take(refill(tokens, updated, now, limit), limit)
+            # full again by `now + limit.period`, at the latest
+            self._buckets[key] = (tokens, now, now + limit.period)
+
+            if len(self._buckets) > self._sweep_at:
+                self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                                 if bucket[2] > now}
+                self._sweep_at = max(MAX_MEMORY_BUCKETS, 2 * len(self._buckets))
+        return wait
+
+
+class SQLiteBackend:
+    """Buckets in a SQLite file, shared by every process that opens it.
+
+    Each take is one short write transaction. The file is only a
+    scratchpad, so it skips fsync; a crash at worst forgets some buckets.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._takes = 0
+        # one connection per process; gevent workers would otherwise
+        # open one per greenlet
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                         "key TEXT PRIMARY KEY, "
+                         "tokens REAL NOT NULL, "
+                         "updated REAL NOT NULL, "
+                         "expires REAL NOT NULL)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def take(self, key, limit, now):
+        """Take a token from bucket `key`; return 0 or seconds to wait."""
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?",
+                                   (key,)).fetchone()
+                tokens, updated = row or (limit.count, now)
+                tokens, wait = _take(refill(tokens, updated, now, limit), limit)
+                conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                             (key, tokens, now, now + limit.period))
+
+                self._takes += 1
+                if self._takes % SWEEP_EVERY == 0:
+                    conn.execute("DELETE FROM buckets WHERE expires < ?", (now,))
+
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
+
+
+def create_backend(url):
+    """Build a backend from a RATELIMIT_URL like 'memory://' or 'sqlite:///path'."""
+
+    if not url or url.startswith('memory:'):
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):] or ':memory:')
+    raise ValueError(f"Unsupported RATELIMIT_URL: {url}")
+
+
+_backend = MemoryBackend()
+
+
+def configure(url):
+    """Keep buckets in the backend at `url` (starting them all full)."""
+
+    global _backend
+    _backend = create_backend(url)
+
+
+##############################################################################
+# Routes
+
+
+class RateLimited(TooManyRequests):
+    """429 with a Retry-After header."""
+
+    description = "Too many requests. Please slow down and try again shortly."
+
+    def __init__(self, wait):
+        super().__init__()
+        self.wait = wait
+
+    def get_headers(self, *args, **kwargs):
+        headers = super().get_headers(*args, **kwargs)
+        headers.append(('Retry-After', str(max(1, math.ceil(self.wait)))))
+        return headers
+
+
+def _limits(endpoint, defaults):
+    overrides = current_app.config.get('RATE_LIMITS', {})
+    if endpoint in overrides:
+        return overrides[endpoint] or {}
+    return defaults
+
+
+def check(endpoint, ip=None, user=None, now=None):
+    """Take a token for this request; raise RateLimited if there's none."""
+
+    now = time.time() if now is None else now
+    user_id = g.user.id if getattr(g, 'user', None) else None
+
+    wait = 0
+    for scope, spec, who in (('ip', ip, request.remote_addr),
+                             ('user', user, user_id)):
+        if spec is None or who is None:
+            continue
+        try:
+            wait = max(wait, _backend.take(f"{endpoint}:{scope}:{who}",
+                                           parse_limit(spec), now))
+        except sqlite3.Error as e:
+            logger.warning("rate limit backend failed, not limiting: %s", e)
+
+    if wait:
+        raise RateLimited(wait)
+
+
+def rate_limit(ip=None, user=None, methods=('POST',)):
+    """Limit a view per client IP and per logged-in user (see module docs)."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method in methods:
+                limits = _limits(request.endpoint, {'ip': ip, 'user': user})
+                if limits:
+                    check(request.endpoint, **limits)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
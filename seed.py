@@ -1,20 +1,39 @@
 """Seed database with sample data from CSV Files."""
 
+import os
 from csv import DictReader
+from datetime import datetime
 from app import db
 from models import User, Message, Follows
+import snowflake
 
 
-db.drop_all()
-db.create_all()
+def seed(directory='generator'):
+    """Recreate the tables and load the CSVs in `directory`; return rows loaded."""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    db.drop_all()
+    db.create_all()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    with open(os.path.join(directory, 'users.csv')) as users:
+        users = list(DictReader(users))
+        db.session.bulk_insert_mappings(User, users)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+    with open(os.path.join(directory, 'messages.csv')) as messages:
+        messages = list(DictReader(messages))
+        # message ids are time-ordered: give each one the id of its timestamp
+        for n, row in enumerate(messages):
+            row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            row['id'] = snowflake.id_at(row['timestamp'],
+                                        sequence=n & snowflake.MAX_SEQUENCE)
+        db.session.bulk_insert_mappings(Message, messages)
 
-db.session.commit()
+    with open(os.path.join(directory, 'follows.csv')) as follows:
+        follows = list(DictReader(follows))
+        db.session.bulk_insert_mappings(Follows, follows)
+
+    db.session.commit()
+    return len(users) + len(messages) + len(follows)
+
+
+if __name__ == '__main__':
+    seed()
@@ -0,0 +1,626 @@
+"""Messages and likes split across several databases by user id.
+
+Sharding is off unless SHARD_URLS names the shards, as `name=url` pairs:
+
+    SHARD_URLS=a=postgresql:///warbler_a,b=postgresql:///warbler_b
+
+Users, follows and everything else stay in the main database. Each user's
+messages, and the likes they've given, live on the shard that the user id
+hashes to on a consistent-hash ring (`HashRing`), so:
+
+- a profile page reads one shard;
+- the home timeline asks each shard holding someone the viewer follows,
+  in parallel, and merges the pages by id (ids are time-ordered);
+- liked messages are read from the likers' shard, then fetched from their
+  authors' shards in parallel (likes keep the author id for this).
+
+Ids can't come from each shard's own sequence. Messages get snowflake ids
+(see snowflake.py); likes get ids handed out in blocks from the
+`id_blocks` table in the main database (`IdAllocator`).
+
+Turning sharding on for a database that already has messages leaves
+them in the main database, where nothing reads them any more. Run
+`flask move-to-shards` right after setting SHARD_URLS (before serving
+traffic) to copy the main database's messages and likes to the shards
+that own them and delete them from the main database. It can be run
+again if it's interrupted.
+
+Adding a shard to the ring moves only about 1/N of the users. After
+changing SHARD_URLS, run `flask rebalance-shards` to copy each moved
+user's rows to their new shard and delete the old copies; until it has
+run, moved users' messages don't show up.
+
+With sharding on (`current()` returns the app's `Shards`), everything that
+reads or writes messages and likes goes through here: the HTML routes and
+the JSON API, viewer states (viewer_state.py), the hashtag and mention
+feeds, exports, deleting a user and the cache warm-up. The hashtag and
+mention index rows, and the cold archive (archive.py), stay in the main
+database; timelines, liked messages and lookups fall back to the archive
+for messages archived before sharding was turned on. The archive job
+itself only moves the main database's messages.
+"""
+
+import bisect
+import hashlib
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+from sqlalchemy import (BigInteger, Column, DateTime, Index, Integer, MetaData,
+                        String, Table, and_, create_engine, func, or_, select)
+from sqlalchemy.exc import IntegrityError
+
+from cards import MESSAGE_CARD_COLUMNS, with_authors
+from models import (db, ArchivedMessage, ArchivedLike, IdBlock, Likes, Message,
+                    liked_page, timeline_page)
+import snowflake
+
+
+VIRTUAL_NODES = 100
+
+ID_BLOCK_SIZE = 1000
+
+REBALANCE_BATCH_SIZE = 1000
+
+# rows read at a time when streaming a user's rows (exports)
+USER_ROWS_BATCH_SIZE = 1000
+
+# ids per statement when deleting likes of a deleted user's messages
+DELETE_BATCH_SIZE = 1000
+
+SCATTER_WORKERS = 8
+
+TIMELINE_PAGE_SIZE = 100
+
+
+metadata = MetaData()
+
+# no foreign keys: users live in the main database, and a like's message
+# usually lives on another shard
+messages = Table(
+    'messages', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Index('ix_messages_user_id_id', 'user_id', 'id'),
+)
+
+likes = Table(
+    'likes', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('user_id', Integer, nullable=False),
+    Column('message_id', BigInteger, nullable=False),
+    # the message's author, whose shard holds the message
+    Column('author_id', Integer, nullable=False),
+    Index('ix_likes_user_id_message_id', 'user_id', 'message_id', unique=True),
+    Index('ix_likes_message_id', 'message_id'),
+)
+
+def parse_shard_urls(value):
+    """{name: url} from 'name=url,name=url' (empty: no sharding)."""
+
+    shards = {}
+    for pair in (value or '').split(','):
+        if pair.strip():
+            name, _, url = pair.strip().partition('=')
+            if not url:
+                raise ValueError(f"Expected name=url in SHARD_URLS, got {pair!r}")
+            shards[name] = url
+    return shards
+
+
+##############################################################################
+# Placement
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys onto named nodes.
+
+    Each node gets `vnodes` points on the ring, so keys spread evenly and
+    adding a node takes keys from every other node, not just a neighbour.
+    """
+
+    def __init__(self, nodes, vnodes=VIRTUAL_NODES):
+        points = sorted((_hash(f"{node}#{i}"), node)
+                        for node in nodes for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        i = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._nodes[i]
+
+
+class IdAllocator:
+    """Globally unique ids for `name`, reserved in blocks from `id_blocks`.
+
+    Each process takes ID_BLOCK_SIZE ids at a time, so ids are unique but
+    only roughly in order across processes.
+    """
+
+    def __init__(self, engine, name, block_size=ID_BLOCK_SIZE, start=1):
+        self.engine = engine
+        self.name = name
+        self.block_size = block_size
+        self.start = start
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._end = self._reserve()
+                self._next = self._end - self.block_size
+            self._next += 1
+            return self._next - 1
+
+    def _reserve(self):
+        """Reserve the next block; returns the id just past it."""
+
+        table = IdBlock.__table__
+        for _ in range(2):
+            try:
+                with self.engine.begin() as conn:
+                    updated = conn.execute(
+                        table.update()
+                             .where(table.c.name == self.name)
+                             .values(next_id=table.c.next_id + self.block_size)).rowcount
+                    if not updated:
+                        conn.execute(table.insert().values(
+                            name=self.name, next_id=self.start + self.block_size))
+                    return conn.execute(select([table.c.next_id])
+                                        .where(table.c.name == self.name)).scalar()
+            except IntegrityError:
+                # another process created the row first; update it instead
+                continue
+        raise RuntimeError(f"couldn't reserve ids for {self.name}")
+
+
+##############################################################################
+# Shards
+
+
+def _page_query(user_ids, cursor, limit, newer=False):
+    """Like models.timeline_page, on a shard's messages table."""
+
+    query = select([messages]).where(messages.c.user_id.in_(user_ids))
+
+    if cursor is not None:
+        query = query.where(messages.c.id > cursor if newer else messages.c.id < cursor)
+
+    if newer:
+        query = query.order_by(messages.c.id)
+    else:
+        query = query.order_by(messages.c.id.desc())
+
+    return query.limit(limit)
+
+
+def _archived(message_ids):
+    """{id: card row} for the archived messages among `message_ids`."""
+
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+    columns = [getattr(ArchivedMessage, column) for column in MESSAGE_CARD_COLUMNS]
+    rows = db.session.query(*columns).filter(ArchivedMessage.id.in_(message_ids))
+    return {row.id: row for row in rows}
+
+
+class Shards:
+    """The shard databases, and the reads and writes that span them."""
+
+    def __init__(self, urls, id_engine):
+        self.engines = {name: create_engine(url) for name, url in urls.items()}
+        self.ring = HashRing(self.engines)
+        self.like_ids = IdAllocator(id_engine, 'likes')
+        self._executor = ThreadPoolExecutor(max_workers=SCATTER_WORKERS,
+                                            thread_name_prefix='shards')
+
+    def create_all(self):
+        for engine in self.engines.values():
+            metadata.create_all(engine)
+
+    def name_for(self, user_id):
+        return self.ring.node_for(user_id)
+
+    def engine_for(self, user_id):
+        return self.engines[self.name_for(user_id)]
+
+    def group(self, user_ids):
+        """{shard name: [user ids on it]}"""
+
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.name_for(user_id), []).append(user_id)
+        return groups
+
+    def group_rows(self, rows):
+        """{shard name: [rows]}, by each row's `user_id`."""
+
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.name_for(row.user_id), []).append(row)
+        return groups
+
+    def scatter(self, fn, names=None):
+        """Call `fn(name, engine)` on shards `names` (all by default), in parallel.
+
+        Returns {name: result}.
+        """
+
+        names = list(self.engines) if names is None else list(names)
+        if len(names) == 1:
+            return {names[0]: fn(names[0], self.engines[names[0]])}
+
+        futures = {name: self._executor.submit(fn, name, self.engines[name])
+                   for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+    ##########################################################################
+    # Messages
+
+    def add_message(self, user_id, text):
+        message_id = snowflake.next_id()
+        row = {'id': message_id, 'text': text,
+               'timestamp': snowflake.timestamp_of(message_id), 'user_id': user_id}
+        with self.engine_for(user_id).begin() as conn:
+            conn.execute(messages.insert(), row)
+        return row['id']
+
+    def find_many(self, message_ids):
+        """Like Message.find_many, as MessageCards: from any shard, or the archive."""
+
+        if not message_ids:
+            return []
+
+        def fetch(name, engine):
+            with engine.connect() as conn:
+                return conn.execute(select([messages])
+                                    .where(messages.c.id.in_(message_ids))).fetchall()
+
+        found = {row.id: row for rows in self.scatter(fetch).values() for row in rows}
+        found.update(_archived(msg_id for msg_id in message_ids if msg_id not in found))
+
+        return with_authors([found[msg_id] for msg_id in message_ids if msg_id in found])
+
+    def find(self, message_id):
+        """The message with `message_id`, from whichever shard has it, or None."""
+
+        found = self.find_many([message_id])
+        return found[0] if found else None
+
+    def delete_message(self, message_id, user_id):
+        """Delete `user_id`'s message `message_id`. Returns False if there's none."""
+
+        with self.engine_for(user_id).begin() as conn:
+            deleted = conn.execute(messages.delete().where(and_(
+                messages.c.id == message_id,
+                messages.c.user_id == user_id))).rowcount
+        if not deleted:
+            return False
+
+        # likes are on the likers' shards, wherever those are
+        def delete_likes(name, engine):
+            with engine.begin() as conn:
+                conn.execute(likes.delete().where(likes.c.message_id == message_id))
+
+        self.scatter(delete_likes)
+        return True
+
+    def delete_user(self, user_id):
+        """Delete `user_id`'s messages and likes, and every like of their messages.
+
+        Returns the ids of the deleted messages.
+        """
+
+        with self.engine_for(user_id).begin() as conn:
+            message_ids = [msg_id for (msg_id,) in conn.execute(
+                select([messages.c.id]).where(messages.c.user_id == user_id))]
+            conn.execute(messages.delete().where(messages.c.user_id == user_id))
+            conn.execute(likes.delete().where(likes.c.user_id == user_id))
+
+        def delete_likes(name, engine):
+            with engine.begin() as conn:
+                for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                    batch = message_ids[i:i + DELETE_BATCH_SIZE]
+                    conn.execute(likes.delete().where(likes.c.message_id.in_(batch)))
+
+        if message_ids:
+            self.scatter(delete_likes)
+        return message_ids
+
+    def user_rows(self, table, user_id, batch_size=USER_ROWS_BATCH_SIZE):
+        """Yield `user_id`'s rows of `table` (messages or likes), by id."""
+
+        engine = self.engine_for(user_id)
+        last_id = 0
+        while True:
+            with engine.connect() as conn:
+                rows = conn.execute(select([table])
+                                    .where(and_(table.c.user_id == user_id,
+                                                table.c.id > last_id))
+                                    .order_by(table.c.id)
+                                    .limit(batch_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1].id
+
+    def recent_authors(self, limit):
+        """Ids of the users who posted most recently, across every shard."""
+
+        latest = func.max(messages.c.id)
+
+        def fetch(name, engine):
+            with engine.connect() as conn:
+                return conn.execute(select([messages.c.user_id, latest])
+                                    .group_by(messages.c.user_id)
+                                    .order_by(latest.desc())
+                                    .limit(limit)).fetchall()
+
+        rows = [row for found in self.scatter(fetch).values() for row in found]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return [user_id for user_id, _ in rows[:limit]]
+
+    def timeline(self, user_ids, before=None, since=None, limit=TIMELINE_PAGE_SIZE):
+        """Like Message.timeline: one page from each shard, merged by id."""
+
+        groups = self.group(user_ids)
+        newer = since is not None
+        cursor = since if newer else before
+
+        def page(name, engine):
+            with engine.connect() as conn:
+                return conn.execute(_page_query(groups[name], cursor, limit, newer)).fetchall()
+
+        pages = self.scatter(page, groups).values()
+        merged = heapq.merge(*pages, key=lambda row: row.id, reverse=not newer)
+        rows = list(merged)[:limit]
+
+        # the archive only holds messages from before sharding was on, all
+        # older than any on the shards
+        if not newer and len(rows) < limit:
+            cursor = rows[-1].id if rows else before
+            rows += timeline_page(ArchivedMessage, user_ids, cursor, limit - len(rows),
+                                  columns=MESSAGE_CARD_COLUMNS)
+
+        return with_authors(rows)
+
+    ##########################################################################
+    # Likes
+
+    def has_liked(self, user_id, message_id):
+        with self.engine_for(user_id).connect() as conn:
+            return conn.execute(select([likes.c.id]).where(and_(
+                likes.c.user_id == user_id,
+                likes.c.message_id == message_id))).first() is not None
+
+    def toggle_like(self, user_id, message):
+        """Like `message` for `user_id`, or unlike it. Returns True if now liked."""
+
+        with self.engine_for(user_id).begin() as conn:
+            deleted = conn.execute(likes.delete().where(and_(
+                likes.c.user_id == user_id,
+                likes.c.message_id == message.id))).rowcount
+            if deleted:
+                return False
+            conn.execute(likes.insert(), {'id': self.like_ids.next_id(),
+                                          'user_id': user_id,
+                                          'message_id': message.id,
+                                          'author_id': message.user_id})
+            return True
+
+    def liked_ids(self, user_ids):
+        """{user id: [ids of the messages they've liked]} for `user_ids`."""
+
+        groups = self.group(user_ids)
+
+        def fetch(name, engine):
+            with engine.connect() as conn:
+                return conn.execute(select([likes.c.user_id, likes.c.message_id])
+                                    .where(likes.c.user_id.in_(groups[name]))).fetchall()
+
+        liked = {user_id: [] for user_id in user_ids}
+        for rows in self.scatter(fetch, groups).values():
+            for user_id, message_id in rows:
+                liked[user_id].append(message_id)
+        return liked
+
+    def liked_messages(self, user_id, before=None, limit=None):
+        """Like Message.liked_by: messages `user_id` has liked, newest first."""
+
+        query = select([likes.c.message_id, likes.c.author_id]).where(likes.c.user_id == user_id)
+        if before is not None:
+            query = query.where(likes.c.message_id < before)
+        query = query.order_by(likes.c.message_id.desc()).limit(limit)
+
+        with self.engine_for(user_id).connect() as conn:
+            liked = conn.execute(query).fetchall()
+
+        by_shard = {}
+        for message_id, author_id in liked:
+            by_shard.setdefault(self.name_for(author_id), []).append(message_id)
+
+        def fetch(name, engine):
+            with engine.connect() as conn:
+                return conn.execute(select([messages])
+                                    .where(messages.c.id.in_(by_shard[name]))).fetchall()
+
+        found = {row.id: row for rows in self.scatter(fetch, by_shard).values() for row in rows}
+        # liked messages that were archived before sharding was on
+        found.update(_archived(message_id for message_id, _ in liked
+                               if message_id not in found))
+        found.update((row.id, row) for row in
+                     liked_page(ArchivedMessage, ArchivedLike, user_id, before, limit,
+                                MESSAGE_CARD_COLUMNS))
+
+        rows = sorted(found.values(), key=lambda row: row.id, reverse=True)
+        return with_authors(rows[:limit])
+
+    ##########################################################################
+    # Rebalancing
+
+    def misplaced_users(self, name):
+        """Ids of users with rows on shard `name` that belong elsewhere."""
+
+        with self.engines[name].connect() as conn:
+            user_ids = {user_id for (user_id,) in
+                        conn.execute(select([messages.c.user_id]).distinct())}
+            user_ids.update(user_id for (user_id,) in
+                            conn.execute(select([likes.c.user_id]).distinct()))
+        return sorted(user_id for user_id in user_ids if self.name_for(user_id) != name)
+
+    def move_user(self, user_id, source, batch_size=REBALANCE_BATCH_SIZE):
+        """Copy a user's rows from shard `source` to their shard, then delete them.
+
+        Rows already on the target are skipped, so a move that was
+        interrupted can simply be run again. Returns the number of rows copied.
+        """
+
+        source_engine = self.engines[source]
+        target_engine = self.engine_for(user_id)
+        copied = 0
+
+        for table in (messages, likes):
+            last_id = 0
+            while True:
+                with source_engine.connect() as conn:
+                    rows = conn.execute(select([table])
+                                        .where(and_(table.c.user_id == user_id,
+                                                    table.c.id > last_id))
+                                        .order_by(table.c.id)
+                                        .limit(batch_size)).fetchall()
+                if not rows:
+                    break
+
+                ids = [row.id for row in rows]
+                with target_engine.begin() as conn:
+                    present = {row_id for (row_id,) in conn.execute(
+                        select([table.c.id]).where(table.c.id.in_(ids)))}
+                    new_rows = [dict(row._mapping) if hasattr(row, '_mapping') else dict(row)
+                                for row in rows if row.id not in present]
+                    if new_rows:
+                        conn.execute(table.insert(), new_rows)
+
+                copied += len(new_rows)
+                last_id = ids[-1]
+
+        with source_engine.begin() as conn:
+            for table in (messages, likes):
+                conn.execute(table.delete().where(table.c.user_id == user_id))
+
+        return copied
+
+    def rebalance(self, batch_size=REBALANCE_BATCH_SIZE):
+        """Move every user's rows to the shard the ring puts them on.
+
+        Returns {shard name: rows moved off it}.
+        """
+
+        moved = {}
+        for name in self.engines:
+            moved[name] = sum(self.move_user(user_id, name, batch_size)
+                              for user_id in self.misplaced_users(name))
+        return moved
+
+    ##########################################################################
+    # Moving in from the main database
+
+    def move_from_main(self, batch_size=REBALANCE_BATCH_SIZE):
+        """Move the main database's messages and likes to their shards.
+
+        Likes are copied first (with new ids from the likes allocator),
+        then messages are copied and deleted from the main database a
+        batch at a time, their likes with them. Rows already on their
+        shard are skipped, so an interrupted move can simply be run again.
+        Returns {'messages': rows copied, 'likes': rows copied}.
+        """
+
+        copied = {'messages': 0, 'likes': 0}
+
+        last_id = 0
+        while True:
+            rows = (db.session
+                      .query(Likes.id, Likes.user_id, Likes.message_id,
+                             Message.user_id.label('author_id'))
+                      .join(Message, Message.id == Likes.message_id)
+                      .filter(Likes.id > last_id)
+                      .order_by(Likes.id)
+                      .limit(batch_size)
+                      .all())
+            if not rows:
+                break
+
+            for name, group in self.group_rows(rows).items():
+                with self.engines[name].begin() as conn:
+                    present = set(conn.execute(
+                        select([likes.c.user_id, likes.c.message_id])
+                        .where(likes.c.message_id.in_([row.message_id for row in group]))
+                        .where(likes.c.user_id.in_({row.user_id for row in group}))))
+                    new_rows = [{'id': self.like_ids.next_id(), 'user_id': row.user_id,
+                                 'message_id': row.message_id, 'author_id': row.author_id}
+                                for row in group
+                                if (row.user_id, row.message_id) not in present]
+                    if new_rows:
+                        conn.execute(likes.insert(), new_rows)
+                copied['likes'] += len(new_rows)
+            last_id = rows[-1].id
+
+        while True:
+            rows = (db.session
+                      .query(*[getattr(Message, column) for column in MESSAGE_CARD_COLUMNS])
+                      .order_by(Message.id)
+                      .limit(batch_size)
+                      .all())
+            if not rows:
+                break
+
+            for name, group in self.group_rows(rows).items():
+                with self.engines[name].begin() as conn:
+                    present = {row_id for (row_id,) in conn.execute(
+                        select([messages.c.id])
+                        .where(messages.c.id.in_([row.id for row in group])))}
+                    new_rows = [{'id': row.id, 'text': row.text, 'timestamp': row.timestamp,
+                                 'user_id': row.user_id}
+                                for row in group if row.id not in present]
+                    if new_rows:
+                        conn.execute(messages.insert(), new_rows)
+                copied['messages'] += len(new_rows)
+
+            ids = [row.id for row in rows]
+            Likes.query.filter(Likes.message_id.in_(ids)).delete(synchronize_session=False)
+            Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+        return copied
+
+
+def connect(urls, id_engine):
+    """Shards for SHARD_URLS-style {name: url}, or None if there are none."""
+
+    if not urls:
+        return None
+    shards = Shards(urls, id_engine)
+    shards.create_all()
+    return shards
+
+
+def init_app(app, id_engine):
+    """Connect `app` to the shards in its SHARDS config (None: sharding is off)."""
+
+    app.extensions['shards'] = connect(app.config['SHARDS'], id_engine)
+
+
+def current():
+    """The current app's `Shards`, or None if sharding is off."""
+
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('shards')
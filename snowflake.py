@@ -0,0 +1,152 @@
+"""Time-ordered 64-bit message ids ("snowflakes").
+
+An id packs, from the top bit down:
+
+    41 bits  milliseconds since EPOCH (good until 2079)
+    10 bits  worker id
+    12 bits  sequence number within the millisecond
+
+so ids are unique without asking the database, and sort by creation
+time: ordering, paging cursors and the archive's monthly partitions can
+all work off the primary key, and a message's time can be read back from
+its id (`timestamp_of`).
+
+Every process writing at the same time needs a different worker id. It
+comes from SNOWFLAKE_WORKER_ID, or else is leased when the process first
+needs one, from the counter that `configure()` was given (the app counts
+in the `id_blocks` table). Leases go round modulo 1024, so two processes
+only share a worker id if one is still writing after 1023 later ones have
+started. With neither, making an id raises rather than guess.
+
+Ids from before the switch are small serial numbers; they sort before
+every snowflake, which is also when they were written. `is_snowflake`
+tells which ids can be read as a time.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+EPOCH = datetime(2010, 1, 1)
+_EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+_TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+def make_id(ms, worker=0, sequence=0):
+    """The id for millisecond `ms` (since EPOCH), `worker` and `sequence`."""
+
+    return (ms << _TIME_SHIFT) | (worker << SEQUENCE_BITS) | sequence
+
+
+def id_at(dt, worker=0, sequence=0):
+    """An id for naive UTC datetime `dt`, e.g. to import old messages."""
+
+    return make_id(int((dt - EPOCH).total_seconds() * 1000), worker, sequence)
+
+
+# made after this (ids for imported messages may be older, which only means
+# they don't count); no serial id gets anywhere near it
+FIRST_SNOWFLAKE = id_at(datetime(2025, 1, 1))
+
+
+def is_snowflake(id):
+    return id >= FIRST_SNOWFLAKE
+
+
+def timestamp_of(id):
+    """When snowflake `id` was made, as a naive UTC datetime (to the ms)."""
+
+    return EPOCH + timedelta(milliseconds=id >> _TIME_SHIFT)
+
+
+class Snowflake:
+    """Makes ids for one worker."""
+
+    def __init__(self, worker):
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError(f"worker id must be 0-{MAX_WORKER}, not {worker}")
+        self.worker = worker
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _now_ms(self):
+        return int(time.time() * 1000) - _EPOCH_MS
+
+    def next_id(self):
+        with self._lock:
+            # never go back in time, even if the clock does
+            ms = max(self._now_ms(), self._last_ms)
+
+            if ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 4096 ids this millisecond already: wait for the next
+                    while ms <= self._last_ms:
+                        time.sleep(0.0001)
+                        ms = max(self._now_ms(), ms)
+            else:
+                self._sequence = 0
+
+            self._last_ms = ms
+            return make_id(ms, self.worker, self._sequence)
+
+
+# returns a new number each call, shared by every process (see configure())
+_lease = None
+
+
+def configure(lease):
+    """Lease worker ids from `lease()` when SNOWFLAKE_WORKER_ID isn't set."""
+
+    global _lease
+    _lease = lease
+
+
+def _default_worker():
+    worker = os.environ.get('SNOWFLAKE_WORKER_ID')
+    if worker:
+        return int(worker)
+    if _lease is None:
+        raise RuntimeError("No snowflake worker id: set SNOWFLAKE_WORKER_ID, "
+                           "or lease one with snowflake.configure()")
+    return _lease() & MAX_WORKER
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+
+
+def start():
+    """Make this process's generator now, leasing its worker id if need be.
+
+    next_id() would otherwise do it on first use, which may be in the
+    middle of a database transaction; gunicorn.conf.py calls this as each
+    worker boots.
+    """
+
+    global _generator, _generator_pid
+
+    # a forked worker mustn't share its parent's worker id and sequence
+    if _generator_pid != os.getpid():
+        with _generator_lock:
+            if _generator_pid != os.getpid():
+                _generator = Snowflake(_default_worker())
+                _generator_pid = os.getpid()
+    return _generator
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    return start().next_id()
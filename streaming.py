@@ -0,0 +1,52 @@
+"""Templates rendered a chunk at a time, for long list pages.
+
+`render_template` builds the whole page as one string before the first
+byte goes out. `stream_template` returns a response that renders while it
+sends: the top of the page (header, nav, styles) leaves as soon as it's
+rendered, and memory holds one chunk of HTML rather than the whole page.
+
+Pair it with a query that streams too (see `stream_query`), or the rows
+are still all loaded up front. Since the page is rendered after the view
+returns, errors partway through can't become an error page; render
+anything that can fail before returning.
+"""
+
+from flask import Response, current_app, stream_with_context
+
+
+# Jinja yields a piece per tag and text run; send roughly this many
+# characters at a time instead
+STREAM_CHUNK_SIZE = 8 * 1024
+
+STREAM_BATCH_SIZE = 500
+
+
+def _chunks(pieces, size):
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_template(template_name, **context):
+    """Like `render_template`, but streams the rendered page."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    pieces = _chunks(template.generate(context), STREAM_CHUNK_SIZE)
+    return Response(stream_with_context(pieces), mimetype='text/html')
+
+
+def stream_query(query, batch_size=STREAM_BATCH_SIZE):
+    """Iterate `query` with a server-side cursor, `batch_size` rows at a time."""
+
+    return query.execution_options(stream_results=True).yield_per(batch_size)
@@ -0,0 +1,127 @@
+"""Admission control and metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import admission
+import metrics
+from admission import AdmissionController, DEFAULT_LIMITS
+
+db.create_all()
+
+
+class AdmissionControllerTestCase(TestCase):
+    """Test deciding which requests get in."""
+
+    def test_in_flight(self):
+        controller = AdmissionController()
+        limits = {'low': (2, 1.0)}
+
+        self.assertTrue(controller.admit('low', limits, now=0))
+        self.assertTrue(controller.admit('low', limits, now=0))
+        self.assertFalse(controller.admit('low', limits, now=0))
+        # no limit for these
+        self.assertTrue(controller.admit('critical', limits, now=0))
+        self.assertEqual(controller.in_flight, 3)
+
+        controller.release()
+        controller.release()
+        self.assertTrue(controller.admit('low', limits, now=0))
+
+    def test_pool_wait(self):
+        controller = AdmissionController()
+        limits = {'low': (100, 0.1)}
+
+        for _ in range(20):
+            controller.record_wait(1.0, now=10)
+        self.assertGreater(controller.pool_wait(now=10), 0.9)
+        self.assertFalse(controller.admit('low', limits, now=10))
+
+        # the average decays once requests stop waiting, or stop coming
+        self.assertAlmostEqual(controller.pool_wait(now=12), controller.pool_wait(now=10) / 2)
+        self.assertTrue(controller.admit('low', limits, now=30))
+
+
+class AdmissionViewsTestCase(TestCase):
+    """Test shedding requests in the app."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u = User.signup("testuser", "test@test.com", "password", None)
+        u.id = 1
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        admission.shed.reset()
+
+    def tearDown(self):
+        app.config['ADMISSION_LIMITS'] = dict(DEFAULT_LIMITS)
+        app.config['ROUTE_PRIORITIES'] = {}
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_in_flight_released(self):
+        self.client.get("/users")
+        self.client.get("/users/1/followers")
+        self.assertEqual(admission.controller.in_flight, 0)
+
+    def test_shed_low_priority(self):
+        # as if the low-priority limit had been reached
+        app.config['ADMISSION_LIMITS'] = {'low': (0, 1.0)}
+
+        resp = self.client.get("/users")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "5")
+        self.assertEqual(self.client.get("/users/1/followers").status_code, 503)
+
+        # the timeline and other pages are still served
+        self.assertEqual(self.client.get("/").status_code, 200)
+        self.assertEqual(self.client.get("/users/1").status_code, 200)
+
+        self.assertEqual(admission.shed.value('low', 'list_users'), 1)
+        self.assertEqual(admission.controller.in_flight, 0)
+
+    def test_route_priorities(self):
+        app.config['ADMISSION_LIMITS'] = {'low': (0, 1.0)}
+        app.config['ROUTE_PRIORITIES'] = {'list_users': 'critical',
+                                          'users_show': 'low'}
+
+        self.assertEqual(self.client.get("/users").status_code, 200)
+        self.assertEqual(self.client.get("/users/1").status_code, 503)
+
+    def test_metrics(self):
+        app.config['ADMISSION_LIMITS'] = {'low': (0, 1.0)}
+        self.client.get("/users")
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        text = resp.get_data(as_text=True)
+        self.assertIn("# TYPE warbler_requests_shed_total counter", text)
+        self.assertIn('warbler_requests_shed_total{priority="low",endpoint="list_users"} 1',
+                      text)
+        self.assertIn("warbler_requests_in_flight 1", text)
+        self.assertIn("warbler_pool_wait_seconds ", text)
+
+    def test_counter(self):
+        count = metrics.counter('test_things_total', "Things.", labels=('kind',))
+        self.assertIs(metrics.counter('test_things_total', "Things."), count)
+        count.inc('a')
+        count.inc('a', amount=2)
+        count.inc('b"c')
+        self.assertEqual(count.value('a'), 3)
+        self.assertIn('test_things_total{kind="b\\"c"} 1', metrics.render())
@@ -0,0 +1,227 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import os
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import msgpack
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import api
+from cache import records
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u1 = User.signup("testuser1", "email1@test.com", "password", None)
+        u1.id = 1111
+        u2 = User.signup("testuser2", "email2@test.com", "password", None)
+        u2.id = 2222
+        db.session.commit()
+
+        db.session.add_all([
+            Message(id=1, text="first", user_id=2222),
+            Message(id=2, text="second", user_id=2222),
+            Follows(user_being_followed_id=2222, user_following_id=1111),
+        ])
+        db.session.commit()
+        db.session.add(Likes(user_id=1111, message_id=1))
+        db.session.commit()
+
+        records.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1111
+
+    def test_unauthorized(self):
+        resp = self.client.get("/api/v1/timeline")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json(), {"error": "Access unauthorized."})
+
+    def test_timeline(self):
+        with self.client as c:
+            self.login(c)
+            data = c.get("/api/v1/timeline").get_json()
+
+        self.assertEqual([m["id"] for m in data["messages"]], [2, 1])
+        self.assertEqual(data["users"]["2222"]["username"], "testuser2")
+
+    def test_timeline_since(self):
+        with self.client as c:
+            self.login(c)
+            data = c.get("/api/v1/timeline?since=1").get_json()
+            self.assertEqual([m["id"] for m in data["messages"]], [2])
+
+            resp = c.get("/api/v1/timeline?since=2")
+            self.assertEqual(resp.status_code, 204)
+
+    def test_field_selection(self):
+        with self.client as c:
+            self.login(c)
+            data = c.get("/api/v1/users?fields=id,username").get_json()
+
+        self.assertEqual(data["users"], [{"id": 1111, "username": "testuser1"},
+                                         {"id": 2222, "username": "testuser2"}])
+
+    def test_msgpack(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/api/v1/users/2222?fields=id,text",
+                         headers={"Accept": "application/msgpack"})
+
+        self.assertEqual(resp.mimetype, "application/msgpack")
+        data = msgpack.unpackb(resp.data)
+        self.assertEqual(data["messages"], [{"id": 2, "text": "second"},
+                                            {"id": 1, "text": "first"}])
+
+    def test_followers_and_following(self):
+        with self.client as c:
+            self.login(c)
+            following = c.get("/api/v1/users/1111/following").get_json()
+            followers = c.get("/api/v1/users/1111/followers").get_json()
+
+        self.assertEqual([u["id"] for u in following["users"]], [2222])
+        self.assertEqual(followers["users"], [])
+
+    def test_message_and_likes(self):
+        with self.client as c:
+            self.login(c)
+            msg = c.get("/api/v1/messages/1").get_json()
+            liked = c.get("/api/v1/users/1111/liked_warbles").get_json()
+            missing = c.get("/api/v1/messages/99")
+
+        self.assertTrue(msg["liked"])
+        self.assertEqual(msg["user"]["username"], "testuser2")
+        self.assertEqual([m["id"] for m in liked["messages"]], [1])
+        self.assertEqual(missing.status_code, 404)
+
+    def test_liked_warbles_paged(self):
+        db.session.add(Likes(user_id=1111, message_id=2))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            first = c.get("/api/v1/users/1111/liked_warbles?limit=1").get_json()
+            rest = c.get("/api/v1/users/1111/liked_warbles?limit=1&before=2").get_json()
+
+        self.assertEqual([m["id"] for m in first["messages"]], [2])
+        self.assertEqual(first["users"]["2222"]["username"], "testuser2")
+        self.assertEqual([m["id"] for m in rest["messages"]], [1])
+
+    def test_limit_at_least_one(self):
+        with self.client as c:
+            self.login(c)
+            zero = c.get("/api/v1/users/1111/liked_warbles?limit=0")
+            negative = c.get("/api/v1/users?limit=-1")
+            trending = c.get("/api/v1/trending?limit=-1")
+
+        self.assertEqual(len(zero.get_json()["messages"]), 1)
+        self.assertEqual(len(negative.get_json()["users"]), 1)
+        self.assertEqual(trending.status_code, 200)
+
+    def test_message_view_leaves_record_alone(self):
+        """Is a batch lookup after a single-message view free of its viewer's keys?"""
+
+        with self.client as c:
+            self.login(c)
+            single = c.get("/api/v1/messages/1").get_json()
+            batch = c.get("/api/v1/messages?ids=1").get_json()
+
+        self.assertTrue(single["liked"])
+        self.assertNotIn("liked", batch["messages"][0])
+        self.assertNotIn("user", batch["messages"][0])
+
+    def test_batch_users(self):
+        with self.client as c:
+            self.login(c)
+            data = c.get("/api/v1/users?ids=2222,99,1111,2222").get_json()
+
+        self.assertEqual([u["id"] for u in data["users"]], [2222, 1111])
+
+    def test_batch_users_unauthorized(self):
+        """Is a batch lookup refused without logging in, like /users/<id>?"""
+
+        resp = self.client.get("/api/v1/users?ids=1111")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(self.client.get("/api/v1/users").status_code, 401)
+
+    def test_batch_messages(self):
+        with self.client as c:
+            self.login(c)
+            data = c.get("/api/v1/messages?ids=2,1&fields=id").get_json()
+            bad = c.get("/api/v1/messages?ids=1,x")
+            too_many = c.get("/api/v1/messages?ids=" +
+                             ",".join(str(i) for i in range(1, 400)))
+
+        self.assertEqual(data["messages"], [{"id": 2}, {"id": 1}])
+        self.assertEqual(bad.status_code, 400)
+        self.assertEqual(too_many.status_code, 400)
+
+    def test_batch_served_from_cache(self):
+        with self.client as c:
+            self.login(c)
+            c.get("/api/v1/users?ids=1111")
+
+            # a cached record comes back without touching the database
+            User.query.filter_by(id=1111).update({"bio": "changed"})
+            db.session.commit()
+            data = c.get("/api/v1/users?ids=1111").get_json()
+
+        self.assertNotEqual(data["users"][0]["bio"], "changed")
+
+    def test_concurrent_misses_load_once(self):
+        """Do requests missing on the same records at once share one query?"""
+
+        loads = []
+
+        def load_users(ids):
+            loads.append(sorted(ids))
+            time.sleep(0.1)
+            return api._load_users(ids)
+
+        results = []
+
+        def request():
+            client = app.test_client()
+            self.login(client)
+            results.append(client.get("/api/v1/users?ids=1111,2222").get_json())
+
+        with patch.dict(api.LOADERS, user=load_users):
+            threads = [threading.Thread(target=request) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(loads, [[1111, 2222]])
+        self.assertEqual(len(results), 5)
+        for data in results:
+            self.assertEqual([user["id"] for user in data["users"]], [1111, 2222])
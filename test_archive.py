@@ -0,0 +1,111 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes, ArchivedMessage, ArchivedLike
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import archive
+from export import export_records
+import snowflake
+
+db.create_all()
+
+
+class ArchiveTestCase(TestCase):
+    """Test moving old messages to the archive and reading them back."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u1 = User.signup("testuser1", "email1@test.com", "password", None)
+        u1.id = 1111
+        u2 = User.signup("testuser2", "email2@test.com", "password", None)
+        u2.id = 2222
+
+        now = datetime.utcnow()
+        self.ids = {}
+        for day in range(150):
+            self.ids[day] = snowflake.id_at(now - timedelta(days=day))
+            db.session.add(Message(id=self.ids[day], text=f"warble {day}", user_id=1111))
+        db.session.commit()
+
+        # someone liked an old message
+        db.session.add(Likes(user_id=2222, message_id=self.ids[120]))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_archive_old_messages(self):
+        """Are messages past the hot window moved, likes and all?"""
+
+        count = archive.archive_messages(batch_size=40)
+
+        self.assertEqual(count, 150 - archive.HOT_WINDOW_DAYS)
+        self.assertEqual(Message.query.count(), archive.HOT_WINDOW_DAYS)
+        self.assertEqual(ArchivedMessage.query.count(), count)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(ArchivedLike.query.one().message_id, self.ids[120])
+
+    def test_timeline_falls_back_to_archive(self):
+        """Does paging past the hot messages continue into the archive?"""
+
+        archive.archive_messages()
+
+        page = Message.timeline(user_ids=[1111])
+        self.assertEqual(len(page), 100)
+        self.assertEqual(page[0].text, "warble 0")
+        self.assertEqual(page[-1].text, "warble 99")
+
+        page = Message.timeline(user_ids=[1111], before=page[-1].id)
+        self.assertEqual(len(page), 50)
+        self.assertEqual(page[0].text, "warble 100")
+        self.assertTrue(all(isinstance(m, ArchivedMessage) for m in page))
+
+    def test_find_archived_message(self):
+        """Can an archived message still be looked up by id?"""
+
+        archive.archive_messages()
+
+        msg = Message.find(self.ids[120])
+        self.assertEqual(msg.text, "warble 120")
+        self.assertEqual([like.user_id for like in msg.likes], [2222])
+
+    def test_export_includes_archive(self):
+        """Are archived messages and likes exported too?"""
+
+        archive.archive_messages()
+
+        records = list(export_records(1111))
+        messages = [r['id'] for r in records if r['type'] == 'message']
+        self.assertEqual(messages, sorted(self.ids.values()))
+
+        records = list(export_records(2222))
+        self.assertEqual([r for r in records if r['type'] == 'like'],
+                         [{'type': 'like', 'id': self.ids[120]}])
+
+    def test_delete_user_removes_archived_likes(self):
+        """Are likes of a deleted user's archived messages deleted too?"""
+
+        archive.archive_messages()
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1111
+        resp = client.post("/users/delete")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(ArchivedMessage.query.count(), 0)
+        self.assertEqual(ArchivedLike.query.count(), 0)
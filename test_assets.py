@@ -0,0 +1,108 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import brotli
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import assets
+
+db.create_all()
+
+
+class AssetsTestCase(TestCase):
+    """Test building, linking and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.dist = tempfile.mkdtemp()
+        self.old_dist = assets.DIST_DIR
+        assets.DIST_DIR = self.dist
+        self.manifest = assets.build(dist_dir=self.dist)
+        assets.load_manifest(self.dist)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        assets.DIST_DIR = self.old_dist
+        assets.load_manifest()
+        shutil.rmtree(self.dist)
+
+    def test_build(self):
+        hashed = self.manifest["stylesheets/style.css"]
+        self.assertRegex(hashed, r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+        self.assertIn("images/warbler-logo.png", self.manifest)
+
+        with open(os.path.join(self.dist, hashed), "rb") as f:
+            original = f.read()
+        with open(os.path.join(self.dist, hashed + ".gz"), "rb") as f:
+            self.assertEqual(gzip.decompress(f.read()), original)
+        with open(os.path.join(self.dist, hashed + ".br"), "rb") as f:
+            self.assertEqual(brotli.decompress(f.read()), original)
+
+        # images aren't worth compressing again
+        logo = self.manifest["images/warbler-logo.png"]
+        self.assertFalse(os.path.exists(os.path.join(self.dist, logo + ".gz")))
+
+    def test_css_urls_fingerprinted(self):
+        with open(os.path.join(self.dist, self.manifest["stylesheets/style.css"])) as f:
+            urls = [url for _, url in assets.CSS_URL_RE.findall(f.read())]
+
+        self.assertIn("/assets/" + self.manifest["images/nav-bg.png"], urls)
+        for url in urls:
+            self.assertRegex(url, r"^/assets/.+\.[0-9a-f]{12}\.\w+$")
+
+    def test_rewrite_css_urls(self):
+        manifest = {"images/a.png": "images/a.0123456789ab.png"}
+        css = ('x { background: url(../images/a.png); }\n'
+               'y { background: url("/static/images/a.png?v=2"); }\n'
+               'z { background: url(data:image/png;base64,AAAA) url(b.png); }')
+
+        self.assertEqual(assets.rewrite_css_urls(css, "stylesheets/s.css", manifest),
+                         'x { background: url("/assets/images/a.0123456789ab.png"); }\n'
+                         'y { background: url("/assets/images/a.0123456789ab.png"); }\n'
+                         'z { background: url(data:image/png;base64,AAAA) url(b.png); }')
+
+    def test_asset_url(self):
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url("stylesheets/style.css"),
+                             "/assets/" + self.manifest["stylesheets/style.css"])
+            self.assertEqual(assets.asset_url("not-built.txt"),
+                             "/static/not-built.txt")
+
+        html = self.client.get("/signup").get_data(as_text=True)
+        self.assertIn("/assets/" + self.manifest["stylesheets/style.css"], html)
+
+    def test_serve(self):
+        url = "/assets/" + self.manifest["stylesheets/style.css"]
+
+        resp = self.client.get(url, headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertEqual(resp.headers["Cache-Control"],
+                         "public, max-age=31536000, immutable")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        resp.close()
+
+        resp = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn(b"body", resp.data)
+        resp.close()
+
+        self.assertEqual(self.client.get(url + ".gz").status_code, 404)
+        self.assertEqual(self.client.get("/assets/manifest.json").status_code, 404)
@@ -0,0 +1,95 @@
+"""Username/email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import availability
+from availability import CountingBloomFilter
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CountingBloomFilterTestCase(TestCase):
+    """Test the filter on its own."""
+
+    def test_add_and_remove(self):
+        bloom = CountingBloomFilter(1000)
+        bloom.add("u:alice")
+
+        self.assertIn("u:alice", bloom)
+        self.assertNotIn("u:bob", bloom)
+
+        bloom.remove("u:alice")
+        self.assertNotIn("u:alice", bloom)
+
+    def test_false_positive_rate(self):
+        bloom = CountingBloomFilter(10_000, error_rate=0.01)
+        for i in range(10_000):
+            bloom.add(f"u:user{i}")
+
+        false_positives = sum(f"u:other{i}" in bloom for i in range(10_000))
+        self.assertLess(false_positives, 300)
+
+
+class AvailabilityTestCase(TestCase):
+    """Test availability checks against the users table."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        availability.load()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_is_taken(self):
+        self.assertTrue(availability.is_taken("testuser", "new@test.com"))
+        self.assertTrue(availability.is_taken("newuser", "test@test.com"))
+        self.assertFalse(availability.is_taken("newuser", "new@test.com"))
+
+    def test_filter_follows_edits_and_deletes(self):
+        user = User.query.filter_by(username="testuser").one()
+        user.username = "renamed"
+        db.session.commit()
+
+        self.assertTrue(availability.might_exist(username="renamed"))
+        self.assertFalse(availability.might_exist(username="testuser"))
+
+        db.session.delete(user)
+        db.session.commit()
+
+        self.assertFalse(availability.might_exist(username="renamed"))
+
+    def test_available_endpoint(self):
+        resp = self.client.get("/signup/available?username=testuser&email=new@test.com")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(), {"username": False, "email": True})
+
+    def test_signup_taken_username(self):
+        resp = self.client.post("/signup", data={
+            "username": "testuser",
+            "email": "other@test.com",
+            "password": "password",
+        })
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Username already taken", resp.data)
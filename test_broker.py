@@ -0,0 +1,125 @@
+"""Pub/sub broker and event stream tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_broker.py
+
+import os
+from unittest import TestCase, skipUnless
+
+import psycopg2
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, broker, CURR_USER_KEY
+from broker import InProcessBroker, PostgresBroker, user_topic
+
+db.create_all()
+
+TEST_DSN = "postgresql:///warbler-test"
+
+
+def postgres_available(dsn):
+    try:
+        psycopg2.connect(dsn).close()
+    except psycopg2.OperationalError:
+        return False
+    return True
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class InProcessBrokerTestCase(TestCase):
+    """Test delivering events within one process."""
+
+    def test_publish_to_subscribers(self):
+        b = InProcessBroker()
+        sub = b.subscribe(["user:1", "user:2"])
+        other = b.subscribe(["user:3"])
+
+        b.publish("user:2", {"id": 10})
+
+        self.assertEqual(sub.get(timeout=1), ("user:2", {"id": 10}))
+        self.assertIsNone(other.get(timeout=0.01))
+
+    def test_unsubscribe(self):
+        b = InProcessBroker()
+        sub = b.subscribe(["user:1"])
+        sub.close()
+
+        b.publish("user:1", {"id": 10})
+        self.assertIsNone(sub.get(timeout=0.01))
+        self.assertEqual(dict(b._subscribers), {})
+
+
+@skipUnless(postgres_available(TEST_DSN), "needs the warbler-test Postgres database")
+class PostgresBrokerTestCase(TestCase):
+    """Test delivering events through LISTEN/NOTIFY."""
+
+    def publish_until_received(self, b, sub, payload):
+        # the listener connects in the background; publish until it's up
+        for _ in range(50):
+            b.publish("user:1", payload)
+            event = sub.get(timeout=0.1)
+            if event:
+                return event
+
+    def test_publish_through_postgres(self):
+        b = PostgresBroker(TEST_DSN)
+        sub = b.subscribe(["user:1"])
+
+        self.assertEqual(self.publish_until_received(b, sub, {"id": 10}),
+                         ("user:1", {"id": 10}))
+
+    def test_listener_reconnects(self):
+        b = PostgresBroker(TEST_DSN)
+        sub = b.subscribe(["user:1"])
+        self.publish_until_received(b, sub, {"id": 10})
+
+        # drop the listener's connection, as a Postgres restart would
+        with b._publish_lock, b._publish_conn.cursor() as cur:
+            cur.execute("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                        "WHERE query = %s", (f"LISTEN {b.CHANNEL}",))
+            self.assertTrue(any(terminated for terminated, in cur))
+
+        self.assertEqual(self.publish_until_received(b, sub, {"id": 11}),
+                         ("user:1", {"id": 11}))
+
+
+class MessageStreamTestCase(TestCase):
+    """Test the server-sent events endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u = User.signup("testuser", "test@test.com", "password", None)
+        u.id = 1111
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_stream_new_message(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            resp = c.get("/messages/stream", buffered=False)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+
+            body = iter(resp.response)
+            self.assertEqual(next(body), b"retry: 5000\n\n")
+
+            broker.publish(user_topic(1111), {"id": 5, "user_id": 1111})
+            self.assertEqual(
+                next(body),
+                b'id: 5\nevent: message\ndata: {"id": 5, "user_id": 1111}\n\n')
+
+            resp.close()
@@ -0,0 +1,212 @@
+"""In-process cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import cache
+from cache import SingleFlight, SQLiteStore, TieredCache, TTLCache
+
+
+class TTLCacheTestCase(TestCase):
+    """Test expiry, eviction and loading on a miss."""
+
+    def test_expiry_and_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        self.assertIsNone(cache.get('b'))
+
+        cache.set('c', 3)
+        cache.get('a')
+        cache.set('d', 4)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertNotIn('c', cache)
+
+    def test_get_or_load(self):
+        cache = TTLCache()
+        loads = []
+
+        def load():
+            loads.append(1)
+            return 'value'
+
+        self.assertEqual(cache.get_or_load('key', load), 'value')
+        self.assertEqual(cache.get_or_load('key', load), 'value')
+        self.assertEqual(len(loads), 1)
+
+    def test_concurrent_misses_load_once(self):
+        cache = TTLCache()
+        loads = []
+        results = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('key', load)))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, ['value'] * 10)
+
+
+class SingleFlightTestCase(TestCase):
+    """Test that waiting callers share the running call's outcome."""
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            time.sleep(0.05)
+            raise ValueError("boom")
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    def test_next_call_runs_again(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+
+
+class TieredCacheTestCase(TestCase):
+    """Test two workers' caches sharing a store."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'cache.sqlite')
+        # two workers, each with its own connection to the store
+        self.a = TieredCache('test', ttl=60, store=SQLiteStore(path))
+        self.b = TieredCache('test', ttl=60, store=SQLiteStore(path))
+        for counter in (cache.hits, cache.misses, cache.evictions, cache.invalidations):
+            counter.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sync(self, worker):
+        worker._synced_at = 0.0
+        worker._sync()
+
+    def test_shared_hit(self):
+        self.assertIsNone(self.b.get('user:1'))
+        self.a.set('user:1', {'username': "one"})
+
+        self.assertEqual(self.b.get('user:1'), {'username': "one"})
+        self.assertEqual(self.b.get('user:1'), {'username': "one"})
+
+        self.assertEqual(cache.hits.value('test', 'user', 'shared'), 1)
+        self.assertEqual(cache.hits.value('test', 'user', 'local'), 1)
+        self.assertEqual(cache.misses.value('test', 'user'), 1)
+
+    def test_invalidate_tag(self):
+        self.sync(self.b)
+        self.a.set('user:1', "one")
+        self.a.set('message:5', "hello", tags=['user:1'])
+        self.a.set('message:6', "other", tags=['user:2'])
+        # b copies them into its LRU
+        for key in ('user:1', 'message:5', 'message:6'):
+            self.b.get(key)
+
+        self.a.invalidate('user:1')
+
+        self.assertIsNone(self.a.get('message:5'))
+        self.assertEqual(self.a.get('message:6'), "other")
+        # b drops its copies once it reads the invalidation log
+        self.assertEqual(self.b.local.get('message:5'), "hello")
+        self.sync(self.b)
+        self.assertIsNone(self.b.get('message:5'))
+        self.assertIsNone(self.b.get('user:1'))
+        self.assertEqual(self.b.get('message:6'), "other")
+        self.assertEqual(cache.invalidations.value('test', 'user'), 1)
+
+    def test_evictions(self):
+        small = TieredCache('test', maxsize=2)
+        for n in range(5):
+            small.set(f'user:{n}', n)
+
+        self.assertEqual(cache.evictions.value('test', 'user'), 3)
+        self.assertEqual(len(small._tags), 2)
+
+    def test_get_or_load(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            return "loaded"
+
+        self.assertEqual(self.a.get_or_load('user:1', load), "loaded")
+        self.assertEqual(self.b.get_or_load('user:1', load), "loaded")
+        self.assertEqual(len(loads), 1)
+
+    def test_concurrent_batch_misses_load_once(self):
+        loads = []
+        results = []
+
+        def load(keys):
+            loads.append(sorted(keys))
+            time.sleep(0.05)
+            return {key: key.upper() for key in keys if key != 'user:3'}
+
+        def lookup(keys):
+            results.append(self.a.get_many_or_load(keys, load))
+
+        threads = [threading.Thread(target=lookup, args=(['user:1', 'user:2', 'user:3'],))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(loads, [['user:1', 'user:2', 'user:3']])
+        self.assertEqual(results, [{'user:1': 'USER:1', 'user:2': 'USER:2'}] * 10)
+
+        # only the misses are loaded
+        found = self.a.get_many_or_load(['user:1', 'user:4'], load)
+        self.assertEqual(found, {'user:1': 'USER:1', 'user:4': 'USER:4'})
+        self.assertEqual(loads[-1], ['user:4'])
+
+    def test_store_failure(self):
+        self.a.store = SQLiteStore(os.path.join(self.dir, 'missing', 'cache.sqlite'))
+
+        self.a.set('user:1', "one")
+        self.assertEqual(self.a.get('user:1'), "one")
+        self.a.invalidate('user:1')
+        self.assertIsNone(self.a.get('user:1'))
+
+    def test_create_store(self):
+        self.assertIsNone(cache.create_store('memory://'))
+        self.assertIsInstance(cache.create_store('sqlite:///' + os.path.join(self.dir, 'x')),
+                              SQLiteStore)
+        with self.assertRaises(ValueError):
+            cache.create_store('redis://localhost')
@@ -0,0 +1,78 @@
+"""User and message card tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cards.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+import cards
+
+
+class CardsTestCase(TestCase):
+    """Test loading cards without model objects."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.drop_all()
+        db.create_all()
+
+        self.u1 = User.signup("testuser1", "test1@test.com", "password", None)
+        self.u2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id = self.u1.id, self.u2.id
+
+        db.session.add_all([Message(text="first", user_id=self.u1_id),
+                            Message(text="second", user_id=self.u2_id),
+                            Follows(user_being_followed_id=self.u1_id,
+                                    user_following_id=self.u2_id)])
+        db.session.commit()
+        db.session.expunge_all()
+
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_user_cards(self):
+        found = list(cards.user_cards(User.query.order_by(User.id)))
+
+        self.assertEqual([card.username for card in found], ["testuser1", "testuser2"])
+        self.assertIsInstance(found[0], cards.UserCard)
+        # nothing was loaded into the session
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_timeline(self):
+        page = cards.timeline(user_ids=[self.u1_id, self.u2_id])
+
+        self.assertEqual([msg.text for msg in page], ["second", "first"])
+        self.assertEqual(page[0].user, cards.Author(self.u2_id, "testuser2",
+                                                    User.image_url.default.arg))
+        self.assertEqual(len(db.session.identity_map), 0)
+
+        older = cards.timeline(user_ids=[self.u1_id, self.u2_id], before=page[0].id)
+        self.assertEqual([msg.text for msg in older], ["first"])
+
+    def test_list_pages(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.get("/users")
+        self.assertIn(b"@testuser2", resp.data)
+
+        resp = self.client.get(f"/users/{self.u2_id}/following")
+        self.assertIn(b"@testuser1", resp.data)
+
+        resp = self.client.get(f"/users/{self.u1_id}/followers")
+        self.assertIn(b"@testuser2", resp.data)
@@ -0,0 +1,102 @@
+"""Response compression middleware tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+import gzip
+import os
+import zlib
+from unittest import TestCase
+
+import brotli
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from compression import CompressionMiddleware, negotiate
+
+db.create_all()
+
+
+def wsgi_app(chunks, content_type='text/html', headers=()):
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', content_type), *headers])
+        return iter(chunks)
+    return application
+
+
+def call(application, accept_encoding='gzip'):
+    """(headers, chunks) from calling `application` through the middleware."""
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started.update(headers)
+
+    environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': accept_encoding}
+    body = CompressionMiddleware(application)(environ, start_response)
+    chunks = list(body)
+    return started, chunks
+
+
+class CompressionTestCase(TestCase):
+    """Test negotiating and compressing responses."""
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate("gzip, deflate, br"), "br")
+        self.assertEqual(negotiate("gzip"), "gzip")
+        self.assertEqual(negotiate("br;q=0, gzip;q=0.5"), "gzip")
+        self.assertEqual(negotiate("*"), "br")
+        self.assertIsNone(negotiate("identity"))
+        self.assertIsNone(negotiate(""))
+        self.assertIsNone(negotiate(None))
+
+    def test_gzip_streamed(self):
+        chunks = [b"<p>%d</p>" % n * 100 for n in range(5)]
+        headers, out = call(wsgi_app(chunks))
+
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(b''.join(out)), b''.join(chunks))
+
+        # each chunk is flushed, so the first decodes before the rest arrive
+        decoder = zlib.decompressobj(31)
+        self.assertEqual(decoder.decompress(out[0]), chunks[0])
+
+    def test_brotli(self):
+        chunks = [b"hello world " * 100]
+        headers, out = call(wsgi_app(chunks), "br, gzip")
+
+        self.assertEqual(headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(b''.join(out)), chunks[0])
+
+    def test_skipped(self):
+        body = [b"x" * 1000]
+        cases = [
+            wsgi_app(body, headers=[('Content-Encoding', 'br')]),
+            wsgi_app(body, content_type='image/png'),
+            wsgi_app(body, content_type='text/event-stream'),
+            wsgi_app([b"tiny"], headers=[('Content-Length', '4')]),
+        ]
+        for application in cases:
+            headers, out = call(application)
+            self.assertNotEqual(headers.get('Content-Encoding'), 'gzip')
+            self.assertEqual(b''.join(out), b"tiny" if len(out[0]) == 4 else body[0])
+
+        headers, out = call(wsgi_app(body), "identity")
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(out, body)
+
+    def test_app(self):
+        client = app.test_client()
+
+        resp = client.get("/signup", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"</html>", gzip.decompress(resp.data))
+
+        resp = client.get("/signup")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn(b"</html>", resp.data)
@@ -0,0 +1,111 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_entities.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, MessageTag, Mention
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import entities
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class EntitiesTestCase(TestCase):
+    """Test indexing hashtags and mentions and paging through them."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u1 = User.signup("testuser1", "email1@test.com", "password", None)
+        u1.id = 1111
+        u2 = User.signup("testuser2", "email2@test.com", "password", None)
+        u2.id = 2222
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_parse(self):
+        text = "#Flask and #flask, not a#tag; hi @testuser2 and @nobody"
+
+        self.assertEqual(entities.parse_tags(text), ["flask"])
+        self.assertEqual(entities.parse_mentions(text), ["testuser2", "nobody"])
+
+    def test_linkify(self):
+        html = entities.linkify("<b>#Hi</b> it's @testuser2")
+
+        self.assertEqual(html, '&lt;b&gt;<a href="/tags/hi">#Hi</a>&lt;/b&gt; it&#39;s '
+                               '<a href="/users?q=testuser2">@testuser2</a>')
+
+    def test_index_on_post(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+            c.post("/messages/new", data={"text": "#python rocks @testuser2"})
+
+        msg = Message.query.one()
+        self.assertEqual([(t.tag, t.message_id) for t in MessageTag.query],
+                         [("python", msg.id)])
+        self.assertEqual([(m.user_id, m.message_id) for m in Mention.query],
+                         [(2222, msg.id)])
+
+    def test_feeds(self):
+        for n in range(1, 6):
+            msg = Message(id=n, text=f"#news item {n} for @testuser2", user_id=1111)
+            entities.index_message(msg)
+            db.session.add(msg)
+        db.session.commit()
+
+        page = entities.tagged("NEWS", limit=2)
+        self.assertEqual([m.id for m in page], [5, 4])
+        page = entities.tagged("news", before=4, limit=2)
+        self.assertEqual([m.id for m in page], [3, 2])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2222
+            html = c.get("/mentions").get_data(as_text=True)
+            data = c.get("/api/v1/tags/news?before=2").get_json()
+
+        self.assertIn("item 5", html)
+        self.assertEqual([m["id"] for m in data["messages"]], [1])
+
+    def test_deleted_message(self):
+        msg = Message(id=1, text="#gone", user_id=1111)
+        entities.index_message(msg)
+        db.session.add(msg)
+        db.session.commit()
+
+        db.session.delete(msg)
+        db.session.commit()
+        self.assertEqual(MessageTag.query.count(), 0)
+
+    def test_backfill(self):
+        db.session.add_all([
+            Message(id=1, text="old #Backlog warble", user_id=1111),
+            Message(id=2, text="hey @testuser1", user_id=2222),
+            Message(id=3, text="nothing", user_id=2222),
+        ])
+        db.session.commit()
+
+        self.assertEqual(entities.backfill(batch_size=2), 3)
+        # a rerun changes nothing
+        self.assertEqual(entities.backfill(batch_size=2), 3)
+
+        self.assertEqual([(t.tag, t.message_id) for t in MessageTag.query],
+                         [("backlog", 1)])
+        self.assertEqual([m.id for m in entities.mentioning(1111)], [2])
@@ -0,0 +1,61 @@
+"""Form validation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_forms.py
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from forms import UserAddForm
+import deliverability
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class EmailValidatorTestCase(TestCase):
+    """Test email validation without DNS lookups."""
+
+    def validate(self, email):
+        with app.test_request_context(method="POST", data={
+            "username": "testuser",
+            "email": email,
+            "password": "password",
+        }):
+            form = UserAddForm()
+            return form.validate(), form.email.errors
+
+    def tearDown(self):
+        app.config['EMAIL_DELIVERABILITY_POLICY'] = 'warn'
+        deliverability._results.clear()
+
+    def test_bad_syntax(self):
+        app.config['EMAIL_DELIVERABILITY_POLICY'] = 'ignore'
+        valid, errors = self.validate("not-an-email")
+
+        self.assertFalse(valid)
+        self.assertIn("Invalid email address.", errors[0])
+
+    def test_syntax_only(self):
+        app.config['EMAIL_DELIVERABILITY_POLICY'] = 'ignore'
+        valid, errors = self.validate("someone@no-such-domain-for-warbler.com")
+
+        self.assertTrue(valid)
+
+    def test_reject_known_undeliverable(self):
+        app.config['EMAIL_DELIVERABILITY_POLICY'] = 'reject'
+        deliverability._results.set("bad.example", False)
+
+        valid, errors = self.validate("someone@bad.example")
+        self.assertFalse(valid)
+        self.assertIn("does not accept email", errors[0])
+
+    def test_warn_accepts_known_undeliverable(self):
+        app.config['EMAIL_DELIVERABILITY_POLICY'] = 'warn'
+        deliverability._results.set("bad.example", False)
+
+        valid, errors = self.validate("someone@bad.example")
+        self.assertTrue(valid)
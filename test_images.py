@@ -0,0 +1,159 @@
+"""Image derivative tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+import os
+import shutil
+import socket
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import images
+
+db.create_all()
+
+
+class ImagesTestCase(TestCase):
+    """Test deriving resized images and the attributes templates emit."""
+
+    def setUp(self):
+        self.derived = tempfile.mkdtemp()
+        self.old_dir = images.DERIVED_DIR
+        images.DERIVED_DIR = self.derived
+        images._digests.clear()
+        images._failed.clear()
+
+    def tearDown(self):
+        images.DERIVED_DIR = self.old_dir
+        images._digests.clear()
+        shutil.rmtree(self.derived)
+
+    def test_derive(self):
+        url = "/static/images/warbler-hero.jpg"
+        digest = images.derive(url)
+
+        self.assertEqual(images.digest_for(url), digest)
+
+        thumb = Image.open(os.path.join(self.derived, f"{digest}-thumb@2x.webp"))
+        self.assertEqual(thumb.size, (144, 144))
+        header = Image.open(os.path.join(self.derived, f"{digest}-header@1x.jpg"))
+        self.assertEqual(header.size, (1200, 400))
+
+        # the derived files are a fraction of the original
+        original = os.path.getsize("static/images/warbler-hero.jpg")
+        self.assertLess(os.path.getsize(thumb.filename), original / 20)
+
+    def test_small_source_not_upscaled(self):
+        # default-pic.png is smaller than the 2x avatar
+        digest = images.derive("/static/images/default-pic.png")
+        source = Image.open("static/images/default-pic.png")
+        avatar = Image.open(os.path.join(self.derived, f"{digest}-avatar@2x.jpg"))
+
+        self.assertLessEqual(avatar.width, source.width)
+        self.assertEqual(avatar.width, avatar.height)
+
+    def test_refuses_private_urls(self):
+        for url in ["http://127.0.0.1/a.png", "file:///etc/passwd",
+                    "/static/../app.py"]:
+            with self.assertRaises(ValueError):
+                images.fetch(url)
+
+    def test_refuses_host_resolving_to_private_address(self):
+        private = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.5', 80))]
+
+        with patch.object(images.socket, 'getaddrinfo', return_value=private), \
+                patch.object(images.socket, 'create_connection') as connect:
+            with self.assertRaises(ValueError):
+                images.fetch("http://images.example/a.png")
+
+        connect.assert_not_called()
+
+    def test_refuses_redirect_to_private_address(self):
+        getaddrinfo = socket.getaddrinfo
+
+        def resolve(host, port, *args, **kwargs):
+            if host == "images.example":
+                return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('8.8.8.8', port))]
+            return getaddrinfo(host, port, *args, **kwargs)
+
+        # the public server answers with a redirect to localhost
+        server, client = socket.socketpair()
+        server.sendall(b"HTTP/1.1 302 Found\r\n"
+                       b"Location: http://localhost/secret.png\r\n"
+                       b"Content-Length: 0\r\n\r\n")
+
+        with patch.object(images.socket, 'getaddrinfo', side_effect=resolve), \
+                patch.object(images.socket, 'create_connection',
+                             return_value=client) as connect:
+            with self.assertRaises(ValueError):
+                images.fetch("http://images.example/a.png")
+
+        server.close()
+        # connected once, to the address that was checked
+        connect.assert_called_once_with(('8.8.8.8', 80), images.FETCH_TIMEOUT)
+
+    def test_image_attrs(self):
+        url = "/static/images/default-pic.png"
+
+        with app.test_request_context(headers={"Accept": "image/webp,*/*"}):
+            self.assertEqual(images.image_attrs(url, "thumb"), f'src="{url}"')
+
+            # as the background worker would (writes are atomic, so racing
+            # it is harmless)
+            digest = images.derive(url)
+            self.assertEqual(
+                images.image_attrs(url, "thumb"),
+                f'src="/static/derived/{digest}-thumb@1x.webp" '
+                f'srcset="/static/derived/{digest}-thumb@1x.webp 1x, '
+                f'/static/derived/{digest}-thumb@2x.webp 2x"')
+
+        with app.test_request_context():
+            self.assertIn("-thumb@1x.jpg", images.image_attrs(url, "thumb"))
+
+    def test_vary_accept(self):
+        """Are pages whose images depend on Accept sent with Vary: Accept?"""
+
+        url = "/static/images/default-pic.png"
+        images.derive(url)
+
+        with app.test_request_context(headers={"Accept": "image/webp,*/*"}):
+            resp = app.process_response(app.make_response("no images"))
+            self.assertNotIn("Accept", resp.headers.get("Vary", ""))
+
+        with app.test_request_context(headers={"Accept": "image/webp,*/*"}):
+            images.image_attrs(url, "thumb")
+            resp = app.process_response(app.make_response("a page"))
+            self.assertIn("Accept", resp.headers["Vary"])
+
+    def test_vary_accept_streamed(self):
+        """Do streamed list pages, rendered after the response is made, vary too?"""
+
+        images.derive("/static/images/default-pic.png")
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            user = User.signup("testuser", "test@test.com", "password", None)
+            db.session.commit()
+            user_id = user.id
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        resp = client.get("/users", headers={"Accept": "image/webp,*/*"})
+
+        self.assertIn(".webp", resp.get_data(as_text=True))
+        self.assertIn("Accept", resp.headers["Vary"])
+
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
@@ -21,6 +21,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from cache import records
+import ratelimit
+import viewer_state
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -39,8 +42,14 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        db.drop_all()
+        db.create_all()
+
+        # ids are reused once the tables are recreated; don't let another
+        # test's cached users, viewer states or rate limits leak in
+        records.clear()
+        viewer_state._states.clear()
+        ratelimit.configure("memory://")
 
         self.client = app.test_client()
 
@@ -50,6 +59,8 @@ class MessageViewTestCase(TestCase):
                                     image_url=None)
 
         db.session.commit()
+        # the session (and so self.testuser) is reset after each request
+        self.testuser_id = self.testuser.id
 
     def tearDown(self):
         """Clean up after tests."""
@@ -65,7 +76,7 @@ class MessageViewTestCase(TestCase):
 
         with self.client as c:
             with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.testuser.id
+                sess[CURR_USER_KEY] = self.testuser_id
 
             # session setting is saved,
             # rest of test
@@ -82,7 +93,7 @@ class MessageViewTestCase(TestCase):
         """Test if a user can view a message after adding it."""
         with self.client as c:
             with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.testuser.id
+                sess[CURR_USER_KEY] = self.testuser_id
 
             # Create a message
             c.post("/messages/new", data={"text": "Hello"})
@@ -96,7 +107,7 @@ class MessageViewTestCase(TestCase):
         """Test if a user can delete their message."""
         with self.client as c:
             with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.testuser.id
+                sess[CURR_USER_KEY] = self.testuser_id
 
             # Create a message to delete
             c.post("/messages/new", data={"text": "This will be deleted"})
@@ -110,9 +121,44 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)  # Should redirect after deletion
             self.assertIsNone(Message.query.get(msg_id))  # Ensure the message is gone
 
+    def test_view_missing_message(self):
+        """Does a message id that doesn't exist give a 404?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/messages/999999")
+
+            self.assertEqual(resp.status_code, 404)
+
     def test_add_message_unauthenticated(self):
         """Test adding a message without being logged in."""
         resp = self.client.post("/messages/new", data={"text": "Hello"})
 
         # Expect a redirect to the login or an error page
         self.assertEqual(resp.status_code, 302)  # Redirect for unauthenticated access
+
+    def test_homepage_since(self):
+        """Does polling with `since` return only newer messages as JSON?"""
+        uid = self.testuser_id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid
+
+            c.post("/messages/new", data={"text": "first"})
+            first_id = Message.query.one().id
+            c.post("/messages/new", data={"text": "second"})
+
+            resp = c.get(f"/?since={first_id}&format=json")
+            self.assertEqual(resp.status_code, 200)
+
+            data = resp.get_json()
+            self.assertEqual([m["text"] for m in data["messages"]], ["second"])
+            self.assertEqual(data["users"][str(uid)]["username"], "testuser")
+
+            newest_id = data["messages"][-1]["id"]
+            resp = c.get(f"/?since={newest_id}",
+                         headers={"Accept": "application/json"})
+            self.assertEqual(resp.status_code, 204)
+            self.assertEqual(resp.data, b"")
@@ -0,0 +1,68 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+import migrations
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+
+class MigrationsTestCase(TestCase):
+    """Test applying migrations and checking query plans."""
+
+    def setUp(self):
+        # SQLite picks indexes regardless of table size, which makes
+        # the plan checks deterministic
+        self.engine = create_engine('sqlite://')
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        self.engine.dispose()
+
+    def test_upgrade_applies_all_once(self):
+        """Does upgrade apply every migration, then nothing the second time?"""
+
+        applied = migrations.upgrade(self.engine)
+        self.assertEqual([m.version for m in applied],
+                         [m.version for m in migrations.MIGRATIONS])
+        self.assertEqual(migrations.upgrade(self.engine), [])
+
+        with self.engine.connect() as conn:
+            version = migrations.current_version(conn)
+        self.assertEqual(version, migrations.MIGRATIONS[-1].version)
+
+    def test_upgrade_creates_indexes(self):
+        """Are the performance indexes created?"""
+
+        migrations.upgrade(self.engine)
+        names = [ix['name'] for ix in inspect(self.engine).get_indexes('messages')]
+
+        self.assertIn('ix_messages_timestamp', names)
+        self.assertIn('ix_messages_user_id_id', names)
+
+    def test_verify_indexes_passes(self):
+        """Do all hot queries use an index after upgrading?"""
+
+        migrations.upgrade(self.engine)
+        self.assertEqual(migrations.verify_indexes(self.engine, min_rows=0), [])
+
+    def test_verify_indexes_reports_missing_index(self):
+        """Is a sequential scan reported when an index is missing?"""
+
+        # the baseline tables, before migration 2 indexed them
+        migrations.upgrade(self.engine, target=1)
+
+        problems = migrations.verify_indexes(self.engine, min_rows=0)
+        # viewer state reads likes by user, which ix_likes_user_id_message_id covers
+        self.assertIn(('homepage', 'likes', 0), problems)
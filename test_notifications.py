@@ -0,0 +1,118 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Notification
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import notifications
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class NotificationsTestCase(TestCase):
+    """Test queueing, coalescing and reading notifications."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        notifications.flush()
+
+        for n in range(1, 5):
+            u = User.signup(f"testuser{n}", f"email{n}@test.com", "password", None)
+            u.id = n
+        db.session.commit()
+
+        db.session.add(Message(id=10, text="hello", user_id=1))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        notifications.flush()
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def unread_count(self, user_id):
+        db.session.expire_all()
+        return User.query.get(user_id).unread_notifications
+
+    def test_coalesce(self):
+        for actor in (2, 3, 4):
+            notifications.notify(1, 'like', actor, 10)
+        notifications.notify(1, 'follow', 2)
+        notifications.notify(1, 'like', 1, 10)  # your own doing
+
+        self.assertEqual(notifications.flush(), 4)
+
+        rows = {(n.kind, n.message_id): (n.count, n.actor_id)
+                for n in Notification.query}
+        self.assertEqual(rows, {('like', 10): (3, 4), ('follow', None): (1, 2)})
+        self.assertEqual(self.unread_count(1), 2)
+
+    def test_coalesce_repeat_actors(self):
+        """Does someone liking the same warble again count once?"""
+
+        for actor in (2, 3, 2, 2):
+            notifications.notify(1, 'like', actor, 10)
+        notifications.flush()
+        notifications.notify(1, 'like', 2, 10)
+        notifications.flush()
+
+        note = Notification.query.one()
+        self.assertEqual((note.count, note.actor_id), (2, 2))
+
+    def test_merge_into_unread(self):
+        notifications.notify(1, 'like', 2, 10)
+        notifications.flush()
+        notifications.notify(1, 'like', 3, 10)
+        notifications.flush()
+
+        self.assertEqual([n.count for n in Notification.query], [2])
+        self.assertEqual(self.unread_count(1), 1)
+
+        # once read, new likes start a new notification
+        notifications.mark_read(1)
+        notifications.notify(1, 'like', 4, 10)
+        notifications.flush()
+
+        self.assertEqual(sorted(n.count for n in Notification.query), [1, 2])
+        self.assertEqual(self.unread_count(1), 1)
+
+    def test_deleted_recipient(self):
+        notifications.notify(4, 'follow', 1)
+        db.session.delete(User.query.get(4))
+        db.session.commit()
+
+        notifications.flush()
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_views(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+            c.post("/users/add_like/10")
+            c.post("/users/follow/1")
+            c.post("/messages/new", data={"text": "hi @testuser1"})
+            notifications.flush()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            home = c.get("/").get_data(as_text=True)
+            page = c.get("/notifications").get_data(as_text=True)
+
+        self.assertIn('<span class="badge badge-primary" id="unread-count">3</span>', home)
+        self.assertIn("liked your warble", page)
+        self.assertIn("followed you", page)
+        self.assertIn("mentioned you", page)
+        self.assertEqual(self.unread_count(1), 0)
@@ -0,0 +1,135 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import ratelimit
+from ratelimit import Limit, MemoryBackend, SQLiteBackend, parse_limit
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BucketTestCase(TestCase):
+    """Test the token buckets on each backend."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit("10/minute"), Limit(10, 60))
+        self.assertEqual(parse_limit("100/hour").rate, 100 / 3600)
+        with self.assertRaises(ValueError):
+            parse_limit("10 per minute")
+        with self.assertRaises(ValueError):
+            parse_limit("10/fortnight")
+
+    def check_backend(self, backend):
+        limit = Limit(3, 60)
+
+        # a burst of 3, then wait for a token at 1 per 20s
+        self.assertEqual([backend.take("k", limit, 1000) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(backend.take("k", limit, 1000), 20)
+        self.assertAlmostEqual(backend.take("k", limit, 1010), 10)
+        self.assertEqual(backend.take("k", limit, 1020), 0)
+
+        # other keys have their own buckets
+        self.assertEqual(backend.take("other", limit, 1020), 0)
+
+        # never more than the limit, however long it's been
+        self.assertEqual([backend.take("k", limit, 9999) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(backend.take("k", limit, 9999), 0)
+
+    def test_memory(self):
+        self.check_backend(MemoryBackend())
+
+    def test_sqlite(self):
+        self.check_backend(SQLiteBackend(self.path))
+
+    def test_sqlite_shared(self):
+        # two workers opening the same file share buckets
+        limit = Limit(2, 60)
+        first, second = SQLiteBackend(self.path), SQLiteBackend(self.path)
+
+        self.assertEqual(first.take("k", limit, 1000), 0)
+        self.assertEqual(second.take("k", limit, 1000), 0)
+        self.assertGreater(first.take("k", limit, 1000), 0)
+
+    def test_create_backend(self):
+        self.assertIsInstance(ratelimit.create_backend("memory://"), MemoryBackend)
+        self.assertIsInstance(ratelimit.create_backend(f"sqlite:///{self.path}"),
+                              SQLiteBackend)
+        with self.assertRaises(ValueError):
+            ratelimit.create_backend("redis://localhost")
+
+
+class RateLimitViewsTestCase(TestCase):
+    """Test limited routes answer 429."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for n in (1, 2):
+            u = User.signup(f"testuser{n}", f"email{n}@test.com", "password", None)
+            u.id = n
+        db.session.commit()
+
+        ratelimit.configure("memory://")
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['RATE_LIMITS'] = {}
+        ratelimit.configure("memory://")
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_login(self):
+        app.config['RATE_LIMITS'] = {'login': {'ip': '2/minute'}}
+        data = {"username": "testuser1", "password": "wrong"}
+
+        self.assertEqual(self.client.post("/login", data=data).status_code, 200)
+        self.assertEqual(self.client.post("/login", data=data).status_code, 200)
+
+        resp = self.client.post("/login", data=data)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers["Retry-After"], "30")
+
+        # the form is still shown; only attempts count
+        self.assertEqual(self.client.get("/login").status_code, 200)
+
+    def test_per_user(self):
+        app.config['RATE_LIMITS'] = {'messages_add': {'user': '1/minute'}}
+
+        for user_id in (1, 2):
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            resp = self.client.post("/messages/new", data={"text": "hi"})
+            self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.post("/messages/new", data={"text": "hi again"})
+        self.assertEqual(resp.status_code, 429)
+
+    def test_disabled(self):
+        app.config['RATE_LIMITS'] = {'login': None}
+        for _ in range(20):
+            resp = self.client.post("/login", data={"username": "x", "password": "y"})
+            self.assertEqual(resp.status_code, 200)
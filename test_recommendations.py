@@ -0,0 +1,85 @@
+"""Follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, Suggestion, StaleSuggestions
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import recommendations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RecommendationsTestCase(TestCase):
+    """Test computing, storing and showing suggestions."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for n in range(1, 6):
+            u = User.signup(f"testuser{n}", f"email{n}@test.com", "password", None)
+            u.id = n
+        db.session.commit()
+
+        # 1 follows 2; 2 follows 3 and 4; 5 follows 4
+        for follower, followed in [(1, 2), (2, 3), (2, 4), (5, 4)]:
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def suggested(self, user_id):
+        return [(s.suggested_user_id, s.score) for s in
+                Suggestion.query.filter_by(user_id=user_id).order_by(Suggestion.rank)]
+
+    def test_refresh(self):
+        count = recommendations.refresh()
+
+        self.assertEqual(count, 5)
+        # friends of friends first, then someone following the same people
+        self.assertEqual(self.suggested(1), [(3, 1.0), (4, 1.0)])
+        self.assertEqual(self.suggested(5), [(2, 0.5)])
+        # nobody to go on: the most-followed users
+        self.assertEqual([user_id for user_id, _ in self.suggested(3)], [4, 2])
+
+    def test_refresh_stale(self):
+        recommendations.refresh()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post("/users/follow/3")
+
+        self.assertEqual([s.user_id for s in StaleSuggestions.query], [1])
+
+        self.assertEqual(recommendations.refresh_stale(), 1)
+        self.assertEqual(self.suggested(1), [(4, 1.0)])
+        self.assertEqual(StaleSuggestions.query.count(), 0)
+        self.assertEqual(recommendations.refresh_stale(), 0)
+
+    def test_shown_on_homepage(self):
+        recommendations.refresh()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn("Who to follow", html)
+        self.assertIn("@testuser3", html)
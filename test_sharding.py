@@ -0,0 +1,335 @@
+"""Sharded messages and likes tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+import os
+import shutil
+import tempfile
+from collections import Counter
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine, func, select
+
+from models import (db, User, IdBlock, Message, Likes, ArchivedMessage, ArchivedLike,
+                    MessageTag, Mention, Notification)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import records, record_key
+from export import export_records
+import notifications
+import sharding
+from sharding import HashRing, IdAllocator, Shards
+import viewer_state
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HashRingTestCase(TestCase):
+    """Test placing keys on shards."""
+
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = Counter(ring.node_for(key) for key in range(10_000))
+
+        self.assertEqual(set(counts), {'a', 'b', 'c'})
+        for count in counts.values():
+            self.assertGreater(count, 2500)
+        self.assertEqual(ring.node_for(42), HashRing(['c', 'b', 'a']).node_for(42))
+
+    def test_adding_a_node_moves_few_keys(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+
+        moved = [key for key in range(10_000)
+                 if before.node_for(key) != after.node_for(key)]
+        # about a quarter, and only onto the new node
+        self.assertLess(len(moved), 3500)
+        self.assertEqual({after.node_for(key) for key in moved}, {'d'})
+
+    def test_parse_shard_urls(self):
+        self.assertEqual(sharding.parse_shard_urls(None), {})
+        self.assertEqual(sharding.parse_shard_urls("a=sqlite:///a.db, b=sqlite:///b.db"),
+                         {'a': 'sqlite:///a.db', 'b': 'sqlite:///b.db'})
+        with self.assertRaises(ValueError):
+            sharding.parse_shard_urls("sqlite:///a.db")
+
+
+class IdAllocatorTestCase(TestCase):
+    """Test handing out global ids in blocks."""
+
+    def test_unique(self):
+        engine = create_engine('sqlite://')
+        IdBlock.__table__.create(engine)
+
+        first = IdAllocator(engine, 'messages', block_size=3)
+        second = IdAllocator(engine, 'messages', block_size=3)
+
+        ids = [first.next_id(), second.next_id(), first.next_id(),
+               first.next_id(), first.next_id(), second.next_id()]
+        self.assertEqual(ids, [1, 4, 2, 3, 7, 5])
+
+
+class ShardsTestCase(TestCase):
+    """Test reads and writes across SQLite shards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for n in range(1, 7):
+            u = User.signup(f"testuser{n}", f"email{n}@test.com", "password", None)
+            u.id = n
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+        self.shards = self.make_shards('a', 'b', 'c')
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        app.extensions['shards'] = None
+        shutil.rmtree(self.dir)
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def make_shards(self, *names):
+        urls = {name: f"sqlite:///{self.dir}/{name}.db" for name in names}
+        return sharding.connect(urls, db.engine)
+
+    def post(self, user_id, text):
+        return self.shards.add_message(user_id, text)
+
+    def test_placement(self):
+        for user_id in range(1, 7):
+            self.post(user_id, f"from {user_id}")
+
+        for name, engine in self.shards.engines.items():
+            with engine.connect() as conn:
+                user_ids = [row.user_id for row in
+                            conn.execute(select([sharding.messages.c.user_id]))]
+            for user_id in user_ids:
+                self.assertEqual(self.shards.name_for(user_id), name)
+
+    def test_timeline(self):
+        ids = [self.post(user_id, f"m{n}")
+               for n, user_id in enumerate([2, 1, 6, 5, 4, 3, 2, 1])]
+        # newest first
+        ids.reverse()
+
+        page = self.shards.timeline([1, 2, 3, 4, 5, 6], limit=5)
+        self.assertEqual([msg.id for msg in page], ids[:5])
+        self.assertEqual(page[0].user.username, "testuser1")
+
+        page = self.shards.timeline([1, 2, 3, 4, 5, 6], before=ids[4], limit=5)
+        self.assertEqual([msg.id for msg in page], ids[5:])
+
+        newer = self.shards.timeline([1, 2, 3, 4, 5, 6], since=ids[2])
+        self.assertEqual([msg.id for msg in newer], [ids[1], ids[0]])
+
+        self.assertEqual([msg.id for msg in self.shards.timeline([2])], [ids[1], ids[7]])
+
+    def test_likes(self):
+        old = self.post(2, "old")
+        new = self.post(3, "new")
+
+        self.assertTrue(self.shards.toggle_like(1, self.shards.find(old)))
+        self.assertTrue(self.shards.toggle_like(1, self.shards.find(new)))
+        self.assertTrue(self.shards.has_liked(1, old))
+        self.assertEqual([msg.text for msg in self.shards.liked_messages(1)],
+                         ["new", "old"])
+
+        self.assertFalse(self.shards.toggle_like(1, self.shards.find(old)))
+        self.assertFalse(self.shards.has_liked(1, old))
+
+        self.shards.delete_message(new, 3)
+        self.assertIsNone(self.shards.find(new))
+        self.assertEqual(self.shards.liked_messages(1), [])
+
+    def test_rebalance(self):
+        ids = {user_id: self.post(user_id, "hi") for user_id in range(1, 7)}
+        for user_id in range(2, 7):
+            self.shards.toggle_like(user_id, self.shards.find(ids[1]))
+
+        # a fourth shard joins
+        self.shards = self.make_shards('a', 'b', 'c', 'd')
+        moved = self.shards.rebalance(batch_size=1)
+        self.assertEqual(self.shards.rebalance(), {'a': 0, 'b': 0, 'c': 0, 'd': 0})
+
+        total = 0
+        for name, engine in self.shards.engines.items():
+            with engine.connect() as conn:
+                total += conn.execute(select([func.count()])
+                                      .select_from(sharding.messages)).scalar()
+            self.assertEqual(self.shards.misplaced_users(name), [])
+        self.assertEqual(total, 6)
+        # only users now on the new shard moved: their message, and their
+        # like (everyone but user 1 liked something)
+        on_d = [user_id for user_id in range(1, 7) if self.shards.name_for(user_id) == 'd']
+        self.assertEqual(moved['d'], 0)
+        self.assertEqual(sum(moved.values()),
+                         len(on_d) + len([user_id for user_id in on_d if user_id != 1]))
+
+        for user_id in range(1, 7):
+            self.assertEqual([msg.id for msg in self.shards.timeline([user_id])],
+                             [ids[user_id]])
+        self.assertEqual(len(self.shards.liked_messages(2)), 1)
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def archive(self, user_id, text):
+        """An archived message in the main database, from before sharding."""
+
+        msg = ArchivedMessage(id=1000 + user_id, text=text, user_id=user_id,
+                              timestamp=datetime(2020, 1, 1))
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def test_archive_fallback(self):
+        archived = self.archive(2, "archived")
+        ids = [self.post(2, "hot"), self.post(2, "hotter")]
+
+        page = self.shards.timeline([2], limit=2)
+        self.assertEqual([msg.id for msg in page], [ids[1], ids[0]])
+        page = self.shards.timeline([2], before=ids[0])
+        self.assertEqual([msg.text for msg in page], ["archived"])
+        self.assertEqual([msg.id for msg in self.shards.find_many([archived, ids[0]])],
+                         [archived, ids[0]])
+
+        db.session.add(ArchivedLike(id=1, user_id=1, message_id=archived))
+        db.session.commit()
+        self.shards.toggle_like(1, self.shards.find(ids[1]))
+        self.assertEqual([msg.text for msg in self.shards.liked_messages(1)],
+                         ["hotter", "archived"])
+        self.assertEqual([msg.text for msg in self.shards.liked_messages(1, before=ids[1])],
+                         ["archived"])
+
+    def test_move_from_main(self):
+        db.session.add_all([Message(id=1, text="one", user_id=1),
+                            Message(id=2, text="two", user_id=2),
+                            Message(id=3, text="three", user_id=3)])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=2, message_id=1), Likes(user_id=4, message_id=3)])
+        db.session.commit()
+
+        # a move that got as far as copying one message
+        with self.shards.engine_for(1).begin() as conn:
+            conn.execute(sharding.messages.insert(),
+                         {'id': 1, 'text': "one", 'timestamp': datetime(2020, 1, 1),
+                          'user_id': 1})
+
+        copied = self.shards.move_from_main(batch_size=2)
+
+        self.assertEqual(copied, {'messages': 2, 'likes': 2})
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        for user_id, text in ((1, "one"), (2, "two"), (3, "three")):
+            self.assertEqual([msg.text for msg in self.shards.timeline([user_id])], [text])
+        self.assertEqual([msg.id for msg in self.shards.liked_messages(2)], [1])
+        self.assertEqual(self.shards.liked_ids([4]), {4: [3]})
+
+        self.assertEqual(self.shards.move_from_main(), {'messages': 0, 'likes': 0})
+
+    def test_move_to_shards_command(self):
+        db.session.add(Message(id=1, text="one", user_id=1))
+        db.session.commit()
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=["move-to-shards"])
+        self.assertNotEqual(result.exit_code, 0)
+
+        app.extensions['shards'] = self.shards
+        result = runner.invoke(args=["move-to-shards"])
+        self.assertIn("moved 1 messages and 0 likes", result.output)
+        self.assertEqual([msg.text for msg in self.shards.timeline([1])], ["one"])
+
+    def test_viewer_state(self):
+        msg_id = self.post(2, "hi")
+        self.shards.toggle_like(1, self.shards.find(msg_id))
+        app.extensions['shards'] = self.shards
+
+        self.assertTrue(viewer_state.load(1).has_liked(msg_id))
+        self.assertTrue(viewer_state.load_many([1, 2])[0].has_liked(msg_id))
+
+    def test_export(self):
+        msg_id = self.post(1, "mine")
+        liked = self.post(2, "theirs")
+        self.shards.toggle_like(1, self.shards.find(liked))
+
+        found = [(record['type'], record['id']) for record in export_records(1, self.shards)]
+        self.assertEqual(found, [('message', msg_id), ('like', liked)])
+
+    def test_delete_user(self):
+        app.extensions['shards'] = self.shards
+        client = app.test_client()
+
+        self.login(client, 3)
+        client.post("/messages/new", data={"text": "bye #gone"})
+        msg_id = self.shards.timeline([3])[0].id
+        self.shards.toggle_like(3, self.shards.find(self.post(1, "hi")))
+        self.shards.toggle_like(1, self.shards.find(msg_id))
+
+        client.post("/users/delete")
+
+        self.assertIsNone(self.shards.find(msg_id))
+        self.assertEqual(self.shards.liked_ids([1, 3]), {1: [], 3: []})
+        self.assertEqual(MessageTag.query.count(), 0)
+
+    def test_routes(self):
+        app.extensions['shards'] = self.shards
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        resp = client.post("/messages/new", data={"text": "sharded warble"})
+        self.assertEqual(resp.status_code, 302)
+        msg_id = self.shards.timeline([1])[0].id
+
+        self.assertIn("sharded warble", client.get("/users/1").get_data(as_text=True))
+        self.assertIn("sharded warble", client.get("/").get_data(as_text=True))
+        self.assertIn("sharded warble",
+                      client.get(f"/messages/{msg_id}").get_data(as_text=True))
+        self.assertEqual(client.get("/messages/999999").status_code, 404)
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 2
+        client.post(f"/users/add_like/{msg_id}")
+        self.assertIn("sharded warble",
+                      client.get("/users/2/liked_warbles").get_data(as_text=True))
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        client.post(f"/messages/{msg_id}/delete")
+        self.assertIsNone(self.shards.find(msg_id))
+
+    def test_routes_index_and_invalidate(self):
+        app.extensions['shards'] = self.shards
+        client = app.test_client()
+        self.login(client, 1)
+
+        client.post("/messages/new", data={"text": "hey @testuser2 #sharded"})
+        msg_id = self.shards.timeline([1])[0].id
+        notifications.flush()
+
+        self.assertEqual(Mention.query.one().message_id, msg_id)
+        self.assertIn(f"/messages/{msg_id}", client.get("/tags/sharded").get_data(as_text=True))
+        self.assertEqual(Notification.query.filter_by(user_id=2, kind='mention').count(), 1)
+
+        self.assertEqual(client.get(f"/api/v1/messages/{msg_id}").status_code, 200)
+        self.assertIsNotNone(records.get(record_key('message', msg_id)))
+
+        client.post(f"/messages/{msg_id}/delete")
+        self.assertIsNone(records.get(record_key('message', msg_id)))
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(client.get(f"/api/v1/messages/{msg_id}").status_code, 404)
@@ -0,0 +1,120 @@
+"""Snowflake message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+
+from models import db, User, Message, IdBlock
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+import snowflake
+from sharding import IdAllocator
+
+
+class SnowflakeTestCase(TestCase):
+    """Test making and reading ids."""
+
+    def test_ids_increase(self):
+        generator = snowflake.Snowflake(3)
+        ids = [generator.next_id() for _ in range(10_000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_clock_going_back(self):
+        generator = snowflake.Snowflake(0)
+        now = [1000]
+        generator._now_ms = lambda: now[0]
+
+        first = generator.next_id()
+        now[0] = 500
+        self.assertGreater(generator.next_id(), first)
+
+    def test_workers_differ(self):
+        self.assertNotEqual(snowflake.make_id(1000, worker=1),
+                            snowflake.make_id(1000, worker=2))
+        with self.assertRaises(ValueError):
+            snowflake.Snowflake(snowflake.MAX_WORKER + 1)
+
+    def test_worker_lease(self):
+        with patch.dict(os.environ, {'SNOWFLAKE_WORKER_ID': '7'}):
+            self.assertEqual(snowflake._default_worker(), 7)
+
+        with patch.dict(os.environ), patch.object(snowflake, '_lease', None):
+            os.environ.pop('SNOWFLAKE_WORKER_ID', None)
+            with self.assertRaises(RuntimeError):
+                snowflake._default_worker()
+
+        leases = IdAllocator(create_engine('sqlite://'), 'snowflake_workers',
+                             block_size=1, start=0)
+        IdBlock.__table__.create(leases.engine)
+        with patch.dict(os.environ), patch.object(snowflake, '_lease', leases.next_id):
+            os.environ.pop('SNOWFLAKE_WORKER_ID', None)
+            workers = [snowflake._default_worker() for _ in range(snowflake.MAX_WORKER + 2)]
+        self.assertEqual(workers[:3], [0, 1, 2])
+        self.assertEqual(len(set(workers[:-1])), snowflake.MAX_WORKER + 1)
+        # round again only after every worker id has been handed out
+        self.assertEqual(workers[-1], 0)
+
+    def test_timestamp_of(self):
+        when = datetime(2026, 3, 4, 5, 6, 7, 8000)
+        message_id = snowflake.id_at(when, worker=5, sequence=17)
+
+        self.assertEqual(snowflake.timestamp_of(message_id), when)
+        self.assertTrue(snowflake.is_snowflake(message_id))
+        self.assertFalse(snowflake.is_snowflake(12345))
+
+    def test_next_id_is_recent(self):
+        made = snowflake.timestamp_of(snowflake.next_id())
+        self.assertLess(abs(made - datetime.utcnow()), timedelta(seconds=5))
+
+
+class MessageIdTestCase(TestCase):
+    """Test messages getting snowflake ids."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_new_message(self):
+        first = Message(text="first", user_id=self.user.id)
+        second = Message(text="second", user_id=self.user.id)
+        db.session.add_all([first, second])
+        db.session.commit()
+
+        self.assertTrue(snowflake.is_snowflake(first.id))
+        self.assertLess(first.id, second.id)
+        self.assertEqual(first.timestamp, snowflake.timestamp_of(first.id))
+
+    def test_timeline_by_id(self):
+        old = Message(id=7, text="old", user_id=self.user.id)
+        new = Message(text="new", user_id=self.user.id)
+        db.session.add_all([new, old])
+        db.session.commit()
+
+        page = Message.timeline([self.user.id])
+        self.assertEqual([msg.text for msg in page], ["new", "old"])
+        self.assertEqual([msg.text for msg in Message.timeline([self.user.id], before=new.id)],
+                         ["old"])
+        self.assertEqual([msg.text for msg in Message.timeline([self.user.id], since=old.id)],
+                         ["new"])
@@ -0,0 +1,76 @@
+"""Streamed template rendering tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_streaming.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from streaming import _chunks
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class StreamingTestCase(TestCase):
+    """Test the list pages that stream as they render."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for n in range(1, 5):
+            u = User.signup(f"testuser{n}", f"email{n}@test.com", "password", None)
+            u.id = n
+        db.session.commit()
+
+        # 2 and 3 follow 1
+        for follower in (2, 3):
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=1))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_chunks(self):
+        pieces = ['ab', 'cd', 'e', 'fgh', 'i']
+        self.assertEqual(list(_chunks(pieces, 4)), ['abcd', 'efgh', 'i'])
+        self.assertEqual(list(_chunks([], 4)), [])
+
+    def test_list_users(self):
+        resp = self.client.get("/users")
+        self.assertTrue(resp.is_streamed)
+        html = resp.get_data(as_text=True)
+
+        for n in range(1, 5):
+            self.assertIn(f"@testuser{n}", html)
+        self.assertNotIn("no users found", html)
+        self.assertTrue(html.rstrip().endswith("</html>"))
+
+    def test_search_no_results(self):
+        html = self.client.get("/users?q=nobody").get_data(as_text=True)
+        self.assertIn("Sorry, no users found", html)
+
+    def test_followers(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+            resp = c.get("/users/1/followers")
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+
+        self.assertIn("@testuser2", html)
+        self.assertIn("@testuser3", html)
+        self.assertNotIn("@testuser4</p>", html)
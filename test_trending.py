@@ -0,0 +1,135 @@
+"""Trending aggregator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import trending
+from trending import CountMinSketch, TopK, Tracker
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AggregatorTestCase(TestCase):
+    """Test the sketch, the top-K heap and decay."""
+
+    def setUp(self):
+        trending.reset()
+
+    def test_sketch_never_undercounts(self):
+        sketch = CountMinSketch(width=64, depth=3)
+        for key in range(500):
+            for _ in range(key % 5):
+                sketch.add(key)
+
+        for key in range(500):
+            self.assertGreaterEqual(sketch.estimate(key), key % 5)
+
+    def test_top_k(self):
+        top = TopK(capacity=3)
+        for key, count in [(1, 5), (2, 1), (3, 3), (4, 4), (2, 6), (5, 2)]:
+            top.offer(key, count)
+
+        self.assertEqual(top.items(), [(2, 6), (1, 5), (4, 4)])
+
+    def test_decay(self):
+        tracker = Tracker(half_life=60)
+        tracker.add(1, now=0)
+        tracker.add(1, now=0)
+        tracker.add(2, now=60)
+
+        # two likes a half-life ago count as much as one now
+        self.assertEqual(tracker.top_items(10, now=60), [(1, 1.0), (2, 1.0)])
+        self.assertEqual(tracker.top_items(10, now=120), [(1, 0.5), (2, 0.5)])
+
+    def test_rescale(self):
+        tracker = Tracker(half_life=1)
+        tracker.add(1, now=0)
+        tracker.add(1, now=1000)
+
+        self.assertEqual(tracker.t0, 1000)
+        self.assertAlmostEqual(tracker.top_items(1, now=1000)[0][1], 1.0)
+
+    def test_checkpoint(self):
+        trending.record_like(10, 1, now=100)
+        trending.record_message(2, now=100)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trending.ckpt")
+            trending.save(path)
+            trending.reset()
+            trending.configure(path)
+            trending.configure(None)
+
+        self.assertEqual(trending.top('messages', now=100), [(10, 1.0)])
+        self.assertEqual(trending.top('users', now=100), [(1, 1.0), (2, 1.0)])
+
+
+    def test_checkpoint_not_written_by_events(self):
+        """Are checkpoints left to the background thread?"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trending.ckpt")
+            trending.configure(path)
+            try:
+                trending.record_like(10, 1)
+                self.assertFalse(os.path.exists(path))
+
+                trending.checkpoint()
+                self.assertTrue(os.path.exists(path))
+            finally:
+                trending.configure(None)
+
+
+class TrendingViewsTestCase(TestCase):
+    """Test that likes and messages show up on the trending page and API."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        trending.reset()
+
+        u1 = User.signup("testuser1", "email1@test.com", "password", None)
+        u1.id = 1111
+        u2 = User.signup("testuser2", "email2@test.com", "password", None)
+        u2.id = 2222
+        db.session.commit()
+
+        db.session.add(Message(id=100, text="popular warble", user_id=2222))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_trending(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            c.post("/users/add_like/100")
+            c.post("/messages/new", data={"text": "hello"})
+
+            html = c.get("/trending").get_data(as_text=True)
+            data = c.get("/api/v1/trending?window=day&fields=id").get_json()
+            bad = c.get("/api/v1/trending?window=year")
+
+        self.assertIn("popular warble", html)
+        self.assertIn("@testuser2", html)
+        self.assertEqual([m["id"] for m in data["messages"]], [100])
+        self.assertEqual({u["id"] for u in data["users"]}, {1111, 2222})
+        self.assertEqual(bad.status_code, 400)
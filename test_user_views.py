@@ -109,3 +109,30 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 302, "Response should be a redirect")
             self.assertNotIn("@testuser", str(resp.data), "User @testuser should not be in response without login")
+
+    def test_export_user(self):
+        """Does the export stream the user's messages and follows?"""
+        m = Message(text="exported warble", user_id=self.testuser_id)
+        f = Follows(user_being_followed_id=self.u1_id, user_following_id=self.testuser_id)
+        db.session.add_all([m, f])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}/export?format=ndjson")
+            self.assertEqual(resp.status_code, 200)
+
+            lines = resp.get_data(as_text=True).splitlines()
+            self.assertIn('"text": "exported warble"', lines[0])
+            self.assertIn(f'{{"type": "following", "user_id": {self.u1_id}}}', lines)
+
+    def test_export_other_user(self):
+        """Is exporting someone else's data refused?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.u1_id}/export")
+            self.assertEqual(resp.status_code, 302)
@@ -0,0 +1,103 @@
+"""Viewer state tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_viewer_state.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY, VIEWER_VERSION_KEY
+import viewer_state
+from viewer_state import IntSet
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class IntSetTestCase(TestCase):
+    """Test the sorted-array integer set."""
+
+    def test_membership(self):
+        ids = IntSet([5, 3, 9, 3])
+
+        self.assertEqual(list(ids), [3, 5, 9])
+        self.assertIn(5, ids)
+        self.assertNotIn(4, ids)
+        self.assertNotIn(10, ids)
+
+    def test_adding_and_removing(self):
+        ids = IntSet([3, 9])
+
+        added = ids.adding(5)
+        self.assertEqual(list(added), [3, 5, 9])
+        self.assertEqual(list(ids), [3, 9])
+
+        self.assertEqual(list(added.removing(3)), [5, 9])
+        self.assertEqual(len(IntSet([1]).removing(1)), 0)
+
+
+class ViewerStateTestCase(TestCase):
+    """Test that the cached state follows likes and follows."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        viewer_state._states.clear()
+
+        u1 = User.signup("testuser1", "email1@test.com", "password", None)
+        u1.id = 1111
+        u2 = User.signup("testuser2", "email2@test.com", "password", None)
+        u2.id = 2222
+        db.session.add(Message(id=1, text="a warble", user_id=2222))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_load(self):
+        db.session.add(Follows(user_being_followed_id=2222, user_following_id=1111))
+        db.session.add(Likes(user_id=1111, message_id=1))
+        db.session.commit()
+
+        state = viewer_state.for_user(1111)
+        self.assertTrue(state.is_following(2222))
+        self.assertTrue(state.has_liked(1))
+        self.assertFalse(state.is_following(1111))
+
+    def test_follow_and_like_update_state(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            c.get("/")
+            c.post("/users/follow/2222")
+            c.post("/users/add_like/1")
+
+            with c.session_transaction() as sess:
+                version = sess[VIEWER_VERSION_KEY]
+
+        self.assertEqual(version, 2)
+
+        state = viewer_state._states.get(1111)
+        self.assertEqual(state.version, 2)
+        self.assertTrue(state.is_following(2222))
+        self.assertTrue(state.has_liked(1))
+
+    def test_stale_state_is_reloaded(self):
+        viewer_state.for_user(1111, version=0)
+
+        # followed through some other worker
+        db.session.add(Follows(user_being_followed_id=2222, user_following_id=1111))
+        db.session.commit()
+
+        self.assertTrue(viewer_state.for_user(1111, version=1).is_following(2222))
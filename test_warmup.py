@@ -0,0 +1,121 @@
+"""Cache warm-up tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_warmup.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from cache import records, record_key
+import viewer_state
+import warmup
+
+ACCESS_LOG = """\
+10.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /users/3 HTTP/1.1" 200 512 "-" "curl"
+10.0.0.1 - - [19/Oct/2026:10:00:01 +0000] "GET /users/3/followers HTTP/1.1" 200 512 "-" "curl"
+10.0.0.2 - - [19/Oct/2026:10:00:02 +0000] "GET /api/users/2?fields=id HTTP/1.1" 200 64 "-" "curl"
+10.0.0.2 - - [19/Oct/2026:10:00:03 +0000] "POST /users/follow/2 HTTP/1.1" 302 0 "-" "curl"
+10.0.0.3 - - [19/Oct/2026:10:00:04 +0000] "GET / HTTP/1.1" 200 4096 "http://example.com/users/9" "curl"
+10.0.0.3 - - [19/Oct/2026:10:00:05 +0000] "GET /users/33 HTTP/1.1" 200 512 "-" "curl"
+"""
+
+
+class HotListTestCase(TestCase):
+    """Test making and reading hot lists."""
+
+    def test_hot_list(self):
+        self.assertEqual(warmup.hot_list(ACCESS_LOG.splitlines()), [3, 2, 33])
+        self.assertEqual(warmup.hot_list(ACCESS_LOG.splitlines(), limit=1), [3])
+
+    def test_read_hot_list(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write("# hottest first\n3\n\n2  # busy\n")
+        try:
+            self.assertEqual(warmup.read_hot_list(f.name), [3, 2])
+        finally:
+            os.unlink(f.name)
+
+
+class WarmTestCase(TestCase):
+    """Test warming the caches."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.drop_all()
+        db.create_all()
+        viewer_state._states.clear()
+        records.clear()
+
+        for n in range(1, 6):
+            db.session.add(User(id=n, username=f"user{n}", email=f"user{n}@test.com",
+                                password="x"))
+        db.session.commit()
+        db.session.add_all([Follows(user_following_id=1, user_being_followed_id=2),
+                            Message(id=100, text="hi", user_id=2)])
+        db.session.commit()
+        db.session.add(Likes(user_id=1, message_id=100))
+        db.session.commit()
+
+    def tearDown(self):
+        viewer_state._states.clear()
+        records.clear()
+        db.session.rollback()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_warm(self):
+        stats = warmup.warm([1, 2, 3], batch_size=2)
+
+        self.assertEqual(stats.users, 3)
+        self.assertIsNone(stats.stopped)
+        self.assertGreater(stats.bytes, 0)
+        self.assertEqual(records.get(record_key('user', 1))['username'], "user1")
+
+        state = viewer_state._states.get(1)
+        self.assertIsNone(state.version)
+        self.assertIn(2, state.following)
+        self.assertIn(100, state.liked)
+
+    def test_budgets(self):
+        stats = warmup.warm([1, 2, 3], time_budget=0)
+        self.assertEqual((stats.users, stats.stopped), (0, 'time'))
+
+        stats = warmup.warm([1, 2, 3], batch_size=1, memory_budget=1)
+        self.assertEqual((stats.users, stats.stopped), (0, 'memory'))
+
+        stats = warmup.warm([1, 2, 3], batch_size=1,
+                            memory_budget=warmup.warm([], batch_size=1).bytes + 1)
+        self.assertEqual((stats.users, stats.stopped), (1, 'memory'))
+
+    def test_preloaded_state_is_adopted(self):
+        warmup.warm([1])
+        # read from the cache, not the database
+        Follows.query.delete()
+        db.session.commit()
+
+        # nothing changed since it was loaded: taken at the session's version
+        state = viewer_state.for_user(1, version=7, changed_at=time.time() - 3600)
+        self.assertEqual(state.version, 7)
+        self.assertIn(2, state.following)
+
+    def test_preloaded_state_after_a_change(self):
+        warmup.warm([1])
+        Follows.query.delete()
+        db.session.commit()
+
+        state = viewer_state.for_user(1, version=3, changed_at=time.time() + 1)
+        self.assertNotIn(2, state.following)
+
+    def test_recent_authors(self):
+        db.session.add(Message(id=200, text="later", user_id=4))
+        db.session.commit()
+        self.assertEqual(warmup.recent_authors(), [4, 2])
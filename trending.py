@@ -0,0 +1,302 @@
+"""Trending messages and users, counted in memory as events happen.
+
+Likes (per message) and activity (per user: messages posted and likes
+received) are counted by a `Tracker` per window in WINDOWS, with
+exponential decay: in the 'hour' window a like from an hour ago counts
+half as much as one just now. Counts live in a count-min sketch, so
+memory stays fixed however many ids show up, and a heap keeps the top
+items; nothing here touches the database.
+
+Decay is "forward decay": an event at time t adds 2 ** ((t - t0) / half_life)
+instead of 1, so stored counts never have to be decayed and always rank
+in the same order as the decayed counts. Dividing by the weight of "now"
+turns them into decayed counts.
+
+Each worker counts the events it serves. Behind a load balancer that's an
+even sample of all traffic, so rankings hold; counts are just scaled down.
+With a checkpoint path configured, a background thread writes state
+there every CHECKPOINT_INTERVAL seconds (never in a request), and it's
+read back on startup.
+"""
+
+import atexit
+import logging
+import os
+import pickle
+import random
+import threading
+import time
+from array import array
+from heapq import heapify, heappop, heappush
+
+
+# window name -> half-life in seconds
+WINDOWS = {
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+KINDS = ('messages', 'users')
+
+SKETCH_WIDTH = 4096
+SKETCH_DEPTH = 4
+
+# items tracked per window; pages show far fewer
+TOP_CAPACITY = 200
+
+# rescale counts once the weight of new events reaches 2 ** this
+RESCALE_AFTER = 256
+
+CHECKPOINT_INTERVAL = 60
+
+_PRIME = (1 << 61) - 1
+
+
+class CountMinSketch:
+    """Approximate counts in fixed memory; estimates are never too low.
+
+    Uses conservative update: an add only raises the counters that are
+    below the item's new estimate, which keeps over-counting down.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, seed=0):
+        self.width = width
+        self.depth = depth
+        rand = random.Random(seed)
+        self.hashes = [(rand.randrange(1, _PRIME), rand.randrange(_PRIME))
+                       for _ in range(depth)]
+        self.rows = [array('d', bytes(8 * width)) for _ in range(depth)]
+
+    def indexes(self, key):
+        """The counter `key` maps to in each row.
+
+        Sketches with the same width, depth and seed share these.
+        """
+
+        width = self.width
+        return [((a * key + b) % _PRIME) % width for a, b in self.hashes]
+
+    def add(self, key, weight=1.0, indexes=None):
+        """Add `weight` to `key` and return its new estimate."""
+
+        cells = list(zip(self.rows, indexes or self.indexes(key)))
+        estimate = min([row[i] for row, i in cells]) + weight
+
+        for row, i in cells:
+            if row[i] < estimate:
+                row[i] = estimate
+        return estimate
+
+    def estimate(self, key):
+        return min([row[i] for row, i in zip(self.rows, self.indexes(key))])
+
+    def scale(self, factor):
+        self.rows = [array('d', (value * factor for value in row))
+                     for row in self.rows]
+
+
+class TopK:
+    """The `capacity` keys with the largest counts offered so far.
+
+    Counts only ever grow, so the heap can hold stale (smaller) entries for
+    a key; they're skipped when they surface.
+    """
+
+    def __init__(self, capacity=TOP_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self._heap = []
+
+    def offer(self, key, count):
+        if key not in self.counts and len(self.counts) >= self.capacity:
+            self._drop_stale()
+            if count <= self._heap[0][0]:
+                return
+            _, evicted = heappop(self._heap)
+            del self.counts[evicted]
+
+        self.counts[key] = count
+        heappush(self._heap, (count, key))
+
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def _drop_stale(self):
+        heap = self._heap
+        while self.counts.get(heap[0][1]) != heap[0][0]:
+            heappop(heap)
+
+    def _rebuild(self):
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapify(self._heap)
+
+    def items(self):
+        """(key, count) pairs, largest count first."""
+
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def scale(self, factor):
+        self.counts = {key: count * factor for key, count in self.counts.items()}
+        self._rebuild()
+
+
+class Tracker:
+    """Exponentially decayed counts for one window, with the top items."""
+
+    def __init__(self, half_life, width=SKETCH_WIDTH, depth=SKETCH_DEPTH,
+                 capacity=TOP_CAPACITY):
+        self.half_life = half_life
+        self.sketch = CountMinSketch(width, depth)
+        self.top = TopK(capacity)
+        self.t0 = None
+
+    def _weight(self, now):
+        return 2.0 ** ((now - self.t0) / self.half_life)
+
+    def add(self, key, now, amount=1.0, indexes=None):
+        if self.t0 is None:
+            self.t0 = now
+        elif now - self.t0 > RESCALE_AFTER * self.half_life:
+            # keep the weights well inside float range
+            factor = 1 / self._weight(now)
+            self.sketch.scale(factor)
+            self.top.scale(factor)
+            self.t0 = now
+
+        weight = amount * self._weight(now)
+        self.top.offer(key, self.sketch.add(key, weight, indexes))
+
+    def top_items(self, limit, now):
+        """Up to `limit` (key, decayed count) pairs, largest first."""
+
+        if self.t0 is None:
+            return []
+
+        weight = self._weight(now)
+        return [(key, count / weight) for key, count in self.top.items()[:limit]]
+
+
+##############################################################################
+# Counting events
+
+
+_trackers = {}
+_lock = threading.Lock()
+
+_checkpoint_path = None
+_checkpointer = None
+
+logger = logging.getLogger(__name__)
+
+
+def reset():
+    """Start counting from nothing."""
+
+    with _lock:
+        _trackers.clear()
+        for kind in KINDS:
+            for window, half_life in WINDOWS.items():
+                _trackers[kind, window] = Tracker(half_life)
+
+
+reset()
+
+
+def _record(kind, key, now, amount=1.0):
+    # every window's sketch hashes alike, so hash the key once
+    indexes = None
+    for window in WINDOWS:
+        tracker = _trackers[kind, window]
+        indexes = indexes or tracker.sketch.indexes(key)
+        tracker.add(key, now, amount, indexes)
+
+
+def record_like(message_id, author_id, now=None):
+    """Count a like on `message_id`, written by `author_id`."""
+
+    now = time.time() if now is None else now
+    with _lock:
+        _record('messages', message_id, now)
+        _record('users', author_id, now)
+    _start_checkpointer()
+
+
+def record_message(user_id, now=None):
+    """Count a message posted by `user_id`."""
+
+    now = time.time() if now is None else now
+    with _lock:
+        _record('users', user_id, now)
+    _start_checkpointer()
+
+
+def top(kind, window='hour', limit=20, now=None):
+    """The `limit` trending message or user ids, as (id, score) pairs."""
+
+    now = time.time() if now is None else now
+    with _lock:
+        return _trackers[kind, window].top_items(limit, now)
+
+
+##############################################################################
+# Checkpoints
+
+
+def configure(path, load_checkpoint=True):
+    """Checkpoint to `path` (None to turn checkpoints off), loading it first."""
+
+    global _checkpoint_path
+    _checkpoint_path = path
+    if path and load_checkpoint and os.path.exists(path):
+        load(path)
+
+
+def save(path):
+    """Write every tracker to `path`, atomically."""
+
+    with _lock:
+        data = pickle.dumps(dict(_trackers), protocol=pickle.HIGHEST_PROTOCOL)
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        trackers = pickle.load(f)
+
+    with _lock:
+        _trackers.update(trackers)
+
+
+def checkpoint():
+    """Write the checkpoint now, if a path is configured."""
+
+    if _checkpoint_path:
+        save(_checkpoint_path)
+
+
+def _run():
+    while True:
+        time.sleep(CHECKPOINT_INTERVAL)
+        try:
+            checkpoint()
+        except Exception:
+            # try again next interval
+            logger.exception("couldn't write the trending checkpoint")
+
+
+def _start_checkpointer():
+    # started by the first event rather than by configure(), so it runs in
+    # the worker that counts, not in a master that forks it
+    global _checkpointer
+
+    if _checkpointer is None and _checkpoint_path:
+        with _lock:
+            if _checkpointer is None:
+                _checkpointer = threading.Thread(target=_run, name='trending-checkpoints',
+                                                 daemon=True)
+                _checkpointer.start()
+                atexit.register(checkpoint)
@@ -0,0 +1,229 @@
+"""Who the logged-in user follows and which messages they've liked.
+
+Pages check "do I follow this user?" and "have I liked this message?" for
+every card and message they show. Rather than load the followed `User`s
+and liked `Message`s for that, each viewer gets a `ViewerState` holding
+just the ids, in compact sorted integer arrays. States are cached per
+worker and kept current by the like/follow routes.
+
+Each state carries a version number that the app keeps in the viewer's
+session and bumps whenever they like or follow. A worker holding a state
+with an older version (because the change went through another worker)
+reloads it, so viewers always see their own changes.
+
+The cache warm-up (warmup.py) preloads states before a worker serves
+anything, without versions. Such a state is adopted at whatever version
+the viewer's session has, unless the session says they changed something
+after it was loaded.
+"""
+
+import sys
+from array import array
+from bisect import bisect_left
+
+from cache import SingleFlight, TTLCache
+from models import db, Follows, Likes, ArchivedLike
+import sharding
+
+
+VIEWER_STATE_TTL = 5 * 60
+
+
+class IntSet:
+    """Immutable set of integers stored as a sorted array.
+
+    Uses 8 bytes per item, against ~60 for a Python set; membership is a
+    binary search.
+    """
+
+    __slots__ = ('_items',)
+
+    def __init__(self, items=()):
+        self._items = array('q', sorted(set(items)))
+
+    def __contains__(self, value):
+        i = bisect_left(self._items, value)
+        return i < len(self._items) and self._items[i] == value
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self._items)
+
+    def adding(self, value):
+        """Return a copy of this set with `value` added."""
+
+        if value in self:
+            return self
+        new = IntSet()
+        i = bisect_left(self._items, value)
+        new._items = self._items[:i] + array('q', [value]) + self._items[i:]
+        return new
+
+    def removing(self, value):
+        """Return a copy of this set without `value`."""
+
+        if value not in self:
+            return self
+        new = IntSet()
+        i = bisect_left(self._items, value)
+        new._items = self._items[:i] + self._items[i + 1:]
+        return new
+
+
+class ViewerState:
+    """Ids of the users a viewer follows and the messages they've liked."""
+
+    __slots__ = ('user_id', 'version', 'following', 'liked')
+
+    def __init__(self, user_id, version, following, liked):
+        self.user_id = user_id
+        self.version = version
+        self.following = following
+        self.liked = liked
+
+    def is_following(self, user_id):
+        return user_id in self.following
+
+    def has_liked(self, message_id):
+        return message_id in self.liked
+
+
+_states = TTLCache(maxsize=10_000, ttl=VIEWER_STATE_TTL)
+_loads = SingleFlight()
+
+# when the warm-up started loading the unversioned states in _states
+_warmed_at = None
+
+
+def load(user_id, version=0):
+    """Read `user_id`'s follows and likes from the database."""
+
+    following = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user_id))
+    archived_liked = (db.session
+                      .query(ArchivedLike.message_id)
+                      .filter(ArchivedLike.user_id == user_id))
+
+    shards = sharding.current()
+    if shards:
+        liked = shards.liked_ids([user_id])[user_id]
+        liked.extend(row[0] for row in archived_liked)
+    else:
+        hot_liked = db.session.query(Likes.message_id).filter(Likes.user_id == user_id)
+        liked = [row[0] for row in hot_liked.union_all(archived_liked)]
+
+    return ViewerState(
+        user_id,
+        version,
+        IntSet(row[0] for row in following),
+        IntSet(liked),
+    )
+
+
+def load_many(user_ids):
+    """Unversioned states for `user_ids`, read with one query per table."""
+
+    following = {user_id: [] for user_id in user_ids}
+    liked = {user_id: [] for user_id in user_ids}
+
+    rows = (db.session
+            .query(Follows.user_following_id, Follows.user_being_followed_id)
+            .filter(Follows.user_following_id.in_(user_ids)))
+    for user_id, other_id in rows:
+        following[user_id].append(other_id)
+
+    shards = sharding.current()
+    if shards:
+        liked.update(shards.liked_ids(user_ids))
+
+    for model in (ArchivedLike,) if shards else (Likes, ArchivedLike):
+        rows = db.session.query(model.user_id, model.message_id).filter(model.user_id.in_(user_ids))
+        for user_id, message_id in rows:
+            liked[user_id].append(message_id)
+
+    return [ViewerState(user_id, None, IntSet(following[user_id]), IntSet(liked[user_id]))
+            for user_id in user_ids]
+
+
+def preload(states, loaded_at):
+    """Cache unversioned `states`, read from the database after `loaded_at`."""
+
+    global _warmed_at
+
+    if _warmed_at is None or loaded_at < _warmed_at:
+        _warmed_at = loaded_at
+    for state in states:
+        _states.set(state.user_id, state)
+
+
+def _load(user_id, version):
+    state = load(user_id, version)
+    _states.set(user_id, state)
+    return state
+
+
+def for_user(user_id, version=0, changed_at=None):
+    """Return the (possibly cached) state for `user_id` at `version`.
+
+    `changed_at` is when the viewer last followed or liked something, if
+    known. Concurrent misses for the same state share one load.
+    """
+
+    state = _states.get(user_id)
+    if state is not None and state.version is None:
+        # preloaded: current unless they've changed something since
+        if changed_at is None or changed_at < _warmed_at:
+            state = ViewerState(user_id, version, state.following, state.liked)
+            _states.set(user_id, state)
+
+    if state is None or state.version != version:
+        state = _loads.do((user_id, version), lambda: _load(user_id, version))
+    return state
+
+
+def _replace(user_id, version, following=None, liked=None):
+    """Swap in an updated copy of `user_id`'s cached state.
+
+    The change is only applied to a state that was current right before it
+    (one version back); anything older is dropped and reloaded when needed.
+    """
+
+    state = _states.get(user_id)
+    if state is None:
+        return
+    if state.version != version - 1:
+        _states.delete(user_id)
+        return
+
+    _states.set(user_id, ViewerState(
+        user_id,
+        version,
+        state.following if following is None else following(state.following),
+        state.liked if liked is None else liked(state.liked),
+    ))
+
+
+def follow(user_id, other_id, version):
+    _replace(user_id, version, following=lambda ids: ids.adding(other_id))
+
+
+def unfollow(user_id, other_id, version):
+    _replace(user_id, version, following=lambda ids: ids.removing(other_id))
+
+
+def like(user_id, message_id, version):
+    _replace(user_id, version, liked=lambda ids: ids.adding(message_id))
+
+
+def unlike(user_id, message_id, version):
+    _replace(user_id, version, liked=lambda ids: ids.removing(message_id))
+
+
+def forget(user_id):
+    _states.delete(user_id)
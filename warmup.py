@@ -0,0 +1,170 @@
+"""Warm the in-process caches before a worker serves traffic.
+
+After a deploy every worker starts cold, and the first minutes of traffic
+all miss on the same busy users at once. `warm()` preloads, for a list of
+the hottest user ids:
+
+- their records in cache.records (profile lookups in the JSON API);
+- their viewer states (who they follow, what they've liked);
+- their home timelines. These aren't kept in-process; reading them pulls
+  the rows into the database's cache (the shards', with sharding on), so
+  the workers' first reads are fast.
+
+It also builds the username/email filter (availability.load()).
+
+Users are warmed a batch at a time, hottest first, until the list runs
+out or a budget is spent: WARMUP_TIME_BUDGET seconds, or
+WARMUP_MEMORY_BUDGET bytes added to the caches (estimated). The budgets
+are checked between batches, so a batch can go a little over.
+
+The hot list is a file of user ids, one per line, hottest first, made
+from the access log with `flask hot-list access.log > hot-users.txt` and
+named by WARMUP_HOT_LIST. Without one, the authors of the latest messages
+are warmed instead.
+
+gunicorn.conf.py runs this in each worker as it boots, or once in the
+master before it forks (WARMUP=master, which preloads the app), so the
+workers start with the caches already full.
+"""
+
+import re
+import sys
+import time
+from collections import Counter, namedtuple
+
+from sqlalchemy import func
+
+import availability
+import cards
+import sharding
+import viewer_state
+from api import user_json
+from cache import records, record_key
+from models import db, User, Message
+
+
+HOT_LIST_SIZE = 1_000
+
+WARM_BATCH_SIZE = 100
+
+WARM_TIME_BUDGET = 10.0
+WARM_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# a page of (or under) a user's profile in an access log's request line,
+# like "GET /users/42/followers HTTP/1.1"
+_USER_REQUEST = re.compile(r'"(?:GET|HEAD) /(?:api/)?users/(\d+)(?:[/? ]|$)')
+
+WarmStats = namedtuple('WarmStats', 'users bytes seconds stopped')
+
+
+def hot_list(lines, limit=HOT_LIST_SIZE):
+    """Ids of the users whose pages `lines` of an access log ask for most."""
+
+    counts = Counter()
+    for line in lines:
+        match = _USER_REQUEST.search(line)
+        if match:
+            counts[int(match.group(1))] += 1
+    return [user_id for user_id, _ in counts.most_common(limit)]
+
+
+def read_hot_list(path):
+    """User ids from a hot list file (one per line, '#' starts a comment)."""
+
+    with open(path) as f:
+        lines = (line.split('#')[0].strip() for line in f)
+        return [int(line) for line in lines if line]
+
+
+def recent_authors(limit=HOT_LIST_SIZE):
+    """Ids of the users who posted most recently."""
+
+    shards = sharding.current()
+    if shards:
+        return shards.recent_authors(limit)
+
+    latest = func.max(Message.id)
+    rows = (db.session
+            .query(Message.user_id)
+            .group_by(Message.user_id)
+            .order_by(latest.desc())
+            .limit(limit))
+    return [user_id for user_id, in rows]
+
+
+def approx_size(value):
+    """Rough bytes held by `value` and what it contains."""
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(key) + approx_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(item) for item in value)
+    elif isinstance(value, viewer_state.ViewerState):
+        size += sys.getsizeof(value.following) + sys.getsizeof(value.liked)
+    return size
+
+
+def _warm_batch(user_ids):
+    """Warm one batch of users; return the bytes added to the caches."""
+
+    added = 0
+
+    loaded_at = time.time()
+    states = viewer_state.load_many(user_ids)
+    viewer_state.preload(states, loaded_at)
+    added += sum(approx_size(state) for state in states)
+
+    # through the cache's loader, so requests missing on the same users
+    # meanwhile wait for these rows rather than query them again
+    keys = {record_key('user', user_id): user_id for user_id in user_ids}
+
+    def load(misses):
+        users = User.query.filter(User.id.in_([keys[key] for key in misses]))
+        return {record_key('user', user.id): user_json(user) for user in users}
+
+    for item in records.get_many_or_load(list(keys), load).values():
+        added += approx_size(item)
+
+    shards = sharding.current()
+    timeline = shards.timeline if shards else cards.timeline
+    for state in states:
+        timeline(user_ids=list(state.following) + [state.user_id])
+
+    db.session.expunge_all()
+    return added
+
+
+def warm(user_ids, time_budget=WARM_TIME_BUDGET, memory_budget=WARM_MEMORY_BUDGET,
+         batch_size=WARM_BATCH_SIZE):
+    """Warm the caches for `user_ids`, hottest first, within the budgets."""
+
+    start = time.monotonic()
+    used = sys.getsizeof(availability.load().counters)
+    warmed = 0
+    stopped = None
+
+    for i in range(0, len(user_ids), batch_size):
+        if time.monotonic() - start >= time_budget:
+            stopped = 'time'
+            break
+        if used >= memory_budget:
+            stopped = 'memory'
+            break
+
+        batch = user_ids[i:i + batch_size]
+        used += _warm_batch(batch)
+        warmed += len(batch)
+
+    return WarmStats(warmed, used, time.monotonic() - start, stopped)
+
+
+def warm_from_config(config):
+    """Warm the hot list named in `config`, or else the latest authors."""
+
+    path = config.get('WARMUP_HOT_LIST')
+    user_ids = read_hot_list(path) if path else recent_authors()
+
+    return warm(user_ids,
+                time_budget=config.get('WARMUP_TIME_BUDGET', WARM_TIME_BUDGET),
+                memory_budget=config.get('WARMUP_MEMORY_BUDGET', WARM_MEMORY_BUDGET))